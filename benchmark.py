@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+"""
+Measures ingest and lookup throughput of a database backend with synthetic
+fingerprints, without decoding any audio.
+
+    python benchmark.py --config dejavu.cnf --songs 200
+    python benchmark.py --type sqlite --option path=/tmp/bench.db
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+
+from dejavu.database import get_database
+from dejavu.fingerprint import FINGERPRINT_REDUCTION
+
+
+def random_hash(rng):
+    return "%0*x" % (FINGERPRINT_REDUCTION,
+                     rng.getrandbits(FINGERPRINT_REDUCTION * 4))
+
+
+def make_song(rng, nhashes, shared):
+    """
+    Returns (hash, offset) tuples of a synthetic song. A part of the hashes
+    is drawn from `shared`, so that lookups hit several songs like real
+    fingerprints do.
+    """
+    hashes = []
+    for offset in xrange(nhashes):
+        if shared and rng.random() < 0.02:
+            hashes.append((rng.choice(shared), offset))
+        else:
+            hashes.append((random_hash(rng), offset))
+    return hashes
+
+
+def benchmark(db, songs, hashes_per_song, queries, query_size, seed,
+              batch=1):
+    rng = random.Random(seed)
+    shared = [random_hash(rng) for _ in xrange(1000)]
+
+    db.setup()
+    db.empty()
+
+    stored = []
+    total = 0
+    start = time.time()
+    for first in xrange(0, songs, batch):
+        pending = []
+        for i in xrange(first, min(first + batch, songs)):
+            hashes = make_song(rng, hashes_per_song, shared)
+            pending.append((db.insert_song("benchmark-%d" % i), hashes))
+            stored.extend(hash for hash, _ in rng.sample(hashes, 100))
+            total += len(hashes)
+        with db.transaction():
+            db.insert_many_hashes(pending)
+            for sid, _ in pending:
+                db.set_song_fingerprinted(sid)
+    elapsed = time.time() - start
+    print("Ingest: %d hashes in %.2fs, %.0f hashes/s"
+          % (total, elapsed, total / elapsed))
+
+    matches = 0
+    start = time.time()
+    for _ in xrange(queries):
+        # half of a query are known hashes, the rest misses
+        query = [(rng.choice(stored), offset)
+                 for offset in xrange(query_size / 2)]
+        query.extend((random_hash(rng), offset)
+                     for offset in xrange(query_size - len(query)))
+        matches += sum(1 for _ in db.return_matches(query))
+    elapsed = time.time() - start
+    print("Lookup: %d queries of %d hashes in %.2fs, %.0f hashes/s, "
+          "%.1f ms per query, %d matches"
+          % (queries, query_size, elapsed, queries * query_size / elapsed,
+             elapsed * 1000 / queries, matches))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark a Dejavu database backend. "
+                    "WARNING: empties the database first.")
+    parser.add_argument('-c', '--config',
+                        help='Dejavu JSON configuration to take the '
+                             'database from')
+    parser.add_argument('-t', '--type',
+                        help='database_type, overrides the configuration')
+    parser.add_argument('-o', '--option', action='append', default=[],
+                        help='database option as key=value, may be repeated')
+    parser.add_argument('--songs', type=int, default=100)
+    parser.add_argument('--hashes', type=int, default=10000,
+                        help='hashes per song')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='songs inserted per transaction, like '
+                             'commit_every')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--query-size', type=int, default=2000,
+                        help='hashes per query, about what a 5 second '
+                             'clip yields')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+
+    database_type = args.type or config.get("database_type", None)
+    options = config.get("database", {}) if not args.type else {}
+    for option in args.option:
+        key, value = option.split("=", 1)
+        options[key] = value
+
+    db = get_database(database_type)(**options)
+    print("Benchmarking %s with %d songs of %d hashes"
+          % (db.type, args.songs, args.hashes))
+    benchmark(db, args.songs, args.hashes, args.queries, args.query_size,
+              args.seed, args.batch)
+    db.close()
+    sys.exit(0)
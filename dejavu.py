@@ -8,6 +8,8 @@ import argparse
 from dejavu import Dejavu
 from dejavu.recognize import FileRecognizer
 from dejavu.recognize import MicrophoneRecognizer
+from dejavu.index import build_index
+from dejavu.server import DEFAULT_ADDRESS, serve
 from argparse import RawTextHelpFormatter
 
 warnings.filterwarnings("ignore")
@@ -51,9 +53,34 @@ if __name__ == '__main__':
                              'Usage: \n'
                              '--recognize mic number_of_seconds \n'
                              '--recognize file path/to/file \n')
+    parser.add_argument('-s', '--serve', nargs='?', const=DEFAULT_ADDRESS,
+                        help='Keep running and answer recognition '
+                             'requests over HTTP\n'
+                             'Usages: \n'
+                             '--serve\n'
+                             '--serve host:port\n'
+                             '--serve unix:/path/to/socket\n')
+    parser.add_argument('-b', '--build-index', nargs=1,
+                        help='Write all fingerprints to an index file for '
+                             'the mmap database\n'
+                             'Usage: \n'
+                             '--build-index /path/to/fingerprints.idx\n')
+    parser.add_argument('-m', '--migrate-schema', action='store_true',
+                        help='Add ingest leases to MySQL songs tables '
+                             'created by older versions and convert the '
+                             'fingerprints to the configured '
+                             'fingerprints_schema\n')
+    parser.add_argument('-l', '--build-stoplist', type=int,
+                        metavar='MIN_SONGS',
+                        help='List the hashes found in at least MIN_SONGS '
+                             'songs, which recognition then skips\n'
+                             'Usage: \n'
+                             '--build-stoplist 50\n')
     args = parser.parse_args()
 
-    if not args.fingerprint and not args.recognize:
+    if (not args.fingerprint and not args.recognize and not args.serve and
+            not args.build_index and not args.migrate_schema and
+            args.build_stoplist is None):
         print("No arguments")
         sys.exit(0)
 
@@ -88,4 +115,44 @@ if __name__ == '__main__':
             song = djv.recognize(FileRecognizer, opt_arg)
         print(song)
 
+    elif args.serve:
+        serve(djv, args.serve, path_root=djv.config.get("serve_path_root"))
+
+    elif args.build_index:
+        build_index(args.build_index[0], djv.db)
+        print("Wrote %d songs to %s"
+              % (djv.db.get_num_songs(), args.build_index[0]))
+
+    elif args.migrate_schema:
+        try:
+            if (hasattr(djv.db, "migrate_songs") and
+                    djv.db.migrate_songs()):
+                print("Added ingest leases to the songs table")
+            if not hasattr(djv.db, "migrate_fingerprints"):
+                raise NotImplementedError(
+                    "%s databases have a single fingerprints layout"
+                    % djv.db.type)
+            migrated = djv.db.migrate_fingerprints()
+        except NotImplementedError as err:
+            print(err)
+        except ValueError as err:
+            print(err)
+            sys.exit(1)
+        else:
+            if migrated:
+                print("Converted fingerprints to the %s layout"
+                      % djv.db.fingerprints_schema)
+            else:
+                print("Fingerprints already use the %s layout"
+                      % djv.db.fingerprints_schema)
+
+    elif args.build_stoplist is not None:
+        try:
+            count = djv.build_stoplist(args.build_stoplist)
+        except NotImplementedError:
+            print("%s databases cannot keep a stop-list" % djv.db.type)
+        else:
+            print("Listed %d hashes found in at least %d songs"
+                  % (count, args.build_stoplist))
+
     sys.exit(0)
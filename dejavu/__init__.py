@@ -1,8 +1,13 @@
-from dejavu.database import get_database
+from dejavu.align import OffsetHistogram
+from dejavu.cache import SongCache
+from dejavu.database import LeaseLostError, get_database
+from dejavu.leases import DEFAULT_LEASE_TTL, LeaseHeartbeat, default_owner
+from dejavu.workers import MODE_THREAD, WorkerPool
 import dejavu.decoder as decoder
 import fingerprint
 import multiprocessing
 import os
+import random
 import traceback
 import sys
 
@@ -15,6 +20,12 @@ class Dejavu(object):
     MATCH_TIME = 'match_time'
     OFFSET = 'offset'
     OFFSET_SECS = 'offset_seconds'
+    MARGIN = 'margin'
+    CANDIDATES = 'candidates'
+
+    # channels shorter than this are fingerprinted in the calling process,
+    # shipping them to a worker would cost more than it saves
+    POOL_MIN_SAMPLES = fingerprint.DEFAULT_FS * 20
 
     def __init__(self, config):
         super(Dejavu, self).__init__()
@@ -32,6 +43,58 @@ class Dejavu(object):
         self.limit = self.config.get("fingerprint_limit", None)
         if self.limit == -1:  # for JSON compatibility
             self.limit = None
+
+        # leases let several ingest hosts share one catalog without
+        # fingerprinting the same song twice
+        self.heartbeat = LeaseHeartbeat(
+            self.db,
+            self.config.get("ingest_owner", None) or default_owner(),
+            self.config.get("lease_ttl", DEFAULT_LEASE_TTL))
+
+        # song metadata used to resolve matches, kept in memory
+        self.song_cache = SongCache(
+            self.config.get("song_cache_size", 10000),
+            self.config.get("song_cache_ttl", 300))
+
+        # number of best guesses reported with every match
+        self.match_candidates = self.config.get("match_candidates", 3)
+
+        # let the database count aligned matches and only send back the
+        # `aggregate_limit` strongest (song, offset difference) pairs
+        self.aggregate_in_database = self.config.get(
+            "aggregate_in_database", False)
+        self.aggregate_limit = self.config.get("aggregate_limit", 100)
+
+        # skip hashes found in too many songs to tell them apart, as listed
+        # by `build_stoplist`
+        self.use_stoplist = self.config.get("use_stoplist", True)
+        self.stop_hashes = frozenset()
+        self.load_stoplist()
+
+        # incremental recognition: stop once the best song leads by
+        # `recognize_margin` aligned hashes or after `recognize_deadline`
+        # seconds, working through the clip in chunks of this many seconds
+        self.recognize_margin = self.config.get("recognize_margin", None)
+        self.recognize_deadline = self.config.get("recognize_deadline", None)
+        self.recognize_chunk_seconds = self.config.get(
+            "recognize_chunk_seconds", 2)
+
+        # optionally look for an indexed copy of every new song before
+        # storing its hashes; None|0 disables the check
+        self.dedupe_sample_size = self.config.get("dedupe_sample_size", None)
+        self.dedupe_min_ratio = self.config.get("dedupe_min_ratio", 0.2)
+
+        # number of fingerprinted songs written per database transaction
+        self.commit_every = max(self.config.get("commit_every", 1), 1)
+
+        # long-lived worker pool shared by ingest and recognition
+        self.workers = WorkerPool(self.config.get("worker_processes", None),
+                                  database=self.db,
+                                  mode=self.config.get("worker_mode", None))
+
+        # threads that wait on the database for the *_async methods
+        self.io_workers = WorkerPool(self.config.get("io_threads", 8),
+                                     mode=MODE_THREAD)
         self.get_fingerprinted_songs()
 
     def get_fingerprinted_songs(self):
@@ -42,17 +105,13 @@ class Dejavu(object):
         for song in self.songs:
             song_name = song[self.db.FIELD_SONGNAME]
             self.songnames_set.add(song_name)
+        # duplicates recorded as aliases count as fingerprinted too
+        for alias_name, _ in self.db.get_aliases():
+            self.songnames_set.add(alias_name)
 
     def fingerprint_directory(self, path, extensions, nprocesses=None):
-        # Try to use the maximum amount of processes if not given.
-        try:
-            nprocesses = nprocesses or multiprocessing.cpu_count()
-        except NotImplementedError:
-            nprocesses = 1
-        else:
-            nprocesses = 1 if nprocesses <= 0 else nprocesses
-
-        pool = multiprocessing.Pool(nprocesses)
+        if nprocesses:
+            self.workers.resize(nprocesses)
 
         filenames_to_fingerprint = []
         for filename, _ in decoder.find_files(path, extensions):
@@ -64,15 +123,37 @@ class Dejavu(object):
 
             filenames_to_fingerprint.append(filename)
 
+        # Claim songs a few batches at a time so that other hosts ingesting
+        # the same directory pick up the rest instead of waiting on us.
+        batch_size = self.workers.processes * 2
+
+        with self.heartbeat:
+            for start in xrange(0, len(filenames_to_fingerprint), batch_size):
+                claimed = {}
+                for filename in filenames_to_fingerprint[start:
+                                                         start + batch_size]:
+                    song_name = decoder.path_to_songname(filename)
+                    if song_name in claimed:
+                        continue
+                    sid = self._claim_song(song_name)
+                    if sid is not None:
+                        claimed[song_name] = (filename, sid)
+
+                self._fingerprint_claimed(claimed)
+
+    def _fingerprint_claimed(self, claimed):
         # Prepare _fingerprint_worker input
-        worker_input = zip(filenames_to_fingerprint,
-                           [self.limit] * len(filenames_to_fingerprint))
+        worker_input = [(filename, self.limit)
+                        for filename, _ in claimed.itervalues()]
+        sids = dict((song_name, sid)
+                    for song_name, (_, sid) in claimed.iteritems())
 
         # Send off our tasks
-        iterator = pool.imap_unordered(_fingerprint_worker,
-                                       worker_input)
+        iterator = self.workers.imap_unordered(_fingerprint_worker,
+                                               worker_input)
 
-        # Loop till we have all of them
+        # Loop till we have all of them, storing them a few at a time
+        stored = []
         while True:
             try:
                 song_name, hashes = iterator.next()
@@ -85,35 +166,268 @@ class Dejavu(object):
                 # Print traceback because we can't reraise it here
                 traceback.print_exc(file=sys.stdout)
             else:
-                sid = self.db.insert_song(song_name)
+                stored.append((sids.pop(song_name), song_name, hashes))
+                if len(stored) >= self.commit_every:
+                    self._store_songs(stored)
+                    stored = []
 
-                self.db.insert_hashes(sid, hashes)
-                self.db.set_song_fingerprinted(sid)
-                self.get_fingerprinted_songs()
+        self._store_songs(stored)
 
-        pool.close()
-        pool.join()
+        # whatever is left failed, let another ingest retry it
+        for sid in sids.itervalues():
+            self.db.release_song(sid, self.heartbeat.owner)
 
     def fingerprint_file(self, filepath, song_name=None):
+        self._fingerprint_file(filepath, song_name)
+
+    def fingerprint_file_async(self, filepath, song_name=None,
+                               callback=None):
+        """
+        Non-blocking `fingerprint_file`. Decoding and fingerprinting run on
+        the worker pool, the database writes on an I/O thread.
+
+        Returns an `AsyncResult`; `callback` is called from the I/O thread
+        once the song is stored.
+        """
+        return self.io_workers.apply_async(
+            self._fingerprint_file, (filepath, song_name, True),
+            callback=callback)
+
+    def _fingerprint_file(self, filepath, song_name=None, in_pool=False):
         songname = decoder.path_to_songname(filepath)
         song_name = song_name or songname
         # don't refingerprint already fingerprinted files
         if song_name in self.songnames_set:
             print "%s already fingerprinted, continuing..." % song_name
-        else:
-            song_name, hashes = _fingerprint_worker(filepath,
-                                                    self.limit,
-                                                    song_name=song_name)
+            return
+
+        with self.heartbeat:
+            sid = self._claim_song(song_name)
+            if sid is None:
+                return
 
-            sid = self.db.insert_song(song_name)
+            try:
+                args = (filepath, self.limit, song_name)
+                if in_pool:
+                    song_name, hashes = self.workers.apply_async(
+                        _fingerprint_worker, args).get()
+                else:
+                    song_name, hashes = _fingerprint_worker(*args)
+            except:
+                self.db.release_song(sid, self.heartbeat.owner)
+                raise
+
+            self._store_songs([(sid, song_name, hashes)])
+
+    def _claim_song(self, song_name):
+        sid = self.db.claim_song(song_name, self.heartbeat.owner,
+                                 self.heartbeat.ttl)
+        if sid is None:
+            print "%s fingerprinted or claimed elsewhere, continuing..." % (
+                song_name)
+        return sid
+
+    def _store_songs(self, songs):
+        """
+        Stores a batch of fingerprinted songs, given as (sid, song_name,
+        hashes) tuples, in one database transaction. The hashes of all new
+        songs are inserted together, so databases can bulk load them. If
+        the transaction fails the songs are released so another ingest can
+        retry them. Songs whose lease passed to another ingest meanwhile
+        are left to it, and so is the rest of their batch.
+        """
+        if not songs:
+            return
 
-            self.db.insert_hashes(sid, hashes)
-            self.db.set_song_fingerprinted(sid)
+        try:
+            with self.db.transaction():
+                new_songs = []
+                for sid, song_name, hashes in songs:
+                    if self._store_alias(sid, song_name, hashes):
+                        continue
+                    new_songs.append((sid, hashes))
+                    if self.dedupe_sample_size:
+                        # later songs of the batch are checked against it
+                        self._insert_songs(new_songs)
+                        new_songs = []
+                self._insert_songs(new_songs)
+        except LeaseLostError as err:
+            print "%s, releasing its batch..." % err
+            self._release_songs(songs)
+        except:
+            self._release_songs(songs)
+            raise
+        finally:
             self.get_fingerprinted_songs()
 
+    def _release_songs(self, songs):
+        for sid, _, _ in songs:
+            self.song_cache.invalidate(sid)
+            self.db.release_song(sid, self.heartbeat.owner)
+
+    def _store_alias(self, sid, song_name, hashes):
+        """
+        Records a song that duplicates an indexed one as an alias of it.
+        Returns whether it did.
+        """
+        duplicate_sid = self.find_duplicate(hashes, exclude_sid=sid)
+        if duplicate_sid is None:
+            return False
+
+        print "%s duplicates song %d, storing it as an alias..." % (
+            song_name, duplicate_sid)
+        self.db.insert_alias(song_name, duplicate_sid)
+        self.db.release_song(sid, self.heartbeat.owner)
+        self.song_cache.invalidate(sid)
+        return True
+
+    def _insert_songs(self, songs):
+        if not songs:
+            return
+        self.db.insert_many_hashes(songs)
+        for sid, _ in songs:
+            self.db.set_song_fingerprinted(sid, self.heartbeat.owner)
+            self.song_cache.invalidate(sid)
+
+    def get_song_by_id(self, sid):
+        """
+        Returns the song with ID `sid` from the song cache, falling back to
+        the database.
+        """
+        song = self.song_cache.get(sid)
+        if song is None:
+            song = self.song_cache.set(sid, self.db.get_song_by_id(sid))
+        return song
+
+    def delete_song(self, sid):
+        """
+        Removes a song and its fingerprints from the database.
+        """
+        self.db.delete_song(sid)
+        self.song_cache.invalidate(sid)
+        self.get_fingerprinted_songs()
+
+    def empty(self):
+        """
+        Removes all songs and fingerprints from the database.
+        """
+        self.db.empty()
+        self.song_cache.invalidate()
+        self.load_stoplist()
+        self.get_fingerprinted_songs()
+
+    def load_stoplist(self):
+        """
+        Reads the stop-list of the database, unless `use_stoplist` is off.
+        Call it to pick up a list rebuilt by another process.
+        """
+        if self.use_stoplist:
+            self.stop_hashes = frozenset(self.db.get_stop_hashes())
+
+    def build_stoplist(self, min_songs):
+        """
+        Lists every hash found in at least `min_songs` different songs so
+        recognition skips it, and returns the number of hashes listed.
+        """
+        count = self.db.build_stoplist(min_songs)
+        self.load_stoplist()
+        return count
+
+    def skip_stop_hashes(self, hashes):
+        """
+        Drops the (hash, offset) tuples whose hash is on the stop-list.
+        """
+        if not self.stop_hashes:
+            return hashes
+        return [(hash, offset) for hash, offset in hashes
+                if hash not in self.stop_hashes]
+
+    def find_duplicate(self, hashes, exclude_sid=None):
+        """
+        Matches a random sample of a new song's hashes against the index.
+
+        Returns the ID of the indexed song that aligns with at least
+        `dedupe_min_ratio` of the sample, or None if there is none or the
+        check is disabled.
+        """
+        if not self.dedupe_sample_size:
+            return None
+
+        hashes = list(self.skip_stop_hashes(hashes))
+        sample = random.sample(hashes, min(self.dedupe_sample_size,
+                                           len(hashes)))
+        if not sample:
+            return None
+
+        histogram = OffsetHistogram()
+        self.add_matches(histogram, sample)
+        match = self.resolve_alignment(histogram)
+        if (match and match[Dejavu.SONG_ID] != exclude_sid and
+                match[Dejavu.CONFIDENCE] >= self.dedupe_min_ratio * len(sample)):
+            return match[Dejavu.SONG_ID]
+        return None
+
+    def fingerprint_channels(self, channels, Fs=fingerprint.DEFAULT_FS):
+        """
+        Fingerprints every channel and returns a list with the hashes of
+        each one. Long channels are sent to the worker pool so they are
+        processed side by side, short ones are done in this process. With
+        thread workers there is nothing to ship, so every channel of a
+        multi-channel clip goes to the pool.
+        """
+        threaded = self.workers.threaded and len(channels) > 1
+        results = [None] * len(channels)
+        pending = []
+        for i, samples in enumerate(channels):
+            if threaded or len(samples) >= self.POOL_MIN_SAMPLES:
+                pending.append((i, self.workers.apply_async(
+                    _fingerprint_channel_worker, ((samples, Fs),))))
+            else:
+                results[i] = _fingerprint_channel_worker((samples, Fs))
+
+        for i, result in pending:
+            results[i] = result.get()
+        return results
+
+    def add_matches(self, histogram, hashes):
+        """
+        Looks up (hash, offset) tuples and counts their matches into an
+        `OffsetHistogram`, in the database when `aggregate_in_database` is
+        set. Hashes on the stop-list are not looked up.
+        """
+        hashes = self.skip_stop_hashes(hashes)
+        if self.aggregate_in_database:
+            histogram.add_counts(
+                self.db.top_alignments(hashes, self.aggregate_limit))
+        else:
+            histogram.add(self.db.return_matches(hashes))
+
     def find_matches(self, samples, Fs=fingerprint.DEFAULT_FS):
-        hashes = fingerprint.fingerprint(samples, Fs=Fs)
-        return self.db.return_matches(hashes)
+        hashes, = self.fingerprint_channels([samples], Fs=Fs)
+        return self.db.return_matches(self.skip_stop_hashes(hashes))
+
+    def find_matches_many(self, hash_lists):
+        """
+        Looks up several lists of (hash, offset) tuples with one database
+        lookup of all their distinct hashes, then hands every list its own
+        matches.
+
+        Returns one list of (sid, offset_difference) tuples per hash list.
+        """
+        hash_lists = [list(hashes) for hashes in hash_lists]
+
+        rows = {}
+        wanted = set(hash for hashes in hash_lists for hash, _ in hashes)
+        wanted -= self.stop_hashes
+        for hash, sid, db_offset in self.db.lookup_hashes(wanted):
+            rows.setdefault(hash, []).append((sid, db_offset))
+
+        results = []
+        for hashes in hash_lists:
+            results.append([(sid, db_offset - offset)
+                            for hash, offset in hashes
+                            for sid, db_offset in rows.get(hash, ())])
+        return results
 
     def align_matches(self, matches):
         """
@@ -123,49 +437,112 @@ class Dejavu(object):
             Returns a dictionary with match information.
         """
         # align by diffs
-        diff_counter = {}
-        largest = 0
-        largest_count = 0
-        song_id = -1
-        for tup in matches:
-            sid, diff = tup
-            if diff not in diff_counter:
-                diff_counter[diff] = {}
-            if sid not in diff_counter[diff]:
-                diff_counter[diff][sid] = 0
-            diff_counter[diff][sid] += 1
-
-            if diff_counter[diff][sid] > largest_count:
-                largest = diff
-                largest_count = diff_counter[diff][sid]
-                song_id = sid
-
-        # extract idenfication
-        song = self.db.get_song_by_id(song_id)
-        if song:
-            # TODO: Clarify what `get_song_by_id` should return.
-            songname = song.get(Dejavu.SONG_NAME, None)
-        else:
+        histogram = OffsetHistogram()
+        histogram.add(matches)
+        return self.resolve_alignment(histogram)
+
+    def resolve_alignment(self, histogram):
+        """
+        Turns the strongest songs of an `OffsetHistogram` into a match
+        dictionary for the best one. It also holds the `match_candidates`
+        best songs under `Dejavu.CANDIDATES` and how many more aligned
+        matches the best song has than the runner-up under `Dejavu.MARGIN`.
+
+        Returns None if nothing matched.
+        """
+        top = histogram.top(self.match_candidates)
+        if not top:
             return None
 
+        candidates = []
+        for sid, diff, count in top:
+            # extract idenfication
+            song = self.get_song_by_id(sid)
+            if song:
+                # TODO: Clarify what `get_song_by_id` should return.
+                songname = song.get(Dejavu.SONG_NAME, None)
+            elif not candidates:
+                return None
+            else:
+                continue
+            candidates.append(self._match_info(sid, songname, count, diff))
+
         # return match info
-        nseconds = round(float(largest) / fingerprint.DEFAULT_FS *
+        song = dict(candidates[0])
+        song[Dejavu.MARGIN] = top[0][2] - (top[1][2] if len(top) > 1 else 0)
+        song[Dejavu.CANDIDATES] = candidates
+        return song
+
+    def _match_info(self, sid, songname, count, diff):
+        nseconds = round(float(diff) / fingerprint.DEFAULT_FS *
                          fingerprint.DEFAULT_WINDOW_SIZE *
                          fingerprint.DEFAULT_OVERLAP_RATIO, 5)
-        song = {
-            Dejavu.SONG_ID: song_id,
+        return {
+            Dejavu.SONG_ID: sid,
             Dejavu.SONG_NAME: songname,
-            Dejavu.CONFIDENCE: largest_count,
-            Dejavu.OFFSET: largest,
+            Dejavu.CONFIDENCE: count,
+            Dejavu.OFFSET: diff,
             Dejavu.OFFSET_SECS: nseconds
         }
 
-        return song
-
     def recognize(self, recognizer, *options, **kwoptions):
         r = recognizer(self)
         return r.recognize(*options, **kwoptions)
 
+    def recognize_async(self, recognizer, *options, **kwoptions):
+        """
+        Non-blocking `recognize`. The recognizer runs on an I/O thread, so
+        only that thread waits on the database, and long channels are
+        fingerprinted by the worker pool.
+
+        Returns an `AsyncResult`. An optional `callback` keyword argument is
+        called with the match from the I/O thread when it is ready.
+        """
+        callback = kwoptions.pop("callback", None)
+        return self.io_workers.apply_async(
+            self.recognize, (recognizer,) + options, kwoptions,
+            callback=callback)
+
+    def recognize_many(self, sources, batch_size=100):
+        """
+        Recognizes many audio files at once.
+
+        The files are decoded and fingerprinted in parallel by the worker
+        pool and the hashes of every `batch_size` files are looked up in a
+        single `find_matches_many` call before being aligned file by file.
+
+        Returns a list with the match of every file in `sources`, in the
+        same order; None for files that did not match or failed to decode.
+        """
+        sources = list(sources)
+        results = []
+        for start in xrange(0, len(sources), batch_size):
+            batch = sources[start:start + batch_size]
+            clips = self.workers.map(_fingerprint_clip_worker,
+                                     [(filename, self.limit)
+                                      for filename in batch])
+
+            matches = iter(self.find_matches_many(
+                [hashes for clip in clips if clip for hashes in clip]))
+
+            for clip in clips:
+                if clip is None:
+                    results.append(None)
+                    continue
+                histogram = OffsetHistogram()
+                for _ in clip:
+                    histogram.add(next(matches))
+                results.append(self.resolve_alignment(histogram))
+        return results
+
+    def close(self):
+        """
+        Shuts down the worker pools and the database.
+        """
+        self.workers.close()
+        self.io_workers.close()
+        self.db.close()
+
 
 def _fingerprint_worker(filename, limit=None, song_name=None):
     # Pool.imap sends arguments as tuples so we have to unpack
@@ -198,6 +575,23 @@ def _fingerprint_worker(filename, limit=None, song_name=None):
     return song_name, result
 
 
+def _fingerprint_channel_worker(args):
+    samples, Fs = args
+    return list(fingerprint.fingerprint(samples, Fs=Fs))
+
+
+def _fingerprint_clip_worker(args):
+    filename, limit = args
+    try:
+        channels, Fs = decoder.read(filename, limit)
+        return [_fingerprint_channel_worker((channel, Fs))
+                for channel in channels]
+    except Exception:
+        print("Failed fingerprinting %s" % filename)
+        traceback.print_exc(file=sys.stdout)
+        return None
+
+
 def chunkify(lst, n):
     """
     Splits a list into roughly n equal parts.
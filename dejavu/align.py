@@ -0,0 +1,122 @@
+from itertools import chain
+import numpy as np
+
+# (song_id, offset difference) pairs are packed into a single int64 so they
+# can be sorted and counted in one go; differences are shifted to be
+# non-negative first.
+DIFF_BITS = 32
+DIFF_SHIFT = 1 << (DIFF_BITS - 1)
+DIFF_MASK = (1 << DIFF_BITS) - 1
+
+
+def pack(sids, diffs):
+    return (sids.astype(np.int64) << DIFF_BITS) | (diffs + DIFF_SHIFT)
+
+
+def unpack(keys):
+    return keys >> DIFF_BITS, (keys & DIFF_MASK) - DIFF_SHIFT
+
+
+def count_keys(keys, weights=None):
+    """
+    Returns the sorted unique `keys` and how often each one occurs, or the
+    sum of its `weights` when given.
+    """
+    if not len(keys):
+        return keys, np.zeros(0, dtype=np.int64)
+
+    order = np.argsort(keys, kind="mergesort")
+    keys = keys[order]
+    starts = np.concatenate(([0], np.flatnonzero(keys[1:] != keys[:-1]) + 1))
+
+    if weights is None:
+        counts = np.diff(np.append(starts, len(keys)))
+    else:
+        counts = np.add.reduceat(weights[order], starts)
+    return keys[starts], counts.astype(np.int64)
+
+
+class OffsetHistogram(object):
+    """
+    Counts how many hash matches agree on each (song_id, offset difference)
+    pair. The pair with the most votes tells which song is playing and where
+    in the song the sample starts.
+
+    ```python
+    histogram = OffsetHistogram()
+    histogram.add(db.return_matches(hashes))
+    for sid, diff, count in histogram.top(3):
+        ...
+    ```
+    """
+
+    def __init__(self):
+        super(OffsetHistogram, self).__init__()
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, matches):
+        """
+        Adds a sequence of (sid, offset_difference) tuples.
+        """
+        matches = np.fromiter(chain.from_iterable(matches), dtype=np.int64)
+        if not len(matches):
+            return
+        matches = matches.reshape(-1, 2)
+        keys, counts = count_keys(pack(matches[:, 0], matches[:, 1]))
+        self._merge(keys, counts)
+
+    def add_counts(self, alignments):
+        """
+        Adds (sid, offset_difference, count) tuples that were already
+        counted elsewhere, e.g. by the database.
+        """
+        alignments = np.fromiter(chain.from_iterable(alignments),
+                                 dtype=np.int64)
+        if not len(alignments):
+            return
+        alignments = alignments.reshape(-1, 3)
+        keys, counts = count_keys(pack(alignments[:, 0], alignments[:, 1]),
+                                  alignments[:, 2])
+        self._merge(keys, counts)
+
+    def _merge(self, keys, counts):
+        if len(self.keys):
+            keys, counts = count_keys(np.concatenate((self.keys, keys)),
+                                      np.concatenate((self.counts, counts)))
+        self.keys, self.counts = keys, counts
+
+    def items(self, k=None):
+        """
+        Returns up to `k` (sid, offset_difference, count) tuples, strongest
+        first, with any number of offset differences per song.
+        """
+        order = np.argsort(-self.counts, kind="mergesort")[:k]
+        sids, diffs = unpack(self.keys[order])
+        return zip(sids.tolist(), diffs.tolist(),
+                   self.counts[order].tolist())
+
+    def top(self, k=1):
+        """
+        Returns up to `k` (sid, offset_difference, count) tuples, one per
+        song, ordered by count. Each song is represented by its best
+        aligned offset difference.
+        """
+        if not len(self.keys):
+            return []
+
+        sids, diffs = unpack(self.keys)
+
+        # best offset difference of every song
+        order = np.lexsort((-self.counts, sids))
+        firsts = np.concatenate(
+            ([True], sids[order][1:] != sids[order][:-1]))
+        best = order[firsts]
+
+        # strongest songs first, ties go to the lower song id
+        best = best[np.lexsort((sids[best], -self.counts[best]))][:k]
+        return zip(sids[best].tolist(), diffs[best].tolist(),
+                   self.counts[best].tolist())
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class SongCache(object):
+    """
+    A thread safe LRU cache with a time to live, used to keep song metadata
+    close at hand while recognizing.
+
+    ```python
+    cache = SongCache(maxsize=1024, ttl=300)
+    song = cache.get(sid)
+    if song is None:
+        song = cache.set(sid, db.get_song_by_id(sid))
+    ```
+
+    Entries older than `ttl` seconds are treated as missing, which bounds
+    how long a change made by another process can go unnoticed. A `ttl` of
+    None keeps entries until they are evicted or invalidated.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        super(SongCache, self).__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires < time.time():
+                return None
+            # re-insert to mark as most recently used
+            self._entries[key] = (value, expires)
+            return value
+
+    def set(self, key, value):
+        if value is None or self.maxsize <= 0:
+            return value
+
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key=None):
+        """
+        Drops `key` from the cache, or everything when no key is given.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
@@ -1,5 +1,17 @@
 from __future__ import absolute_import
+from contextlib import contextmanager
 import abc
+import importlib
+
+from dejavu.align import OffsetHistogram
+
+
+class LeaseLostError(Exception):
+    """
+    Raised when the lease on a song passed to another ingest process
+    before the song was stored.
+    """
+    pass
 
 
 class Database(object):
@@ -26,6 +38,22 @@ class Database(object):
         """
         pass
 
+    def close(self):
+        """
+        Releases background threads and other resources of the database.
+        """
+        pass
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups the writes made inside the block so they are committed
+        together, or not at all if the block raises.
+
+        Databases without transactions simply run the block.
+        """
+        yield
+
     def setup(self):
         """
         Called on creation or shortly afterwards.
@@ -62,11 +90,14 @@ class Database(object):
         pass
 
     @abc.abstractmethod
-    def set_song_fingerprinted(self, sid):
+    def set_song_fingerprinted(self, sid, owner=None):
         """
         Sets a specific song as having all fingerprints in the database.
 
-        sid: Song identifier
+          sid: Song identifier
+        owner: Ingest process that claimed the song, see `claim_song`.
+               Raises `LeaseLostError` if the song is leased by another
+               owner by now.
         """
         pass
 
@@ -86,6 +117,47 @@ class Database(object):
         """
         pass
 
+    def delete_song(self, sid):
+        """
+        Removes a song and all fingerprints associated with it.
+
+        sid: Song identifier
+        """
+        raise NotImplementedError("Deleting single songs is not supported.")
+
+    def get_aliases(self):
+        """
+        Returns all (alias_name, sid) pairs, names under which a duplicate
+        of an indexed song was ingested.
+        """
+        return []
+
+    def insert_alias(self, alias_name, sid):
+        """
+        Records a song name as an alias of an indexed song instead of
+        storing its fingerprints a second time.
+
+        alias_name: The name of the duplicate song.
+               sid: Song identifier of the song it duplicates
+        """
+        raise NotImplementedError("Song aliases are not supported.")
+
+    def get_stop_hashes(self):
+        """
+        Returns the hashes on the stop-list, in hexadecimal format.
+        """
+        return []
+
+    def build_stoplist(self, min_songs):
+        """
+        Replaces the stop-list with every hash found in at least
+        `min_songs` different songs. Such hashes match too many songs to
+        tell them apart, so recognition skips them. Returns the number of
+        hashes listed.
+        """
+        raise NotImplementedError(
+            "%s cannot keep a stop-list" % type(self).__name__)
+
     @abc.abstractmethod
     def insert(self, hash, sid, offset):
         """
@@ -107,6 +179,38 @@ class Database(object):
         """
         pass
 
+    def claim_song(self, song_name, owner, ttl):
+        """
+        Claims the right to fingerprint a song and returns its new
+        identifier, or None if the song is already fingerprinted or another
+        owner holds a live lease on it.
+
+        Databases that cannot coordinate several ingest hosts simply insert
+        the song.
+
+        song_name: The name of the song.
+            owner: Identifier of the ingest process claiming the song
+              ttl: Seconds the claim stays valid without being renewed
+        """
+        return self.insert_song(song_name)
+
+    def renew_leases(self, owner, ttl):
+        """
+        Keeps all claims held by `owner` alive for another `ttl` seconds.
+        """
+        pass
+
+    def release_song(self, sid, owner=None):
+        """
+        Gives up the claim on a song that could not be fingerprinted.
+        Returns whether the song was removed; it is kept if it got
+        fingerprinted or leased by another owner meanwhile.
+
+          sid: Song identifier
+        owner: Ingest process that claimed the song
+        """
+        return False
+
     @abc.abstractmethod
     def query(self, hash):
         """
@@ -124,6 +228,15 @@ class Database(object):
         """
         pass
 
+    def iter_fingerprints(self):
+        """
+        Returns all fingerprints in the database as (hash, sid, offset)
+        tuples, with hashes in hexadecimal format. Used to bulk load other
+        databases.
+        """
+        raise NotImplementedError(
+            "%s cannot export its fingerprints" % type(self).__name__)
+
     @abc.abstractmethod
     def insert_hashes(self, sid, hashes):
         """
@@ -136,6 +249,27 @@ class Database(object):
         """
         pass
 
+    def insert_many_hashes(self, songs):
+        """
+        Inserts the fingerprints of several songs, given as (sid, hashes)
+        pairs. Databases that load faster in large batches override this.
+        """
+        for sid, hashes in songs:
+            self.insert_hashes(sid, hashes)
+
+    def lookup_hashes(self, hashes):
+        """
+        Returns all fingerprints whose hash is one of `hashes`.
+
+        hashes: A collection of hashes, in hexadecimal format
+
+        Returns a sequence of (hash, sid, offset) tuples, with `hash` given
+        exactly as it was passed in.
+        """
+        for hash in set(hashes):
+            for sid, offset in self.query(hash):
+                yield (hash, sid, offset)
+
     @abc.abstractmethod
     def return_matches(self, hashes):
         """
@@ -152,6 +286,31 @@ class Database(object):
         """
         pass
 
+    def top_alignments(self, hashes, limit):
+        """
+        Counts the matches of `hashes` per (sid, offset_difference) pair
+        and returns the `limit` strongest pairs as (sid, offset_difference,
+        count) tuples, strongest first.
+
+        Databases that cannot aggregate themselves count the result of
+        `return_matches`.
+        """
+        histogram = OffsetHistogram()
+        histogram.add(self.return_matches(hashes))
+        return histogram.items(limit)
+
+
+# modules of the bundled database handlers, only imported once selected so
+# each one's client library is only needed when it is used
+DATABASE_MODULES = {
+    "mysql": "dejavu.database_sql",
+    "sqlite": "dejavu.database_sqlite",
+    "memory": "dejavu.database_memory",
+    "mmap": "dejavu.database_mmap",
+    "segments": "dejavu.database_segments",
+    "sharded": "dejavu.database_sharded",
+}
+
 
 def get_database(database_type=None):
     # Default to using the mysql database
@@ -159,12 +318,11 @@ def get_database(database_type=None):
     # Lower all the input.
     database_type = database_type.lower()
 
+    if database_type in DATABASE_MODULES:
+        importlib.import_module(DATABASE_MODULES[database_type])
+
     for db_cls in Database.__subclasses__():
         if db_cls.type == database_type:
             return db_cls
 
     raise TypeError("Unsupported database type supplied.")
-
-
-# Import our default database handler
-import dejavu.database_sql
@@ -0,0 +1,347 @@
+from __future__ import absolute_import
+from binascii import unhexlify
+from contextlib import contextmanager
+import threading
+
+import numpy as np
+
+from dejavu.database import Database, get_database
+
+# fingerprints are FINGERPRINT_REDUCTION hex characters, i.e. 10 bytes
+HASH_DTYPE = "S10"
+
+
+def hash_keys(hashes):
+    """
+    Converts hexadecimal hashes into an array of fixed size byte strings,
+    which sort the same way as the binary hashes stored by MySQL.
+    """
+    return np.array([unhexlify(hash) for hash in hashes], dtype=HASH_DTYPE)
+
+
+class MemoryDatabase(Database):
+    """
+    Keeps all fingerprints in RAM as an inverted index: a sorted array of
+    hash keys with the song_id and offset of every posting alongside.
+    Lookups are vectorized binary searches, so recognition never waits on
+    a database round trip.
+
+    With a `source` the index is bulk loaded from another database when
+    `setup` runs, and songs and fingerprints added through this instance
+    are written through to it as well:
+
+    ```python
+    config = {
+        "database_type": "memory",
+        "database": {
+            "source_type": "mysql",
+            "source": {"host": "127.0.0.1", "user": "root", "db": "dejavu"},
+        },
+    }
+    ```
+
+    Without a source the index only lives as long as the process.
+
+    Fingerprints written inside a `transaction` only reach the index, and
+    songs only turn fingerprinted, once it commits, so a rolled back batch
+    leaves no postings behind.
+    """
+
+    type = "memory"
+
+    FIELD_SONG_ID = "song_id"
+    FIELD_SONGNAME = "song_name"
+    FIELD_FINGERPRINTED = "fingerprinted"
+
+    # postings read from the source per chunk while loading
+    LOAD_CHUNK_SIZE = 1000000
+
+    def __init__(self, source=None, source_type=None):
+        super(MemoryDatabase, self).__init__()
+        self.source = None
+        if source is not None:
+            self.source = get_database(source_type)(**source)
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._clear()
+
+    def _clear(self):
+        self.songs = {}
+        self.aliases = {}
+        self._next_sid = 1
+        self._index = (np.zeros(0, dtype=HASH_DTYPE),
+                       np.zeros(0, dtype=np.int64),
+                       np.zeros(0, dtype=np.int64))
+        self._pending = []
+
+    def before_fork(self):
+        if self.source is not None:
+            self.source.before_fork()
+
+    def after_fork(self):
+        if self.source is not None:
+            self.source.after_fork()
+
+    def setup(self):
+        """
+        Loads songs, aliases and fingerprints from the source database.
+        """
+        if self.source is None:
+            return
+
+        self.source.setup()
+        with self._lock:
+            self._clear()
+            for song in self.source.get_songs():
+                self._add_song(song[self.source.FIELD_SONG_ID],
+                               song[self.source.FIELD_SONGNAME], True)
+            for alias_name, sid in self.source.get_aliases():
+                self.aliases[alias_name] = sid
+
+            chunk = []
+            for row in self.source.iter_fingerprints():
+                chunk.append(row)
+                if len(chunk) >= self.LOAD_CHUNK_SIZE:
+                    self._pending.append(self._postings(chunk))
+                    chunk = []
+            if chunk:
+                self._pending.append(self._postings(chunk))
+
+        self._merge()
+
+    def _postings(self, rows):
+        hashes, sids, offsets = zip(*rows)
+        return (hash_keys(hashes), np.array(sids, dtype=np.int64),
+                np.array(offsets, dtype=np.int64))
+
+    def _merge(self):
+        """
+        Folds the postings added since the last lookup into the sorted
+        index.
+        """
+        with self._lock:
+            if not self._pending:
+                return self._index
+
+            keys, sids, offsets = [np.concatenate(columns) for columns in
+                                   zip(self._index, *self._pending)]
+            order = np.argsort(keys, kind="mergesort")
+            self._index = (keys[order], sids[order], offsets[order])
+            self._pending = []
+            return self._index
+
+    def _add_song(self, sid, song_name, fingerprinted=False):
+        self.songs[sid] = {
+            self.FIELD_SONG_ID: sid,
+            self.FIELD_SONGNAME: song_name,
+            self.FIELD_FINGERPRINTED: fingerprinted,
+        }
+        self._next_sid = max(self._next_sid, sid + 1)
+
+    def empty(self):
+        if self.source is not None:
+            self.source.empty()
+        with self._lock:
+            self._clear()
+
+    def delete_unfingerprinted_songs(self):
+        if self.source is not None:
+            self.source.delete_unfingerprinted_songs()
+        with self._lock:
+            for sid, song in self.songs.items():
+                if not song[self.FIELD_FINGERPRINTED]:
+                    del self.songs[sid]
+
+    def delete_song(self, sid):
+        if self.source is not None:
+            self.source.delete_song(sid)
+
+        self._drop_postings(sid)
+        with self._lock:
+            self.songs.pop(sid, None)
+            for alias_name, alias_sid in self.aliases.items():
+                if alias_sid == sid:
+                    del self.aliases[alias_name]
+
+    def _drop_postings(self, sid):
+        # right away, the source may hand the song id out again
+        keys, sids, offsets = self._merge()
+        with self._lock:
+            keep = sids != sid
+            self._index = (keys[keep], sids[keep], offsets[keep])
+
+    def get_num_songs(self):
+        return sum(1 for song in self.songs.itervalues()
+                   if song[self.FIELD_FINGERPRINTED])
+
+    def get_num_fingerprints(self):
+        return len(self._merge()[0])
+
+    def set_song_fingerprinted(self, sid, owner=None):
+        if self.source is not None:
+            self.source.set_song_fingerprinted(sid, owner)
+        self._write(sid, fingerprinted=True)
+
+    def get_songs(self):
+        for song in self.songs.values():
+            if song[self.FIELD_FINGERPRINTED]:
+                yield {self.FIELD_SONG_ID: song[self.FIELD_SONG_ID],
+                       self.FIELD_SONGNAME: song[self.FIELD_SONGNAME]}
+
+    def get_song_by_id(self, sid):
+        song = self.songs.get(sid)
+        if song is None:
+            return None
+        return {self.FIELD_SONGNAME: song[self.FIELD_SONGNAME]}
+
+    def get_aliases(self):
+        return self.aliases.items()
+
+    def insert_alias(self, alias_name, sid):
+        if self.source is not None:
+            self.source.insert_alias(alias_name, sid)
+        self.aliases[alias_name] = sid
+
+    def insert(self, hash, sid, offset):
+        self.insert_hashes(sid, [(hash, offset)])
+
+    def insert_song(self, song_name):
+        sid = None
+        if self.source is not None:
+            sid = self.source.insert_song(song_name)
+        with self._lock:
+            if sid is None:
+                sid = self._next_sid
+            self._add_song(sid, song_name)
+        return sid
+
+    def claim_song(self, song_name, owner, ttl):
+        if self.source is None:
+            return self.insert_song(song_name)
+
+        sid = self.source.claim_song(song_name, owner, ttl)
+        if sid is not None:
+            with self._lock:
+                self._add_song(sid, song_name)
+        return sid
+
+    def renew_leases(self, owner, ttl):
+        if self.source is not None:
+            self.source.renew_leases(owner, ttl)
+
+    def release_song(self, sid, owner=None):
+        if self.source is not None and not self.source.release_song(sid,
+                                                                    owner):
+            return False
+        with self._lock:
+            song = self.songs.get(sid)
+            if song is None or song[self.FIELD_FINGERPRINTED]:
+                return False
+            del self.songs[sid]
+        self._drop_postings(sid)
+        return True
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the block in a transaction of the source, if any, and
+        publishes the fingerprints and songs written inside it once it
+        commits. On an error they are dropped.
+        """
+        local = self._local
+        outermost = not getattr(local, "depth", 0)
+        if outermost:
+            local.depth, local.writes = 0, []
+        local.depth += 1
+        try:
+            if self.source is not None:
+                with self.source.transaction():
+                    yield
+            else:
+                yield
+        except:
+            if outermost:
+                local.writes = []
+            raise
+        finally:
+            local.depth -= 1
+
+        if outermost:
+            writes, local.writes = local.writes, []
+            self._publish(writes)
+
+    def _write(self, sid, postings=None, fingerprinted=False):
+        """
+        Publishes new postings of a song, or the song being fingerprinted,
+        right away or once the enclosing transaction commits.
+        """
+        if getattr(self._local, "depth", 0):
+            self._local.writes.append((sid, postings, fingerprinted))
+        else:
+            self._publish([(sid, postings, fingerprinted)])
+
+    def _publish(self, writes):
+        with self._lock:
+            for sid, postings, fingerprinted in writes:
+                if postings is not None:
+                    self._pending.append(postings)
+                if fingerprinted and sid in self.songs:
+                    self.songs[sid][self.FIELD_FINGERPRINTED] = True
+
+    def query(self, hash):
+        for _, sid, offset in self.lookup_hashes([hash]):
+            yield (sid, offset)
+
+    def get_iterable_kv_pairs(self):
+        _, sids, offsets = self._merge()
+        return zip(sids.tolist(), offsets.tolist())
+
+    def iter_fingerprints(self):
+        keys, sids, offsets = self._merge()
+        for key, sid, offset in zip(keys, sids.tolist(), offsets.tolist()):
+            yield (key.ljust(10, "\0").encode("hex"), sid, offset)
+
+    def insert_hashes(self, sid, hashes):
+        hashes = list(hashes)
+        if not hashes:
+            return
+        if self.source is not None:
+            self.source.insert_hashes(sid, hashes)
+        self._write(sid, postings=self._postings(
+            [(hash, sid, offset) for hash, offset in hashes]))
+
+    def _find(self, keys):
+        """
+        Returns, for the postings matching `keys`, the index of the key they
+        matched, their song ids and their offsets.
+        """
+        index_keys, sids, offsets = self._merge()
+        starts = np.searchsorted(index_keys, keys, side="left")
+        counts = np.searchsorted(index_keys, keys, side="right") - starts
+
+        total = counts.sum()
+        which = np.repeat(np.arange(len(keys)), counts)
+        # position of every posting within the run of its key
+        within = np.arange(total) - np.repeat(np.cumsum(counts) - counts,
+                                              counts)
+        postings = starts[which] + within
+        return which, sids[postings], offsets[postings]
+
+    def lookup_hashes(self, hashes):
+        hashes = list(set(hashes))
+        if not hashes:
+            return []
+        which, sids, offsets = self._find(hash_keys(hashes))
+        return ((hashes[i], sid, offset) for i, sid, offset in
+                zip(which.tolist(), sids.tolist(), offsets.tolist()))
+
+    def return_matches(self, hashes):
+        hashes = list(hashes)
+        if not hashes:
+            return []
+        which, sids, offsets = self._find(hash_keys(h for h, _ in hashes))
+        query_offsets = np.array([offset for _, offset in hashes],
+                                 dtype=np.int64)
+        diffs = offsets - query_offsets[which]
+        return zip(sids.tolist(), diffs.tolist())
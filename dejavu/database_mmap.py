@@ -0,0 +1,131 @@
+from __future__ import absolute_import
+import threading
+
+import numpy as np
+
+from dejavu.database import Database
+from dejavu.database_memory import hash_keys
+from dejavu.index import IndexFile
+
+
+class MmapDatabase(Database):
+    """
+    Serves recognition from an immutable index file (see `dejavu.index`)
+    mapped into memory. Every process opening the same file shares its
+    pages, so a host can run many recognition workers on one copy of the
+    index.
+
+    The database is read-only. Build the file from the database you ingest
+    into, and point recognition nodes at it:
+
+    ```
+    $ python dejavu.py --config ingest.cnf --build-index fingerprints.idx
+    ```
+
+    ```python
+    config = {
+        "database_type": "mmap",
+        "database": {"path": "fingerprints.idx"},
+    }
+    ```
+
+    A rebuilt file replaces the old one atomically; call `reload` (or
+    `setup`) to switch to it.
+    """
+
+    type = "mmap"
+
+    FIELD_SONG_ID = "song_id"
+    FIELD_SONGNAME = "song_name"
+
+    def __init__(self, path="fingerprints.idx"):
+        super(MmapDatabase, self).__init__()
+        self.path = path
+        self._lock = threading.Lock()
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self.reload()
+        return self._index
+
+    def reload(self):
+        """
+        Opens the index file again, picking up a rebuilt one.
+        """
+        index = IndexFile(self.path)
+        with self._lock:
+            # readers still using the old index keep their own reference
+            self._index = index
+
+    def setup(self):
+        self.reload()
+
+    def _read_only(self, *args):
+        raise NotImplementedError(
+            "%s is a read-only index, rebuild it with build_index"
+            % self.path)
+
+    empty = insert = insert_song = insert_hashes = _read_only
+    set_song_fingerprinted = delete_song = insert_alias = _read_only
+
+    def delete_unfingerprinted_songs(self):
+        # an index only ever holds fingerprinted songs
+        pass
+
+    def get_num_songs(self):
+        return len(self.index.songs)
+
+    def get_num_fingerprints(self):
+        return len(self.index)
+
+    def get_songs(self):
+        for sid, song_name in self.index.songs:
+            yield {self.FIELD_SONG_ID: sid, self.FIELD_SONGNAME: song_name}
+
+    def get_song_by_id(self, sid):
+        song_name = self.index.song_names.get(sid)
+        if song_name is None:
+            return None
+        return {self.FIELD_SONGNAME: song_name}
+
+    def get_aliases(self):
+        return list(self.index.aliases)
+
+    def query(self, hash):
+        for _, sid, offset in self.lookup_hashes([hash]):
+            yield (sid, offset)
+
+    def get_iterable_kv_pairs(self):
+        for _, sid, offset in self.index:
+            yield (sid, offset)
+
+    def iter_fingerprints(self):
+        return iter(self.index)
+
+    def lookup_hashes(self, hashes):
+        hashes = list(set(hashes))
+        if not hashes:
+            return []
+        which, sids, offsets = self.index.lookup(hash_keys(hashes))
+        return ((hashes[i], sid, offset) for i, sid, offset in
+                zip(which.tolist(), sids.tolist(), offsets.tolist()))
+
+    def return_matches(self, hashes):
+        hashes = list(hashes)
+        if not hashes:
+            return []
+        which, sids, offsets = self.index.lookup(
+            hash_keys(hash for hash, _ in hashes))
+        query_offsets = np.array([offset for _, offset in hashes],
+                                 dtype=np.int64)
+        return zip(sids.tolist(), (offsets - query_offsets[which]).tolist())
+
+    def __getstate__(self):
+        return (self.path,)
+
+    def __setstate__(self, state):
+        self.path, = state
+        self._lock = threading.Lock()
+        self._index = None
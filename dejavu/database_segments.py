@@ -0,0 +1,591 @@
+from __future__ import absolute_import
+from contextlib import contextmanager
+import fcntl
+import json
+import math
+import os
+import threading
+
+import numpy as np
+
+from dejavu.database import Database
+from dejavu.database_memory import hash_keys
+from dejavu.index import IndexFile, fsync_directory, write_index
+
+
+class SegmentDatabase(Database):
+    """
+    A local, log-structured fingerprint store for write heavy ingest.
+
+    Fingerprints are buffered in memory and written out as immutable,
+    sorted segment files in the index format of `dejavu.index`; nothing is
+    ever updated in place, so the cost of storing a song does not grow with
+    the catalog. Lookups search every segment. A background thread merges
+    segments of similar size once `merge_factor` of them pile up, which
+    keeps the number of segments logarithmic in the catalog size and
+    drops the fingerprints of deleted songs.
+
+    Songs, aliases and the list of live segments are kept in a
+    `catalog.json` next to the segments. Every change is appended to a
+    log, and the catalog is only rewritten, replacing the log, once the
+    log outgrows it, so a change costs the same however many songs are
+    stored. A song only becomes visible as fingerprinted once the segment
+    holding its fingerprints is listed there.
+
+    ```python
+    config = {
+        "database_type": "segments",
+        "database": {"directory": "/var/lib/dejavu/segments"},
+    }
+    ```
+
+    Opening a directory only reads it. The first write takes an
+    exclusive lock on it, so only one process may write to a directory at
+    a time; that process also removes what an interrupted writer left
+    behind and merges the segments. Other processes keep serving lookups
+    from the catalog they read at setup.
+    """
+
+    type = "segments"
+
+    FIELD_SONG_ID = "song_id"
+    FIELD_SONGNAME = "song_name"
+
+    CATALOG_FILENAME = "catalog.json"
+    LOG_FILENAME = "catalog-%d.log"
+    LOCK_FILENAME = "writer.lock"
+    SEGMENT_FILENAME = "segment-%012d.idx"
+
+    # changes logged before the catalog is rewritten, at least
+    MIN_LOG_SIZE = 1000
+
+    def __init__(self, directory="segments", flush_size=1000000,
+                 merge_factor=4, compact_interval=10):
+        super(SegmentDatabase, self).__init__()
+        self.directory = directory
+        self.flush_size = int(flush_size)
+        self.merge_factor = int(merge_factor)
+        if self.merge_factor < 2:
+            raise ValueError("merge_factor must be at least 2, not %d"
+                             % self.merge_factor)
+        self.compact_interval = float(compact_interval)
+        self._init_state()
+
+    def _init_state(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._compacting = threading.Lock()
+        self._compactor = None
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._songs = {}
+        self._aliases = {}
+        self._deleted = set()
+        self._segments = []
+        self._next_sid = 1
+        self._next_segment = 1
+        self._generation = 0
+        self._log = None
+        self._log_size = 0
+        self._log_limit = self.MIN_LOG_SIZE
+        self._lock_file = None
+
+    # catalog
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _load_catalog(self):
+        try:
+            with open(self._path(self.CATALOG_FILENAME)) as f:
+                catalog = json.load(f)
+        except IOError:
+            catalog = {}
+
+        self._songs = dict((int(sid), (song_name, fingerprinted))
+                           for sid, song_name, fingerprinted
+                           in catalog.get("songs", []))
+        self._aliases = dict(catalog.get("aliases", []))
+        self._deleted = set(catalog.get("deleted", []))
+        self._next_sid = catalog.get("next_sid", 1)
+        self._next_segment = catalog.get("next_segment", 1)
+        self._generation = catalog.get("log", 0)
+        names = list(catalog.get("segments", []))
+
+        try:
+            with open(self._path(self.LOG_FILENAME % self._generation)) as f:
+                for line in f:
+                    try:
+                        change = json.loads(line)
+                    except ValueError:
+                        # cut short by a crash, nothing follows it
+                        break
+                    self._apply(change, names)
+        except IOError:
+            pass
+
+        self._segments = [IndexFile(self._path(name)) for name in names]
+
+    def _apply(self, change, names=None):
+        """
+        Applies a logged change to the catalog. When replaying the log,
+        `names` stands in for the live segments; otherwise the caller
+        updates the segments itself.
+        """
+        kind, args = change[0], change[1:]
+        if kind == "song":
+            sid, song_name = args
+            self._songs[sid] = (song_name, False)
+            self._next_sid = max(self._next_sid, sid + 1)
+        elif kind == "flush":
+            name, sids, next_segment = args
+            if name is not None and names is not None:
+                names.append(name)
+            for sid in sids:
+                if sid in self._songs:
+                    self._songs[sid] = (self._songs[sid][0], True)
+            self._next_segment = max(self._next_segment, next_segment)
+        elif kind == "alias":
+            alias_name, sid = args
+            self._aliases[alias_name] = sid
+        elif kind == "delete":
+            sid, = args
+            self._songs.pop(sid, None)
+            for alias_name, alias_sid in self._aliases.items():
+                if alias_sid == sid:
+                    del self._aliases[alias_name]
+            self._deleted.add(sid)
+        elif kind == "merge":
+            merged, created, purged, next_segment = args
+            if names is not None:
+                position = names.index(merged[0])
+                names[:] = [name for name in names if name not in merged]
+                names[position:position] = created
+            self._deleted -= set(purged)
+            self._next_segment = max(self._next_segment, next_segment)
+        elif kind == "empty":
+            if names is not None:
+                del names[:]
+            self._songs, self._aliases, self._deleted = {}, {}, set()
+
+    def _log_change(self, *change):
+        """
+        Applies a change to the catalog and appends it to the log. Must be
+        called with the lock held, after updating the segments.
+        """
+        self._apply(list(change))
+
+        self._log.write(json.dumps(change) + "\n")
+        self._log.flush()
+        # the songs of a flush are only kept once it is logged, and that
+        # sync writes out the song entries before it as well
+        if change[0] != "song":
+            os.fsync(self._log.fileno())
+        self._log_size += 1
+        if self._log_size >= self._log_limit:
+            self._save_catalog()
+
+    def _save_catalog(self):
+        """
+        Writes the whole catalog and starts a new, empty log.
+        """
+        generation = self._generation + 1
+        catalog = {
+            "songs": [(sid, song_name, fingerprinted) for sid,
+                      (song_name, fingerprinted) in self._songs.iteritems()],
+            "aliases": self._aliases.items(),
+            "deleted": sorted(self._deleted),
+            "next_sid": self._next_sid,
+            "next_segment": self._next_segment,
+            "segments": [os.path.basename(segment.path)
+                         for segment in self._segments],
+            "log": generation,
+        }
+        log = open(self._path(self.LOG_FILENAME % generation), "w")
+        path = self._path(self.CATALOG_FILENAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump(catalog, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + ".tmp", path)
+        fsync_directory(path)
+
+        if self._log is not None:
+            self._log.close()
+        old_log = self._path(self.LOG_FILENAME % self._generation)
+        if os.path.exists(old_log):
+            os.remove(old_log)
+        self._log, self._log_size = log, 0
+        self._generation = generation
+        # as long as the catalog itself, so its writes stay a constant
+        # share of the changes
+        self._log_limit = max(self.MIN_LOG_SIZE, len(self._songs))
+
+    def _writer(self):
+        """
+        Makes this process the writer of the directory, on its first
+        write. Raises IOError if another process writes to it.
+        """
+        with self._lock:
+            if self._lock_file is not None:
+                return
+
+            lock_file = open(self._path(self.LOCK_FILENAME), "a")
+            try:
+                fcntl.flock(lock_file.fileno(),
+                            fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lock_file.close()
+                raise IOError("%s is written to by another process"
+                              % self.directory)
+            self._lock_file = lock_file
+
+            # the previous writer may have changed the catalog since setup
+            self._load_catalog()
+            self._save_catalog()
+
+            # segments and logs not in the catalog are left over from an
+            # interrupted flush, merge or catalog write
+            live = set(os.path.basename(segment.path)
+                       for segment in self._segments)
+            live.add(os.path.basename(self._log.name))
+            for name in os.listdir(self.directory):
+                if (name.startswith(("segment-", "catalog-")) and
+                        name not in live):
+                    os.remove(self._path(name))
+
+            for sid, (_, fingerprinted) in self._songs.items():
+                if not fingerprinted:
+                    self._log_change("delete", sid)
+
+        if self._compactor is None and self.compact_interval > 0:
+            self._compactor = threading.Thread(target=self._compact_forever)
+            self._compactor.daemon = True
+            self._compactor.start()
+
+    def _new_segment_path(self):
+        with self._lock:
+            number = self._next_segment
+            self._next_segment += 1
+        return self._path(self.SEGMENT_FILENAME % number)
+
+    def setup(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        with self._lock:
+            self._load_catalog()
+
+    def after_fork(self):
+        # the compaction thread does not survive the fork, and writing
+        # stays with the parent
+        self._compactor = None
+        self._log = self._lock_file = None
+
+    # write buffer
+
+    def _buffer(self):
+        local = self._local
+        if not hasattr(local, "postings"):
+            local.postings = []
+            local.size = 0
+            local.ready = []
+            local.depth = 0
+        return local
+
+    @contextmanager
+    def transaction(self):
+        """
+        Buffers the writes of the calling thread and flushes them as one
+        segment when the block is left. On an error the buffered
+        fingerprints are discarded.
+        """
+        local = self._buffer()
+        local.depth += 1
+        try:
+            yield
+        except:
+            local.depth -= 1
+            if not local.depth:
+                local.postings, local.size, local.ready = [], 0, []
+            raise
+        local.depth -= 1
+        if not local.depth:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the fingerprints buffered by the calling thread to a new
+        segment, then marks the songs completed since the last flush as
+        fingerprinted.
+        """
+        local = self._buffer()
+        postings, ready = local.postings, local.ready
+        local.postings, local.size, local.ready = [], 0, []
+        if not postings and not ready:
+            return
+        self._writer()
+
+        segment = name = None
+        if postings:
+            keys, sids, offsets = [np.concatenate(columns)
+                                   for columns in zip(*postings)]
+            path = self._new_segment_path()
+            write_index(path, keys, sids, offsets)
+            segment = IndexFile(path)
+            name = os.path.basename(path)
+
+        with self._lock:
+            if segment is not None:
+                self._segments.append(segment)
+            self._log_change("flush", name, ready, self._next_segment)
+
+        if segment is not None:
+            self._wakeup.set()
+
+    def insert_hashes(self, sid, hashes):
+        hashes = list(hashes)
+        if not hashes:
+            return
+
+        local = self._buffer()
+        local.postings.append((
+            hash_keys(hash for hash, _ in hashes),
+            np.repeat(np.int64(sid), len(hashes)),
+            np.array([offset for _, offset in hashes], dtype=np.int64)))
+        local.size += len(hashes)
+        if local.size >= self.flush_size:
+            # the song only turns fingerprinted with the final flush
+            ready, local.ready = local.ready, []
+            self.flush()
+            local.ready = ready
+
+    def insert(self, hash, sid, offset):
+        self.insert_hashes(sid, [(hash, offset)])
+
+    def set_song_fingerprinted(self, sid, owner=None):
+        local = self._buffer()
+        local.ready.append(sid)
+        if not local.depth:
+            self.flush()
+
+    # compaction
+
+    def _compact_forever(self):
+        # runs after every flush, and every `compact_interval` seconds
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.compact_interval)
+            self._wakeup.clear()
+            try:
+                while not self._stopped.is_set() and self.compact():
+                    pass
+            except Exception:
+                # retried on the next tick
+                pass
+
+    def close(self):
+        """
+        Stops the background compaction and gives up writing to the
+        directory.
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+
+        with self._lock:
+            if self._lock_file is not None:
+                self._log.close()
+                self._lock_file.close()
+                self._log = self._lock_file = None
+
+    def _tier(self, segment):
+        return int(math.log(max(len(segment), 1), self.merge_factor))
+
+    def compact(self, full=False):
+        """
+        Merges `merge_factor` segments of the same size tier into one, or
+        every segment when `full` is set. Returns whether anything was
+        merged.
+        """
+        self._writer()
+        with self._compacting:
+            with self._lock:
+                segments = list(self._segments)
+                deleted = set(self._deleted)
+
+            if full:
+                merging = segments if len(segments) > 1 or deleted else []
+            else:
+                tiers = {}
+                for segment in segments:
+                    tiers.setdefault(self._tier(segment), []).append(segment)
+                merging = []
+                for tier in sorted(tiers):
+                    if len(tiers[tier]) >= self.merge_factor:
+                        merging = tiers[tier][:self.merge_factor]
+                        break
+            if not merging:
+                return False
+
+            keys, sids, offsets = [np.concatenate(columns) for columns in
+                                   zip(*[segment.postings()
+                                         for segment in merging])]
+            if deleted:
+                keep = ~np.in1d(sids, list(deleted))
+                keys, sids, offsets = keys[keep], sids[keep], offsets[keep]
+
+            merged = []
+            if len(keys):
+                path = self._new_segment_path()
+                write_index(path, keys, sids, offsets)
+                merged.append(IndexFile(path))
+
+            with self._lock:
+                position = self._segments.index(merging[0])
+                self._segments = [segment for segment in self._segments
+                                  if segment not in merging]
+                self._segments[position:position] = merged
+                purged = []
+                if len(merging) == len(segments):
+                    # no segment holds fingerprints of these songs anymore
+                    purged = sorted(deleted)
+                self._log_change(
+                    "merge", [os.path.basename(s.path) for s in merging],
+                    [os.path.basename(s.path) for s in merged], purged,
+                    self._next_segment)
+
+            # readers still holding the old segments keep them mapped
+            for segment in merging:
+                os.remove(segment.path)
+            return True
+
+    # songs
+
+    def empty(self):
+        self._writer()
+        with self._lock:
+            for segment in self._segments:
+                os.remove(segment.path)
+            self._segments = []
+            self._log_change("empty")
+
+    def delete_unfingerprinted_songs(self):
+        self._writer()
+        with self._lock:
+            for sid, (_, fingerprinted) in self._songs.items():
+                if not fingerprinted:
+                    self._log_change("delete", sid)
+
+    def delete_song(self, sid):
+        self._writer()
+        with self._lock:
+            self._log_change("delete", sid)
+
+    def release_song(self, sid, owner=None):
+        with self._lock:
+            song = self._songs.get(sid)
+            if song is None or song[1]:
+                return False
+            self.delete_song(sid)
+            return True
+
+    def get_num_songs(self):
+        return sum(1 for _, fingerprinted in self._songs.itervalues()
+                   if fingerprinted)
+
+    def get_num_fingerprints(self):
+        return sum(len(segment) for segment in list(self._segments))
+
+    def get_songs(self):
+        for sid, (song_name, fingerprinted) in self._songs.items():
+            if fingerprinted:
+                yield {self.FIELD_SONG_ID: sid, self.FIELD_SONGNAME: song_name}
+
+    def get_song_by_id(self, sid):
+        song = self._songs.get(sid)
+        if song is None:
+            return None
+        return {self.FIELD_SONGNAME: song[0]}
+
+    def get_aliases(self):
+        return self._aliases.items()
+
+    def insert_alias(self, alias_name, sid):
+        self._writer()
+        with self._lock:
+            self._log_change("alias", alias_name, sid)
+
+    def insert_song(self, song_name):
+        self._writer()
+        with self._lock:
+            sid = self._next_sid
+            self._log_change("song", sid, song_name)
+        return sid
+
+    # lookups
+
+    def _find(self, keys):
+        """
+        Searches every segment for `keys`. Returns the index of the key
+        every posting matched, its song id and offset.
+        """
+        with self._lock:
+            segments = list(self._segments)
+            deleted = list(self._deleted)
+
+        found = [segment.lookup(keys) for segment in segments]
+        if not found:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+
+        which, sids, offsets = [np.concatenate(columns)
+                                for columns in zip(*found)]
+        if deleted:
+            keep = ~np.in1d(sids, deleted)
+            which, sids, offsets = which[keep], sids[keep], offsets[keep]
+        return which, sids, offsets
+
+    def query(self, hash):
+        for _, sid, offset in self.lookup_hashes([hash]):
+            yield (sid, offset)
+
+    def get_iterable_kv_pairs(self):
+        for _, sid, offset in self.iter_fingerprints():
+            yield (sid, offset)
+
+    def iter_fingerprints(self):
+        with self._lock:
+            segments = list(self._segments)
+            deleted = set(self._deleted)
+        for segment in segments:
+            for hash, sid, offset in segment:
+                if sid not in deleted:
+                    yield (hash, sid, offset)
+
+    def lookup_hashes(self, hashes):
+        hashes = list(set(hashes))
+        if not hashes:
+            return []
+        which, sids, offsets = self._find(hash_keys(hashes))
+        return ((hashes[i], sid, offset) for i, sid, offset in
+                zip(which.tolist(), sids.tolist(), offsets.tolist()))
+
+    def return_matches(self, hashes):
+        hashes = list(hashes)
+        if not hashes:
+            return []
+        which, sids, offsets = self._find(hash_keys(h for h, _ in hashes))
+        query_offsets = np.array([offset for _, offset in hashes],
+                                 dtype=np.int64)
+        return zip(sids.tolist(), (offsets - query_offsets[which]).tolist())
+
+    def __getstate__(self):
+        return (self.directory, self.flush_size, self.merge_factor,
+                self.compact_interval)
+
+    def __setstate__(self, state):
+        (self.directory, self.flush_size, self.merge_factor,
+         self.compact_interval) = state
+        self._init_state()
@@ -0,0 +1,286 @@
+from __future__ import absolute_import
+from contextlib import contextmanager
+from itertools import chain
+from multiprocessing.pool import ThreadPool
+import threading
+
+from dejavu.database import Database, get_database
+
+
+def first(pair):
+    return pair[0]
+
+
+def shard_for(hash, count):
+    """
+    Returns which of `count` shards holds a hash. Shards own contiguous
+    ranges of hash prefixes, so hash ordered writes stay ordered per shard.
+    """
+    return int(hash[:8], 16) * count >> 32
+
+
+@contextmanager
+def transactions(databases):
+    """
+    Nests the transactions of several databases, the first one outermost
+    so it commits last.
+    """
+    if not databases:
+        yield
+        return
+    with databases[0].transaction():
+        with transactions(databases[1:]):
+            yield
+
+
+class ShardedDatabase(Database):
+    """
+    Spreads the fingerprints over several databases by hash prefix, while
+    songs, aliases and ingest leases stay on a single primary database.
+    Ingest writes every fingerprint to the shard owning its hash, and
+    recognition queries all shards side by side, one thread per shard.
+
+    ```python
+    config = {
+        "database_type": "sharded",
+        "database": {
+            "primary_type": "mysql",
+            "primary": {"host": "db0", "user": "root", "db": "dejavu"},
+            "shards": [
+                {"host": "db1", "user": "root", "db": "dejavu"},
+                {"host": "db2", "user": "root", "db": "dejavu"},
+            ],
+        },
+    }
+    ```
+
+    Shards are of `shard_type` (default: `primary_type`), `mysql` or
+    `sqlite`, and are opened with `fingerprints_only` so they do not keep
+    songs of their own. Several SQLite files stand in for servers when
+    trying it out locally.
+
+    The number of shards decides where every hash lives, so it cannot be
+    changed without re-ingesting. Writes commit on the shards before the
+    primary, so a song is only marked fingerprinted once all its
+    fingerprints are stored; the fingerprints of a song whose primary
+    commit fails are removed again when it is released.
+    """
+
+    type = "sharded"
+
+    FIELD_SONG_ID = "song_id"
+    FIELD_SONGNAME = "song_name"
+
+    def __init__(self, primary=None, shards=(), primary_type=None,
+                 shard_type=None):
+        super(ShardedDatabase, self).__init__()
+        if not shards:
+            raise ValueError("a sharded database needs at least one shard")
+
+        self._options = (primary, shards, primary_type, shard_type)
+        self.primary = get_database(primary_type)(**(primary or {}))
+        shard_cls = get_database(shard_type or primary_type)
+        self.shards = [shard_cls(fingerprints_only=True, **options)
+                       for options in shards]
+        self._init_state()
+
+    def _init_state(self):
+        self._workers = None
+        self._workers_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def databases(self):
+        return [self.primary] + self.shards
+
+    def _group(self, items, key=lambda item: item):
+        """
+        Splits items between the shards, returns a list per shard.
+        """
+        groups = [[] for _ in self.shards]
+        for item in items:
+            groups[shard_for(key(item), len(self.shards))].append(item)
+        return groups
+
+    def _fan_out(self, method, groups):
+        """
+        Calls `method` of every shard with its group, one thread per shard,
+        and returns the results as lists. Inside a transaction the calls
+        run in the calling thread, which holds the open transactions.
+        """
+        calls = [(shard, group) for shard, group in zip(self.shards, groups)
+                 if group]
+
+        def call(args):
+            shard, group = args
+            return list(getattr(shard, method)(group))
+
+        if len(calls) <= 1 or getattr(self._local, "depth", 0):
+            return map(call, calls)
+
+        with self._workers_lock:
+            if self._workers is None:
+                self._workers = ThreadPool(len(self.shards))
+        return self._workers.map(call, calls)
+
+    def before_fork(self):
+        for db in self.databases:
+            db.before_fork()
+
+    def after_fork(self):
+        for db in self.databases:
+            db.after_fork()
+        # threads and their locks do not survive a fork
+        self._workers = None
+        self._workers_lock = threading.Lock()
+
+    def close(self):
+        with self._workers_lock:
+            if self._workers is not None:
+                self._workers.close()
+                self._workers = None
+        for db in self.databases:
+            db.close()
+
+    @contextmanager
+    def transaction(self):
+        local = self._local
+        local.depth = getattr(local, "depth", 0) + 1
+        try:
+            with transactions(self.databases):
+                yield
+        finally:
+            local.depth -= 1
+
+    def setup(self):
+        for db in self.databases:
+            db.setup()
+
+    def empty(self):
+        for db in self.databases:
+            db.empty()
+
+    @property
+    def fingerprints_schema(self):
+        return self.shards[0].fingerprints_schema
+
+    def migrate_fingerprints(self):
+        """
+        Converts the fingerprints of every shard to its `fingerprints_schema`.
+        Returns False if all of them already had that layout.
+        """
+        if not all(hasattr(shard, "migrate_fingerprints")
+                   for shard in self.shards):
+            raise NotImplementedError(
+                "%s shards have a single fingerprints layout"
+                % self.shards[0].type)
+        # one shard at a time, a rebuild keeps its server busy
+        return any([shard.migrate_fingerprints() for shard in self.shards])
+
+    def migrate_songs(self):
+        if not hasattr(self.primary, "migrate_songs"):
+            return False
+        return self.primary.migrate_songs()
+
+    def delete_unfingerprinted_songs(self):
+        self.primary.delete_unfingerprinted_songs()
+
+    def delete_song(self, sid):
+        for shard in self.shards:
+            shard.delete_song(sid)
+        self.primary.delete_song(sid)
+
+    def get_num_songs(self):
+        return self.primary.get_num_songs()
+
+    def get_num_fingerprints(self):
+        return sum(shard.get_num_fingerprints() for shard in self.shards)
+
+    def set_song_fingerprinted(self, sid, owner=None):
+        self.primary.set_song_fingerprinted(sid, owner)
+
+    def get_songs(self):
+        return self.primary.get_songs()
+
+    def get_song_by_id(self, sid):
+        return self.primary.get_song_by_id(sid)
+
+    def get_aliases(self):
+        return self.primary.get_aliases()
+
+    def insert_alias(self, alias_name, sid):
+        self.primary.insert_alias(alias_name, sid)
+
+    def get_stop_hashes(self):
+        return list(chain.from_iterable(shard.get_stop_hashes()
+                                        for shard in self.shards))
+
+    def build_stoplist(self, min_songs):
+        # every hash lives on one shard, which sees all of its songs
+        return sum(shard.build_stoplist(min_songs) for shard in self.shards)
+
+    def insert_song(self, song_name):
+        return self.primary.insert_song(song_name)
+
+    def claim_song(self, song_name, owner, ttl):
+        return self.primary.claim_song(song_name, owner, ttl)
+
+    def renew_leases(self, owner, ttl):
+        self.primary.renew_leases(owner, ttl)
+
+    def release_song(self, sid, owner=None):
+        # the primary keeps the leases, a song taken over by another owner
+        # keeps its fingerprints
+        if not self.primary.release_song(sid, owner):
+            return False
+        for shard in self.shards:
+            shard.release_song(sid)
+        return True
+
+    def insert(self, hash, sid, offset):
+        self.shards[shard_for(hash, len(self.shards))].insert(
+            hash, sid, offset)
+
+    def query(self, hash):
+        return self.shards[shard_for(hash, len(self.shards))].query(hash)
+
+    def get_iterable_kv_pairs(self):
+        return chain.from_iterable(shard.get_iterable_kv_pairs()
+                                   for shard in self.shards)
+
+    def iter_fingerprints(self):
+        return chain.from_iterable(shard.iter_fingerprints()
+                                   for shard in self.shards)
+
+    def insert_hashes(self, sid, hashes):
+        self.insert_many_hashes([(sid, hashes)])
+
+    def insert_many_hashes(self, songs):
+        """
+        Writes the fingerprints of every song to the shards owning their
+        hashes, in the calling thread so they join its transaction.
+        """
+        groups = [[] for _ in self.shards]
+        for sid, hashes in songs:
+            for shard, shard_hashes in enumerate(
+                    self._group(hashes, key=first)):
+                if shard_hashes:
+                    groups[shard].append((sid, shard_hashes))
+
+        for shard, shard_songs in zip(self.shards, groups):
+            if shard_songs:
+                shard.insert_many_hashes(shard_songs)
+
+    def lookup_hashes(self, hashes):
+        return chain.from_iterable(
+            self._fan_out("lookup_hashes", self._group(set(hashes))))
+
+    def return_matches(self, hashes):
+        return chain.from_iterable(self._fan_out(
+            "return_matches", self._group(hashes, key=first)))
+
+    def __getstate__(self):
+        return self._options
+
+    def __setstate__(self, state):
+        self.__init__(*state)
@@ -3,13 +3,23 @@
 # and working with forum data
 
 from __future__ import absolute_import
+from binascii import unhexlify
+from contextlib import contextmanager
+from functools import partial
 from itertools import izip_longest
-import Queue
+from multiprocessing.pool import ThreadPool
+import logging
+import os
+import tempfile
+import threading
+import time
 
 import MySQLdb as mysql
-from MySQLdb.cursors import DictCursor
+from MySQLdb.cursors import DictCursor, SSCursor
+import numpy as np
 
-from dejavu.database import Database
+from dejavu.database import Database, LeaseLostError
+from dejavu.index import decode_varints, encode_varints, expand_ranges
 
 
 class SQLDatabase(Database):
@@ -66,9 +76,29 @@ class SQLDatabase(Database):
 
     type = "mysql"
 
+    # query pairs sent per multi-row insert when matching
+    QUERY_BATCH_SIZE = 10000
+
+    # fingerprint rows sent per multi-row insert when ingesting
+    INSERT_BATCH_SIZE = 10000
+
+    # values of the fingerprints_schema option
+    FINGERPRINTS_SCHEMAS = ("indexed", "clustered", "postings")
+
+    # default connection options of replicas, in seconds, so reads fail
+    # over from a replica that hangs; the options of a replica override them
+    REPLICA_TIMEOUTS = {"connect_timeout": 5, "pool_wait_timeout": 10}
+    if getattr(mysql, "version_info", (0,)) >= (1, 3):
+        # only mysqlclient knows read_timeout
+        REPLICA_TIMEOUTS["read_timeout"] = 30
+
     # tables
     FINGERPRINTS_TABLENAME = "fingerprints"
+    POSTINGS_TABLENAME = "fingerprint_postings"
     SONGS_TABLENAME = "songs"
+    ALIASES_TABLENAME = "song_aliases"
+    STOPLIST_TABLENAME = "stop_hashes"
+    QUERY_TABLENAME = "query_hashes"
     MATCH_DATA_TABLENAME = "match_data"
     FORUM_POSTS_TABLENAME = "forum_posts"
     COMMENTS_TABLENAME = "comments"
@@ -78,8 +108,13 @@ class SQLDatabase(Database):
     FIELD_HASH = "hash"
     FIELD_SONG_ID = "song_id"
     FIELD_OFFSET = "offset"
+    FIELD_POSTINGS = "postings"
     FIELD_SONGNAME = "song_name"
     FIELD_FINGERPRINTED = "fingerprinted"
+    FIELD_LEASE_OWNER = "lease_owner"
+    FIELD_LEASE_EXPIRES = "lease_expires"
+    FIELD_ALIAS = "alias_name"
+    FIELD_NUM_SONGS = "num_songs"
     FIELD_MATCH_ENTRY_ID = "matchEntryID"
     FIELD_MATCHID = "matchID"
     FIELD_UID = "userID"
@@ -105,8 +140,10 @@ class SQLDatabase(Database):
     FIELD_DESCRIPTION = "insectDesc"
 
     # creates
+    # the fingerprints tables are named when created, so migrations can
+    # fill a new table before swapping it in
     CREATE_FINGERPRINTS_TABLE = """
-        CREATE TABLE IF NOT EXISTS `%s` (
+        CREATE TABLE IF NOT EXISTS `%%s` (
              `%s` binary(10) not null,
              `%s` mediumint unsigned not null,
              `%s` int unsigned not null,
@@ -114,23 +151,143 @@ class SQLDatabase(Database):
          UNIQUE KEY `unique_constraint` (%s, %s, %s),
          FOREIGN KEY (%s) REFERENCES %s(%s) ON DELETE CASCADE
     ) ENGINE=INNODB;""" % (
-        FINGERPRINTS_TABLENAME, FIELD_HASH,
+        FIELD_HASH,
+        FIELD_SONG_ID, FIELD_OFFSET, FIELD_HASH,
         FIELD_SONG_ID, FIELD_OFFSET, FIELD_HASH,
+        FIELD_SONG_ID, SONGS_TABLENAME, FIELD_SONG_ID
+    )
+
+    # Same table clustered on the hash: InnoDB stores rows in primary key
+    # order, so all rows of a hash are adjacent and a lookup is one range
+    # scan instead of an index probe plus a random row read per match.
+    CREATE_CLUSTERED_FINGERPRINTS_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%%s` (
+             `%s` binary(10) not null,
+             `%s` mediumint unsigned not null,
+             `%s` int unsigned not null,
+         PRIMARY KEY (%s, %s, %s),
+         INDEX (%s),
+         FOREIGN KEY (%s) REFERENCES %s(%s) ON DELETE CASCADE
+    ) ENGINE=INNODB;""" % (
+        FIELD_HASH,
         FIELD_SONG_ID, FIELD_OFFSET, FIELD_HASH,
+        FIELD_SONG_ID, FIELD_OFFSET, FIELD_SONG_ID,
         FIELD_SONG_ID, SONGS_TABLENAME, FIELD_SONG_ID
     )
 
+    # fingerprints tables of databases that only hold fingerprints, like
+    # the shards of a sharded database, whose songs live elsewhere
+    CREATE_UNLINKED_FINGERPRINTS_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%%s` (
+             `%s` binary(10) not null,
+             `%s` mediumint unsigned not null,
+             `%s` int unsigned not null,
+         INDEX (%s),
+         INDEX (%s),
+         UNIQUE KEY `unique_constraint` (%s, %s, %s)
+    ) ENGINE=INNODB;""" % (
+        FIELD_HASH,
+        FIELD_SONG_ID, FIELD_OFFSET, FIELD_HASH, FIELD_SONG_ID,
+        FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET
+    )
+
+    CREATE_UNLINKED_CLUSTERED_FINGERPRINTS_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%%s` (
+             `%s` binary(10) not null,
+             `%s` mediumint unsigned not null,
+             `%s` int unsigned not null,
+         PRIMARY KEY (%s, %s, %s),
+         INDEX (%s)
+    ) ENGINE=INNODB;""" % (
+        FIELD_HASH,
+        FIELD_SONG_ID, FIELD_OFFSET, FIELD_HASH,
+        FIELD_SONG_ID, FIELD_OFFSET, FIELD_SONG_ID
+    )
+
+    # One row per hash with the (song_id, offset) pairs of all its
+    # fingerprints packed into a blob, see `pack_postings`. The table name
+    # is left open so migrations can fill a new table before swapping it in.
+    CREATE_POSTINGS_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%%s` (
+            `%s` binary(10) not null,
+            `%s` mediumblob not null,
+        PRIMARY KEY (`%s`)
+    ) ENGINE=INNODB;""" % (FIELD_HASH, FIELD_POSTINGS, FIELD_HASH)
+
     CREATE_SONGS_TABLE = """
         CREATE TABLE IF NOT EXISTS `%s` (
             `%s` mediumint unsigned not null auto_increment,
             `%s` varchar(250) not null,
             `%s` tinyint default 0,
+            `%s` varchar(128) default null,
+            `%s` datetime default null,
         PRIMARY KEY (`%s`),
+        UNIQUE KEY `%s` (`%s`),
         UNIQUE KEY `%s` (`%s`)
     ) ENGINE=INNODB;""" % (
         SONGS_TABLENAME, FIELD_SONG_ID, FIELD_SONGNAME,
-        FIELD_FINGERPRINTED, FIELD_SONG_ID,
-        FIELD_SONG_ID, FIELD_SONG_ID,
+        FIELD_FINGERPRINTED, FIELD_LEASE_OWNER, FIELD_LEASE_EXPIRES,
+        FIELD_SONG_ID, FIELD_SONG_ID, FIELD_SONG_ID,
+        FIELD_SONGNAME, FIELD_SONGNAME,
+    )
+
+    # holds the (hash, offset) pairs of one clip while it is matched, one
+    # per connection
+    CREATE_QUERY_TABLE = """
+        CREATE TEMPORARY TABLE IF NOT EXISTS `%s` (
+            `%s` binary(10) not null,
+            `%s` int not null,
+        INDEX USING HASH (`%s`)
+    ) ENGINE=MEMORY;""" % (
+        QUERY_TABLENAME, FIELD_HASH, FIELD_OFFSET, FIELD_HASH
+    )
+
+    # songs tables created before ingest leases existed lack these
+    ALTER_SONGS_ADD_LEASES = """
+        ALTER TABLE `%s`
+            ADD COLUMN `%s` varchar(128) default null,
+            ADD COLUMN `%s` datetime default null,
+            ADD UNIQUE KEY `%s` (`%s`);
+    """ % (SONGS_TABLENAME, FIELD_LEASE_OWNER, FIELD_LEASE_EXPIRES,
+           FIELD_SONGNAME, FIELD_SONGNAME)
+
+    # switch an existing fingerprints table between the two layouts, the
+    # server rebuilds the table in the new order
+    ALTER_FINGERPRINTS_CLUSTERED = """
+        ALTER TABLE `%s`
+            ADD PRIMARY KEY (`%s`, `%s`, `%s`),
+            DROP INDEX `unique_constraint`,
+            DROP INDEX `%s`;
+    """ % (FINGERPRINTS_TABLENAME, FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET,
+           FIELD_HASH)
+
+    ALTER_FINGERPRINTS_INDEXED = """
+        ALTER TABLE `%s`
+            DROP PRIMARY KEY,
+            ADD INDEX (`%s`),
+            ADD UNIQUE KEY `unique_constraint` (`%s`, `%s`, `%s`);
+    """ % (FINGERPRINTS_TABLENAME, FIELD_HASH, FIELD_HASH, FIELD_SONG_ID,
+           FIELD_OFFSET)
+
+    CREATE_ALIASES_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+            `%s` varchar(250) not null,
+            `%s` mediumint unsigned not null,
+        PRIMARY KEY (`%s`),
+        FOREIGN KEY (`%s`) REFERENCES %s(`%s`) ON DELETE CASCADE
+    ) ENGINE=INNODB;""" % (
+        ALIASES_TABLENAME, FIELD_ALIAS, FIELD_SONG_ID, FIELD_ALIAS,
+        FIELD_SONG_ID, SONGS_TABLENAME, FIELD_SONG_ID
+    )
+
+    # hashes found in so many songs that recognition skips them
+    CREATE_STOPLIST_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+            `%s` binary(10) not null,
+            `%s` int unsigned not null,
+        PRIMARY KEY (`%s`)
+    ) ENGINE=INNODB;""" % (
+        STOPLIST_TABLENAME, FIELD_HASH, FIELD_NUM_SONGS, FIELD_HASH
     )
 
     CREATE_MATCH_DATA_TABLE = """
@@ -212,6 +369,44 @@ class SQLDatabase(Database):
             (UNHEX(%%s), %%s, %%s);
     """ % (FINGERPRINTS_TABLENAME, FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET)
 
+    # multi-row form, followed by one FINGERPRINT_VALUES per row
+    INSERT_FINGERPRINTS = """
+        INSERT IGNORE INTO `%%s` (%s, %s, %s) values
+    """ % (FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET)
+
+    FINGERPRINT_VALUES = "(UNHEX(%s), %s, %s)"
+
+    # loads a tab separated file of hex hash, song_id, offset lines
+    LOAD_FINGERPRINTS = """
+        LOAD DATA LOCAL INFILE %%s IGNORE INTO TABLE %s
+        FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n'
+            (@hash, %s, %s) SET %s = UNHEX(@hash);
+    """ % (FINGERPRINTS_TABLENAME, FIELD_SONG_ID, FIELD_OFFSET, FIELD_HASH)
+
+    # multi-row form, followed by one POSTINGS_VALUES per hash and
+    # UPDATE_POSTINGS, which appends to the postings of stored hashes
+    INSERT_POSTINGS = """
+        INSERT INTO `%%s` (%s, %s) values
+    """ % (FIELD_HASH, FIELD_POSTINGS)
+
+    POSTINGS_VALUES = "(UNHEX(%s), _binary %s)"
+
+    UPDATE_POSTINGS = """
+        ON DUPLICATE KEY UPDATE %s = CONCAT(%s, VALUES(%s));
+    """ % (FIELD_POSTINGS, FIELD_POSTINGS, FIELD_POSTINGS)
+
+    INSERT_QUERY_HASH = """
+        INSERT INTO %s (%s, %s) values (%%s, %%s);
+    """ % (QUERY_TABLENAME, FIELD_HASH, FIELD_OFFSET)
+
+    INSERT_ALIAS = """
+        INSERT IGNORE INTO %s (%s, %s) values (%%s, %%s);
+    """ % (ALIASES_TABLENAME, FIELD_ALIAS, FIELD_SONG_ID)
+
+    INSERT_STOP_HASH = """
+        INSERT INTO %s (%s, %s) values (UNHEX(%%s), %%s);
+    """ % (STOPLIST_TABLENAME, FIELD_HASH, FIELD_NUM_SONGS)
+
     INSERT_MATCH = """
         INSERT INTO %s (%s, %s, %s, %s, %s, %s, %s, %s) values
             (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s);
@@ -222,6 +417,23 @@ class SQLDatabase(Database):
     INSERT_SONG = "INSERT INTO %s (%s) values (%%s);" % (
         SONGS_TABLENAME, FIELD_SONGNAME)
 
+    # Claims a song for an owner. An existing row is only taken over when
+    # it is unfinished and its lease ran out; the row stays locked until
+    # commit so two hosts can never both win the same song.
+    INSERT_SONG_LEASE = """
+        INSERT INTO %s (%s, %s, %s) values
+            (%%s, %%s, NOW() + INTERVAL %%s SECOND)
+        ON DUPLICATE KEY UPDATE
+            %s = IF(%s = 0 AND (%s IS NULL OR %s < NOW()),
+                    VALUES(%s), %s),
+            %s = IF(%s = VALUES(%s), VALUES(%s), %s);
+    """ % (SONGS_TABLENAME, FIELD_SONGNAME, FIELD_LEASE_OWNER,
+           FIELD_LEASE_EXPIRES,
+           FIELD_LEASE_OWNER, FIELD_FINGERPRINTED, FIELD_LEASE_EXPIRES,
+           FIELD_LEASE_EXPIRES, FIELD_LEASE_OWNER, FIELD_LEASE_OWNER,
+           FIELD_LEASE_EXPIRES, FIELD_LEASE_OWNER, FIELD_LEASE_OWNER,
+           FIELD_LEASE_EXPIRES, FIELD_LEASE_EXPIRES)
+
     INSERT_POST = """
         INSERT INTO %s (%s, %s, %s, %s, %s, %s, %s, %s, %s) values
             (%%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s, %%s);
@@ -253,10 +465,46 @@ class SQLDatabase(Database):
     """ % (FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET,
            FINGERPRINTS_TABLENAME, FIELD_HASH)
 
+    SELECT_POSTINGS = """
+        SELECT HEX(%s), %s FROM %s WHERE %s IN (%%s);
+    """ % (FIELD_HASH, FIELD_POSTINGS, POSTINGS_TABLENAME, FIELD_HASH)
+
+    SELECT_POSTINGS_FOR_UPDATE = """
+        SELECT HEX(%s), %s FROM %s WHERE %s IN (%%s) FOR UPDATE;
+    """ % (FIELD_HASH, FIELD_POSTINGS, POSTINGS_TABLENAME, FIELD_HASH)
+
+    # offsets are unsigned, cast so differences may be negative
+    SELECT_QUERY_MATCHES = """
+        SELECT f.%s, CAST(f.%s AS SIGNED) - q.%s
+        FROM %s AS q JOIN %s AS f ON f.%s = q.%s;
+    """ % (FIELD_SONG_ID, FIELD_OFFSET, FIELD_OFFSET, QUERY_TABLENAME,
+           FINGERPRINTS_TABLENAME, FIELD_HASH, FIELD_HASH)
+
+    SELECT_QUERY_ALIGNMENTS = """
+        SELECT f.%s, CAST(f.%s AS SIGNED) - q.%s AS difference,
+            COUNT(*) AS n
+        FROM %s AS q JOIN %s AS f ON f.%s = q.%s
+        GROUP BY f.%s, difference ORDER BY n DESC LIMIT %%s;
+    """ % (FIELD_SONG_ID, FIELD_OFFSET, FIELD_OFFSET, QUERY_TABLENAME,
+           FINGERPRINTS_TABLENAME, FIELD_HASH, FIELD_HASH, FIELD_SONG_ID)
+
     SELECT_ALL = """
         SELECT %s, %s FROM %s;
     """ % (FIELD_SONG_ID, FIELD_OFFSET, FINGERPRINTS_TABLENAME)
 
+    SELECT_ALL_FINGERPRINTS = """
+        SELECT HEX(%s), %s, %s FROM %s;
+    """ % (FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET, FINGERPRINTS_TABLENAME)
+
+    SELECT_SORTED_FINGERPRINTS = """
+        SELECT HEX(%s), %s, %s FROM %s ORDER BY %s;
+    """ % (FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET, FINGERPRINTS_TABLENAME,
+           FIELD_HASH)
+
+    SELECT_ALL_POSTINGS = """
+        SELECT HEX(%s), %s FROM %s;
+    """ % (FIELD_HASH, FIELD_POSTINGS, POSTINGS_TABLENAME)
+
     SELECT_SONG = """
         SELECT %s FROM %s WHERE %s = %%s
     """ % (FIELD_SONGNAME, SONGS_TABLENAME, FIELD_SONG_ID)
@@ -277,6 +525,50 @@ class SQLDatabase(Database):
         SELECT %s, %s FROM %s WHERE %s = 1;
     """ % (FIELD_SONG_ID, FIELD_SONGNAME, SONGS_TABLENAME, FIELD_FINGERPRINTED)
 
+    SELECT_ALIASES = """
+        SELECT %s, %s FROM %s;
+    """ % (FIELD_ALIAS, FIELD_SONG_ID, ALIASES_TABLENAME)
+
+    SELECT_STOP_HASHES = """
+        SELECT LOWER(HEX(%s)) FROM %s;
+    """ % (FIELD_HASH, STOPLIST_TABLENAME)
+
+    # number of different songs of every hash found in at least %s songs
+    SELECT_FREQUENT_HASHES = """
+        SELECT HEX(%s), COUNT(DISTINCT %s) FROM %s
+        GROUP BY %s HAVING COUNT(DISTINCT %s) >= %%s;
+    """ % (FIELD_HASH, FIELD_SONG_ID, FINGERPRINTS_TABLENAME, FIELD_HASH,
+           FIELD_SONG_ID)
+
+    SELECT_LEASED_SONG = """
+        SELECT %s FROM %s WHERE %s = %%s AND %s = 0 AND %s = %%s;
+    """ % (FIELD_SONG_ID, SONGS_TABLENAME, FIELD_SONGNAME,
+           FIELD_FINGERPRINTED, FIELD_LEASE_OWNER)
+
+    # song names the unique key added with the lease columns would reject
+    SELECT_DUPLICATE_SONGNAMES = """
+        SELECT %s FROM %s GROUP BY %s HAVING COUNT(*) > 1 LIMIT 10;
+    """ % (FIELD_SONGNAME, SONGS_TABLENAME, FIELD_SONGNAME)
+
+    SELECT_LEASE_COLUMNS = """
+        SELECT COUNT(*) as n FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = '%s'
+        AND column_name = '%s';
+    """ % (SONGS_TABLENAME, FIELD_LEASE_OWNER)
+
+    SELECT_FINGERPRINTS_PRIMARY_KEY = """
+        SELECT COUNT(*) as n FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = '%s'
+        AND index_name = 'PRIMARY';
+    """ % (FINGERPRINTS_TABLENAME)
+
+    SELECT_TABLE = """
+        SELECT COUNT(*) as n FROM information_schema.tables
+        WHERE table_schema = DATABASE() AND table_name = %s;
+    """
+
+    SELECT_ANY_ROW = "SELECT 1 FROM `%s` LIMIT 1;"
+
     SELECT_ALL_MATCH_DATA = """
         SELECT * FROM %s WHERE %s = %%s;
     """ % (MATCH_DATA_TABLENAME, FIELD_UID)
@@ -377,11 +669,34 @@ class SQLDatabase(Database):
     # drops
     DROP_FINGERPRINTS = "DROP TABLE IF EXISTS %s;" % FINGERPRINTS_TABLENAME
     DROP_SONGS = "DROP TABLE IF EXISTS %s;" % SONGS_TABLENAME
+    DROP_ALIASES = "DROP TABLE IF EXISTS %s;" % ALIASES_TABLENAME
+    DROP_POSTINGS = "DROP TABLE IF EXISTS %s;" % POSTINGS_TABLENAME
+    DROP_STOPLIST = "DROP TABLE IF EXISTS %s;" % STOPLIST_TABLENAME
+    DROP_TABLE = "DROP TABLE IF EXISTS `%s`;"
+
+    # swaps a filled postings table in for the fingerprints rows
+    RENAME_TO_POSTINGS = """
+        RENAME TABLE %s TO `%%s`, `%%s` TO %s;
+    """ % (FINGERPRINTS_TABLENAME, POSTINGS_TABLENAME)
+
+    # and a filled fingerprints table in for the postings
+    RENAME_FROM_POSTINGS = """
+        RENAME TABLE %s TO `%%s`, `%%s` TO %s;
+    """ % (POSTINGS_TABLENAME, FINGERPRINTS_TABLENAME)
 
     # updates
+    # only while the caller still holds the lease, NULL for unclaimed songs
     UPDATE_SONG_FINGERPRINTED = """
-        UPDATE %s SET %s = 1 WHERE %s = %%s
-    """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED, FIELD_SONG_ID)
+        UPDATE %s SET %s = 1, %s = NULL, %s = NULL
+        WHERE %s = %%s AND %s <=> %%s
+    """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED, FIELD_LEASE_OWNER,
+           FIELD_LEASE_EXPIRES, FIELD_SONG_ID, FIELD_LEASE_OWNER)
+
+    UPDATE_LEASES = """
+        UPDATE %s SET %s = NOW() + INTERVAL %%s SECOND
+        WHERE %s = %%s AND %s = 0;
+    """ % (SONGS_TABLENAME, FIELD_LEASE_EXPIRES, FIELD_LEASE_OWNER,
+           FIELD_FINGERPRINTED)
 
     UPDATE_USERNAME_ON_POSTS = """
         UPDATE %s SET %s = %%s WHERE %s = %%s;
@@ -404,10 +719,30 @@ class SQLDatabase(Database):
     """ % (COMMENTS_TABLENAME, FIELD_CONTENT, FIELD_COMMENTID)
 
     # deletes
+    # songs that are still being fingerprinted under a live lease are kept
     DELETE_UNFINGERPRINTED = """
+        DELETE FROM %s WHERE %s = 0 AND (%s IS NULL OR %s < NOW());
+    """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED, FIELD_LEASE_EXPIRES,
+           FIELD_LEASE_EXPIRES)
+
+    # songs tables from before ingest leases
+    DELETE_UNLEASED_UNFINGERPRINTED = """
         DELETE FROM %s WHERE %s = 0;
     """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED)
 
+    DELETE_SONG = """
+        DELETE FROM %s WHERE %s = %%s;
+    """ % (SONGS_TABLENAME, FIELD_SONG_ID)
+
+    DELETE_SONG_FINGERPRINTS = """
+        DELETE FROM %s WHERE %s = %%s;
+    """ % (FINGERPRINTS_TABLENAME, FIELD_SONG_ID)
+
+    DELETE_LEASED_SONG = """
+        DELETE FROM %s WHERE %s = %%s AND %s = 0 AND %s <=> %%s;
+    """ % (SONGS_TABLENAME, FIELD_SONG_ID, FIELD_FINGERPRINTED,
+           FIELD_LEASE_OWNER)
+
     DELETE_MATCH_DATA = """
         DELETE FROM %s WHERE %s = %%s;
     """ % (MATCH_DATA_TABLENAME, FIELD_MATCHID)
@@ -432,36 +767,366 @@ class SQLDatabase(Database):
         DELETE FROM %s;
     """ % (FINGERPRINTS_TABLENAME)
 
+    DELETE_ALL_POSTINGS = """
+        DELETE FROM %s;
+    """ % (POSTINGS_TABLENAME)
+
+    DELETE_POSTINGS = """
+        DELETE FROM %s WHERE %s IN (%%s);
+    """ % (POSTINGS_TABLENAME, FIELD_HASH)
+
+    # not TRUNCATE, which would commit an enclosing transaction
+    DELETE_QUERY_HASHES = "DELETE FROM %s;" % QUERY_TABLENAME
+
+    DELETE_STOPLIST = "DELETE FROM %s;" % STOPLIST_TABLENAME
+
     DELETE_SONGS = """
         DELETE FROM %s;
     """ % (SONGS_TABLENAME)
 
     def __init__(self, **options):
         super(SQLDatabase, self).__init__()
-        self.cursor = cursor_factory(**options)
+        self._configure(options)
+
+    def _configure(self, options):
         self._options = options
+        options = dict(options)
+
+        # large lookups are split into parts of at least
+        # `lookup_split_size` hashes, run side by side on up to
+        # `lookup_threads` pooled connections
+        self.lookup_threads = options.pop("lookup_threads", 1)
+        self.lookup_split_size = options.pop("lookup_split_size", 5000)
+        self._lookup_workers = None
+        self._lookup_workers_lock = threading.Lock()
+
+        # "values" inserts fingerprints with multi-row INSERTs, "infile"
+        # streams them from a temporary file with LOAD DATA LOCAL INFILE
+        self.bulk_insert = options.pop("bulk_insert", "values")
+        if self.bulk_insert not in ("values", "infile"):
+            raise ValueError("bulk_insert must be 'values' or 'infile', "
+                             "not %r" % self.bulk_insert)
+        if self.bulk_insert == "infile":
+            options.setdefault("local_infile", 1)
+
+        # cleared by setup() for songs tables created before ingest leases,
+        # until `migrate_songs` adds them
+        self.leases = True
+
+        # layout of newly created fingerprints tables, "indexed",
+        # "clustered" or "postings", see `migrate_fingerprints`
+        self.fingerprints_schema = options.pop("fingerprints_schema",
+                                               "indexed")
+        if self.fingerprints_schema not in self.FINGERPRINTS_SCHEMAS:
+            raise ValueError("fingerprints_schema must be one of %s, not %r"
+                             % (", ".join(self.FINGERPRINTS_SCHEMAS),
+                                self.fingerprints_schema))
+
+        # only store fingerprints, songs are kept by another database
+        self.fingerprints_only = options.pop("fingerprints_only", False)
+
+        # read-only queries are spread over these servers, each given as
+        # connection options overriding those of the primary
+        replicas = options.pop("replicas", [])
+        check_interval = options.pop("replica_check_interval", 30)
+        max_lag = options.pop("replica_max_lag", None)
+
+        self.cursor = cursor_factory(**options)
+        self.replicas = []
+        for replica in replicas:
+            # a hung replica times out and fails over instead of blocking
+            replica_options = dict(self.REPLICA_TIMEOUTS, **options)
+            replica_options.update(replica)
+            self.replicas.append(Replica(
+                cursor_factory(**replica_options), check_interval, max_lag,
+                name=replica_options.get("host", "localhost")))
+        self._next_replica = 0
 
     def after_fork(self):
         # Clear the cursor cache, we don't want any stale connections from
         # the previous process.
+        self.cursor.pool.clear()
+        for replica in self.replicas:
+            replica.cursor.pool.clear()
         Cursor.clear_cache()
+        # threads do not survive a fork
+        self._lookup_workers = None
+        self._lookup_workers_lock = threading.Lock()
+
+    def close(self):
+        with self._lookup_workers_lock:
+            if self._lookup_workers is not None:
+                self._lookup_workers.close()
+                self._lookup_workers = None
+
+    def _read_replicas(self):
+        """
+        Returns the replicas a read of the calling thread may go to. Reads
+        inside a transaction stay on the primary, which holds its
+        uncommitted writes.
+        """
+        if self.cursor.pool.pinned() is not None:
+            return []
+        return self.replicas
+
+    def _read_on(self, replicas, func, *args):
+        """
+        Calls `func(cursor, *args)` with the cursor factory of the next
+        healthy replica, moving on to the following one if it fails and
+        to the primary when none is left. `func` must only read.
+        """
+        if replicas:
+            # a racy counter still spreads the reads well enough
+            start = self._next_replica % len(replicas)
+            self._next_replica = start + 1
+            for replica in replicas[start:] + replicas[:start]:
+                if not replica.healthy():
+                    continue
+                try:
+                    return func(replica.cursor, *args)
+                except (mysql.OperationalError, PoolTimeoutError) as err:
+                    replica.failed(err)
+        return func(self.cursor, *args)
+
+    def _read(self, func, *args):
+        return self._read_on(self._read_replicas(), func, *args)
+
+    def _fetch_all(self, cursor, query, args=None,
+                   cursor_type=mysql.cursors.Cursor):
+        with cursor(cursor_type=cursor_type) as cur:
+            cur.execute(query, args)
+            return list(cur)
+
+    def pool_stats(self):
+        """
+        Returns the counters of this database's connection pool, see
+        `ConnectionPool.stats`.
+        """
+        return self.cursor.pool.stats()
+
+    def transaction(self):
+        """
+        Runs every query of the calling thread inside the block on one
+        connection and commits them together when the block is left, or
+        rolls them all back on an error. Nested blocks join the outer
+        transaction.
+
+        ```python
+        with db.transaction():
+            db.insert_hashes(sid, hashes)
+            db.set_song_fingerprinted(sid)
+        ```
+        """
+        return self.cursor.pool.transaction()
 
     def setup(self):
         """
         Creates any non-existing tables required for dejavu to function.
 
         This also removes all songs that have been added but have no
-        fingerprints associated with them.
+        fingerprints associated with them, unless another ingest still
+        holds a lease on them.
+
+        With `fingerprints_only` only the fingerprints table is created.
+        Fingerprints stored in another layout than `fingerprints_schema`
+        keep it until `migrate_fingerprints` converts them.
         """
         with self.cursor() as cur:
+            if self.fingerprints_only:
+                self._setup_fingerprints_table(cur)
+                cur.execute(self.CREATE_STOPLIST_TABLE)
+                return
+
             cur.execute(self.CREATE_SONGS_TABLE)
-            cur.execute(self.CREATE_FINGERPRINTS_TABLE)
-            cur.execute(self.DELETE_UNFINGERPRINTED)
+            cur.execute(self.SELECT_LEASE_COLUMNS)
+            self.leases = bool(cur.fetchone()[0])
+            if not self.leases:
+                logging.warning(
+                    "The %s table has no ingest leases yet, run python "
+                    "dejavu.py --migrate-schema before fingerprinting",
+                    self.SONGS_TABLENAME)
+            self._setup_fingerprints_table(cur)
+            cur.execute(self.CREATE_ALIASES_TABLE)
+            cur.execute(self.CREATE_STOPLIST_TABLE)
+            self._delete_unfingerprinted(cur)
             cur.execute(self.CREATE_MATCH_DATA_TABLE)
             cur.execute(self.CREATE_FORUM_POSTS_TABLE)
             cur.execute(self.CREATE_COMMENTS_TABLE)
             cur.execute(self.CREATE_POTENTIAL_MATCH_TABLE)
 
+    def migrate_songs(self):
+        """
+        Adds the ingest lease columns, and the unique key on song names
+        they rely on, to a songs table created by an older version.
+        Returns False if it has them already.
+        """
+        if self.fingerprints_only:
+            return False
+
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_LEASE_COLUMNS)
+            if cur.fetchone()[0]:
+                self.leases = True
+                return False
+
+            # older catalogs did not keep song names unique
+            cur.execute(self.SELECT_DUPLICATE_SONGNAMES)
+            duplicates = [song_name for song_name, in cur]
+            if duplicates:
+                raise ValueError(
+                    "Cannot add ingest leases to the %s table, some song "
+                    "names are stored more than once (%s). Delete or rename "
+                    "the duplicates, e.g. with Dejavu.delete_song, and "
+                    "migrate again."
+                    % (self.SONGS_TABLENAME, ", ".join(duplicates)))
+            cur.execute(self.ALTER_SONGS_ADD_LEASES)
+        self.leases = True
+        return True
+
+    def _delete_unfingerprinted(self, cur):
+        if self.leases:
+            cur.execute(self.DELETE_UNFINGERPRINTED)
+        else:
+            cur.execute(self.DELETE_UNLEASED_UNFINGERPRINTED)
+
+    def _setup_fingerprints_table(self, cur):
+        stored = self.get_fingerprints_schema()
+        if stored is None:
+            self._create_fingerprints_table(cur)
+        elif (stored == "postings") != (self.fingerprints_schema == "postings"):
+            # a table of the other layout next to them would hide them
+            logging.warning(
+                "Fingerprints are stored in the %s layout, run python "
+                "dejavu.py --migrate-schema to convert them to %s",
+                stored, self.fingerprints_schema)
+
+    def _create_fingerprints_table(self, cur, table=None):
+        if self.fingerprints_schema == "postings":
+            query = self.CREATE_POSTINGS_TABLE
+            table = table or self.POSTINGS_TABLENAME
+        elif self.fingerprints_only:
+            if self.fingerprints_schema == "clustered":
+                query = self.CREATE_UNLINKED_CLUSTERED_FINGERPRINTS_TABLE
+            else:
+                query = self.CREATE_UNLINKED_FINGERPRINTS_TABLE
+        elif self.fingerprints_schema == "clustered":
+            query = self.CREATE_CLUSTERED_FINGERPRINTS_TABLE
+        else:
+            query = self.CREATE_FINGERPRINTS_TABLE
+        cur.execute(query % (table or self.FINGERPRINTS_TABLENAME))
+
+    def _table_rows(self, cur, table):
+        """
+        Returns None if `table` does not exist, else whether it holds any
+        rows.
+        """
+        cur.execute(self.SELECT_TABLE, (table,))
+        if not cur.fetchone()[0]:
+            return None
+        cur.execute(self.SELECT_ANY_ROW % table)
+        return cur.fetchone() is not None
+
+    def _drop_empty_table(self, cur, table):
+        if self._table_rows(cur, table):
+            raise ValueError("The %s table holds fingerprints of its own, "
+                             "move them out of the way before migrating"
+                             % table)
+        cur.execute(self.DROP_TABLE % table)
+
+    def get_fingerprints_schema(self):
+        """
+        Returns the layout of the stored fingerprints, "indexed",
+        "clustered" or "postings", or None before setup.
+
+        Migrations only swap in a table once it is complete, so both
+        tables only exist if an older version created an empty one next
+        to the stored fingerprints, which does not count.
+        """
+        with self.cursor() as cur:
+            postings = self._table_rows(cur, self.POSTINGS_TABLENAME)
+            rows = self._table_rows(cur, self.FINGERPRINTS_TABLENAME)
+            if postings and rows:
+                raise ValueError("Both the %s and the %s table hold "
+                                 "fingerprints, keep only one of them"
+                                 % (self.FINGERPRINTS_TABLENAME,
+                                    self.POSTINGS_TABLENAME))
+            if postings is None and rows is None:
+                return None
+            if postings or rows is None:
+                return "postings"
+            cur.execute(self.SELECT_FINGERPRINTS_PRIMARY_KEY)
+            clustered, = cur.fetchone()
+        return "clustered" if clustered else "indexed"
+
+    def migrate_fingerprints(self):
+        """
+        Converts the stored fingerprints to `fingerprints_schema`. Returns
+        False if they already have that layout.
+
+        Between the two row layouts the server rebuilds the table in the
+        new order. Lookups keep working when moving to the clustered
+        layout; moving back blocks writes until done. To or from the
+        postings layout every fingerprint is copied to a new table, so
+        stop ingest first. An interrupted migration can simply be run
+        again.
+        """
+        current = self.get_fingerprints_schema()
+        if current in (None, self.fingerprints_schema):
+            return False
+
+        if self.fingerprints_schema == "postings":
+            self._migrate_to_postings()
+        elif current == "postings":
+            self._migrate_from_postings()
+        else:
+            with self.cursor() as cur:
+                if self.fingerprints_schema == "clustered":
+                    cur.execute(self.ALTER_FINGERPRINTS_CLUSTERED)
+                else:
+                    cur.execute(self.ALTER_FINGERPRINTS_INDEXED)
+        return True
+
+    def _migrate_to_postings(self):
+        new_table = self.POSTINGS_TABLENAME + "_new"
+        old_table = self.FINGERPRINTS_TABLENAME + "_old"
+        with self.cursor() as cur:
+            cur.execute(self.DROP_TABLE % new_table)
+            cur.execute(self.DROP_TABLE % old_table)
+            cur.execute(self.CREATE_POSTINGS_TABLE % new_table)
+
+        # rows arrive in hash order, a hash split over two batches is
+        # appended to like during ingest
+        with self.cursor(cursor_type=SSCursor) as source:
+            source.execute(self.SELECT_SORTED_FINGERPRINTS)
+            for rows in grouper(source, self.INSERT_BATCH_SIZE):
+                with self.cursor() as cur:
+                    self._insert_postings(cur, rows, new_table)
+
+        with self.cursor() as cur:
+            self._drop_empty_table(cur, self.POSTINGS_TABLENAME)
+            cur.execute(self.RENAME_TO_POSTINGS % (old_table, new_table))
+            cur.execute(self.DROP_TABLE % old_table)
+
+    def _migrate_from_postings(self):
+        new_table = self.FINGERPRINTS_TABLENAME + "_new"
+        old_table = self.POSTINGS_TABLENAME + "_old"
+        with self.cursor() as cur:
+            cur.execute(self.DROP_TABLE % new_table)
+            cur.execute(self.DROP_TABLE % old_table)
+            self._create_fingerprints_table(cur, new_table)
+
+        for hashes, counts, sids, offsets in self._scan_postings():
+            owner = np.repeat(np.arange(len(hashes)), counts)
+            rows = sorted(zip([hashes[i] for i in owner], sids.tolist(),
+                              offsets.tolist()))
+            with self.cursor() as cur:
+                self._insert_fingerprints(cur, rows, new_table)
+
+        with self.cursor() as cur:
+            self._drop_empty_table(cur, self.FINGERPRINTS_TABLENAME)
+            cur.execute(self.RENAME_FROM_POSTINGS % (old_table, new_table))
+            cur.execute(self.DROP_TABLE % old_table)
+
     def empty(self):
         """
         Drops tables created by dejavu and then creates them again
@@ -472,16 +1137,59 @@ class SQLDatabase(Database):
         """
         with self.cursor() as cur:
             cur.execute(self.DROP_FINGERPRINTS)
+            cur.execute(self.DROP_POSTINGS)
+            cur.execute(self.DROP_STOPLIST)
+            cur.execute(self.DROP_ALIASES)
             cur.execute(self.DROP_SONGS)
 
         self.setup()
 
     def delete_unfingerprinted_songs(self):
         """
-        Removes all songs that have no fingerprints associated with them.
+        Removes all songs that have no fingerprints associated with them
+        and are not leased by a running ingest.
         """
+        if self.fingerprints_only:
+            return
+
         with self.cursor() as cur:
-            cur.execute(self.DELETE_UNFINGERPRINTED)
+            self._delete_unfingerprinted(cur)
+
+    def delete_song(self, sid):
+        """
+        Removes a song, its fingerprints and aliases given its song ID.
+
+        With the postings layout this reads every posting to find the
+        song's, as nothing indexes them by song. The rows holding them are
+        then locked and read again, so postings appended meanwhile are
+        kept.
+        """
+        if self.fingerprints_schema == "postings":
+            changed = []
+            for hashes, counts, sids, offsets in self._scan_postings():
+                owner = np.repeat(np.arange(len(hashes)), counts)
+                changed.extend(hashes[i]
+                               for i in np.unique(owner[sids == sid]))
+
+        with self.transaction():
+            with self.cursor() as cur:
+                if self.fingerprints_schema == "postings":
+                    hashes, counts, sids, offsets = self._read_postings(
+                        cur, changed, lock=True)
+                    owner = np.repeat(np.arange(len(hashes)), counts)
+                    keep = sids != sid
+                    kept = zip([hashes[i] for i in owner[keep]],
+                               sids[keep].tolist(), offsets[keep].tolist())
+                    for split_values in grouper(hashes, 1000):
+                        cur.execute(self.DELETE_POSTINGS % ', '.join(
+                            ['UNHEX(%s)'] * len(split_values)), split_values)
+                    self._insert_postings(cur, kept)
+                elif self.fingerprints_only:
+                    cur.execute(self.DELETE_SONG_FINGERPRINTS, (sid,))
+
+                # the songs foreign key removes the fingerprint rows
+                if not self.fingerprints_only:
+                    cur.execute(self.DELETE_SONG, (sid,))
 
     def delete_match(self, mid):
         """
@@ -518,7 +1226,10 @@ class SQLDatabase(Database):
         Deletes all fingerprints from the database
         """
         with self.cursor() as cur:
-            cur.execute(self.DELETE_FINGERPRINTS)
+            if self.fingerprints_schema == "postings":
+                cur.execute(self.DELETE_ALL_POSTINGS)
+            else:
+                cur.execute(self.DELETE_FINGERPRINTS)
             cur.execute(self.DELETE_SONGS)
 
     def get_all_match_data(self, uid):
@@ -669,17 +1380,19 @@ class SQLDatabase(Database):
         """
         Returns number of songs the database has fingerprinted.
         """
-        with self.cursor() as cur:
-            cur.execute(self.SELECT_UNIQUE_SONG_IDS)
-
-            for count, in cur:
-                return count
-            return 0
+        for count, in self._read(self._fetch_all,
+                                 self.SELECT_UNIQUE_SONG_IDS):
+            return count
+        return 0
 
     def get_num_fingerprints(self):
         """
         Returns number of fingerprints the database has fingerprinted.
         """
+        if self.fingerprints_schema == "postings":
+            return sum(int(counts.sum()) for _, counts, _, _
+                       in self._scan_postings())
+
         with self.cursor() as cur:
             cur.execute(self.SELECT_NUM_FINGERPRINTS)
 
@@ -692,6 +1405,10 @@ class SQLDatabase(Database):
         Returns number of individual fingerprints for song
         with matching song id
         """
+        if self.fingerprints_schema == "postings":
+            return sum(int((sids == sid).sum()) for _, _, sids, _
+                       in self._scan_postings())
+
         with self.cursor() as cur:
             cur.execute(self.SELECT_INDIVIDUAL_FINGERPRINTS, (sid,))
 
@@ -786,13 +1503,17 @@ class SQLDatabase(Database):
             for row in cur:
                 yield row
 
-    def set_song_fingerprinted(self, sid):
+    def set_song_fingerprinted(self, sid, owner=None):
         """
         Set the fingerprinted flag to TRUE (1) once a song has been
-        completely fingerprinted in the database.
+        completely fingerprinted in the database, provided `owner` still
+        holds its lease.
         """
         with self.cursor() as cur:
-            cur.execute(self.UPDATE_SONG_FINGERPRINTED, (sid,))
+            cur.execute(self.UPDATE_SONG_FINGERPRINTED, (sid, owner))
+            if owner is not None and not cur.rowcount:
+                raise LeaseLostError("Song %d is no longer leased by %s"
+                                     % (sid, owner))
 
     def set_username(self, newUsername, uid):
         """
@@ -828,18 +1549,72 @@ class SQLDatabase(Database):
         """
         Return songs that have the fingerprinted flag set TRUE (1).
         """
-        with self.cursor(cursor_type=DictCursor) as cur:
-            cur.execute(self.SELECT_SONGS)
-            for row in cur:
-                yield row
+        return iter(self._read(self._fetch_all, self.SELECT_SONGS, None,
+                               DictCursor))
 
     def get_song_by_id(self, sid):
         """
         Returns song by its ID.
         """
-        with self.cursor(cursor_type=DictCursor) as cur:
-            cur.execute(self.SELECT_SONG, (sid,))
-            return cur.fetchone()
+        for song in self._read(self._fetch_all, self.SELECT_SONG, (sid,),
+                               DictCursor):
+            return song
+        return None
+
+    def get_aliases(self):
+        """
+        Return the (alias_name, song_id) pairs of songs that were found to
+        duplicate a song already in the database.
+        """
+        return iter(self._read(self._fetch_all, self.SELECT_ALIASES))
+
+    def get_stop_hashes(self):
+        """
+        Returns the hashes on the stop-list, see `build_stoplist`.
+        """
+        return [hash for hash, in self._read(self._fetch_all,
+                                             self.SELECT_STOP_HASHES)]
+
+    def build_stoplist(self, min_songs):
+        """
+        Counts the different songs of every hash and replaces the stop-list
+        with the hashes found in at least `min_songs` of them. Returns the
+        number of hashes listed.
+
+        The counts are read without locking the fingerprints, so ingest
+        can go on meanwhile, but the whole table is scanned.
+        """
+        if self.fingerprints_schema == "postings":
+            frequent = self._frequent_postings(min_songs)
+        else:
+            with self.cursor(cursor_type=SSCursor) as cur:
+                cur.execute(self.SELECT_FREQUENT_HASHES, (min_songs,))
+                frequent = list(cur)
+
+        with self.transaction():
+            with self.cursor() as cur:
+                cur.execute(self.DELETE_STOPLIST)
+                for batch in grouper(frequent, self.INSERT_BATCH_SIZE):
+                    cur.executemany(self.INSERT_STOP_HASH, batch)
+        return len(frequent)
+
+    def _frequent_postings(self, min_songs):
+        frequent = []
+        for hashes, counts, sids, _ in self._scan_postings():
+            # distinct (hash, song) pairs, counted per hash
+            owner = np.repeat(np.arange(len(hashes), dtype=np.int64), counts)
+            pairs = np.unique((owner << 32) | sids)
+            num_songs = np.bincount(pairs >> 32, minlength=len(hashes))
+            frequent.extend((hashes[i], int(num_songs[i])) for i
+                            in np.flatnonzero(num_songs >= min_songs))
+        return frequent
+
+    def insert_alias(self, alias_name, sid):
+        """
+        Records `alias_name` as another name of the song with ID `sid`.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.INSERT_ALIAS, (alias_name, sid))
 
     def insert(self, hash, sid, offset):
         """
@@ -856,6 +1631,47 @@ class SQLDatabase(Database):
             cur.execute(self.INSERT_SONG, (songname,))
             return cur.lastrowid
 
+    def claim_song(self, song_name, owner, ttl):
+        """
+        Inserts or takes over the song row for `song_name` on behalf of
+        `owner`, leased for `ttl` seconds. Returns the song ID, or None
+        when the song is fingerprinted already or leased by someone else.
+        """
+        if not self.leases:
+            raise ValueError("The %s table has no ingest leases yet, run "
+                             "python dejavu.py --migrate-schema first"
+                             % self.SONGS_TABLENAME)
+
+        with self.cursor() as cur:
+            cur.execute(self.INSERT_SONG_LEASE, (song_name, owner, ttl))
+            cur.execute(self.SELECT_LEASED_SONG, (song_name, owner))
+            row = cur.fetchone()
+            return row[0] if row else None
+
+    def renew_leases(self, owner, ttl):
+        """
+        Extends every lease held by `owner` by `ttl` seconds from now.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.UPDATE_LEASES, (ttl, owner))
+
+    def release_song(self, sid, owner=None):
+        """
+        Removes a claimed song that could not be fingerprinted, together
+        with any fingerprints already written for it, unless it has been
+        fingerprinted or leased by another owner meanwhile.
+
+        With `fingerprints_only` there are no leases here; the database
+        keeping the songs decides, see `ShardedDatabase`.
+        """
+        if self.fingerprints_only:
+            self.delete_song(sid)
+            return True
+
+        with self.cursor() as cur:
+            cur.execute(self.DELETE_LEASED_SONG, (sid, owner))
+            return cur.rowcount > 0
+
     def query(self, hash):
         """
         Return all tuples associated with hash.
@@ -914,36 +1730,180 @@ class SQLDatabase(Database):
         """
         Returns all tuples in database.
         """
+        if self.fingerprints_schema == "postings":
+            return ((sid, offset) for _, sid, offset
+                    in self.iter_fingerprints())
         return self.query(None)
 
+    def iter_fingerprints(self):
+        """
+        Streams all (hash, sid, offset) tuples in the database without
+        buffering them on the client.
+        """
+        if self.fingerprints_schema == "postings":
+            for hashes, counts, sids, offsets in self._scan_postings():
+                owner = np.repeat(np.arange(len(hashes)), counts)
+                for i, sid, offset in zip(owner.tolist(), sids.tolist(),
+                                          offsets.tolist()):
+                    yield (hashes[i], sid, offset)
+            return
+
+        with self.cursor(cursor_type=SSCursor) as cur:
+            cur.execute(self.SELECT_ALL_FINGERPRINTS)
+            for hash, sid, offset in cur:
+                yield (hash, sid, offset)
+
     def insert_hashes(self, sid, hashes):
         """
         Insert series of hash => song_id, offset
         values into the database.
         """
-        values = []
-        for hash, offset in hashes:
-            values.append((hash, sid, offset))
-
-        with self.cursor() as cur:
-            for split_values in grouper(values, 1000):
-                cur.executemany(self.INSERT_FINGERPRINT, split_values)
+        self.insert_many_hashes([(sid, hashes)])
 
-    def return_matches(self, hashes):
+    def insert_many_hashes(self, songs):
         """
-        Return the (song_id, offset_diff) tuples associated with
-        a list of (sha1, sample_offset) values.
+        Inserts the fingerprints of several songs, given as (sid, hashes)
+        pairs, sorted by hash across all of them so the index pages of the
+        fingerprints table are filled in order instead of at random.
         """
-        # Create a dictionary of hash => offset pairs for later lookups
-        mapper = {}
-        for hash, offset in hashes:
-            mapper[hash.upper()] = offset
-
-        # Get an iteratable of all the hashes we need
-        values = mapper.keys()
+        rows = sorted((hash, sid, offset)
+                      for sid, hashes in songs for hash, offset in hashes)
+        if not rows:
+            return
 
         with self.cursor() as cur:
-            for split_values in grouper(values, 1000):
+            if self.fingerprints_schema == "postings":
+                self._insert_postings(cur, rows)
+            else:
+                self._insert_fingerprints(cur, rows)
+
+    def _insert_fingerprints(self, cur, rows, table=None):
+        if self.bulk_insert == "infile" and table is None:
+            self._load_fingerprints(cur, rows)
+        else:
+            prefix = self.INSERT_FINGERPRINTS % (
+                table or self.FINGERPRINTS_TABLENAME)
+            for start in xrange(0, len(rows), self.INSERT_BATCH_SIZE):
+                batch = rows[start:start + self.INSERT_BATCH_SIZE]
+                query = prefix + ", ".join(
+                    [self.FINGERPRINT_VALUES] * len(batch))
+                cur.execute(query, tuple(value for row in batch
+                                         for value in row))
+
+    def _insert_postings(self, cur, rows, table=None):
+        """
+        Appends (hash, sid, offset) rows, grouped by hash, to the postings
+        of their hashes.
+        """
+        packed = pack_postings(rows)
+        prefix = self.INSERT_POSTINGS % (table or self.POSTINGS_TABLENAME)
+        for start in xrange(0, len(packed), self.INSERT_BATCH_SIZE):
+            batch = packed[start:start + self.INSERT_BATCH_SIZE]
+            query = prefix + ", ".join(
+                [self.POSTINGS_VALUES] * len(batch)) + self.UPDATE_POSTINGS
+            cur.execute(query, tuple(value for pair in batch
+                                     for value in pair))
+
+    def _read_postings(self, cur, hashes, lock=False):
+        """
+        Fetches the postings of distinct `hashes`. Returns the hashes found,
+        as passed in, with the number of postings of each and the song ids
+        and offsets of all postings, in the same order. With `lock` their
+        rows stay locked until the enclosing transaction ends.
+        """
+        # HEX() hands hashes back in upper case
+        originals = dict((hash.upper(), hash) for hash in hashes)
+
+        found, blobs = [], []
+        for split_values in grouper(originals.keys(), 1000):
+            if lock:
+                query = self.SELECT_POSTINGS_FOR_UPDATE
+            else:
+                query = self.SELECT_POSTINGS
+            query = query % ', '.join(['UNHEX(%s)'] * len(split_values))
+            cur.execute(query, split_values)
+            for hash, postings in cur:
+                found.append(originals[hash])
+                blobs.append(postings)
+        return (found,) + unpack_postings(blobs)
+
+    def _scan_postings(self):
+        """
+        Streams the whole postings table, decoded a batch of hashes at a
+        time. Yields (hashes, counts, sids, offsets) like `_read_postings`.
+        """
+        with self.cursor(cursor_type=SSCursor) as cur:
+            cur.execute(self.SELECT_ALL_POSTINGS)
+            for batch in grouper(cur, self.QUERY_BATCH_SIZE):
+                hashes = [hash for hash, _ in batch]
+                yield (hashes,) + unpack_postings(
+                    [postings for _, postings in batch])
+
+    def _load_fingerprints(self, cur, rows):
+        """
+        Writes (hash, sid, offset) rows to a temporary file and has the
+        server load it in one statement. The client reads the file, so
+        it works against remote servers that allow `local_infile`.
+        """
+        with tempfile.NamedTemporaryFile(prefix="dejavu-",
+                                         suffix=".tsv") as f:
+            f.writelines("%s\t%d\t%d\n" % row for row in rows)
+            f.flush()
+            cur.execute(self.LOAD_FINGERPRINTS, (f.name,))
+
+    def _split(self, items):
+        """
+        Splits a lookup into one part per lookup thread, none smaller than
+        `lookup_split_size`.
+        """
+        items = list(items)
+        if self.lookup_threads <= 1:
+            return [items]
+        size = max(self.lookup_split_size,
+                   -(-len(items) // self.lookup_threads))
+        return [items[start:start + size]
+                for start in xrange(0, len(items), size)] or [items]
+
+    def _fan_out(self, func, parts):
+        """
+        Runs `func` on every part, on as many threads and pooled
+        connections as there are parts, and yields the results in the
+        order they complete. Inside a transaction the parts run one after
+        the other on its connection, so they see its uncommitted writes.
+        """
+        if len(parts) == 1 or self.cursor.pool.pinned() is not None:
+            for part in parts:
+                yield func(part)
+            return
+
+        with self._lookup_workers_lock:
+            if self._lookup_workers is None:
+                self._lookup_workers = ThreadPool(self.lookup_threads)
+        for result in self._lookup_workers.imap_unordered(func, parts):
+            yield result
+
+    def lookup_hashes(self, hashes):
+        """
+        Return the (sha1, song_id, offset) rows of every fingerprint whose
+        hash is in `hashes`.
+        """
+        if self.fingerprints_schema == "postings":
+            lookup_part = self._lookup_postings
+        else:
+            lookup_part = self._lookup_part
+
+        read = partial(self._read_on, self._read_replicas(), lookup_part)
+        for rows in self._fan_out(read, self._split(set(hashes))):
+            for row in rows:
+                yield row
+
+    def _lookup_part(self, cursor, hashes):
+        # HEX() hands hashes back in upper case
+        originals = dict((hash.upper(), hash) for hash in hashes)
+
+        rows = []
+        with cursor() as cur:
+            for split_values in grouper(originals.keys(), 1000):
                 # Create our IN part of the query
                 query = self.SELECT_MULTIPLE
                 query = query % ', '.join(['UNHEX(%s)'] * len(split_values))
@@ -951,15 +1911,114 @@ class SQLDatabase(Database):
                 cur.execute(query, split_values)
 
                 for hash, sid, offset in cur:
-                    # (sid, db_offset - song_sampled_offset)
-                    yield (sid, offset - mapper[hash])
+                    rows.append((originals[hash], sid, offset))
+        return rows
+
+    def _lookup_postings(self, cursor, hashes):
+        with cursor() as cur:
+            found, counts, sids, offsets = self._read_postings(cur, hashes)
+
+        owner = np.repeat(np.arange(len(found)), counts)
+        return [(found[i], sid, offset) for i, sid, offset
+                in zip(owner.tolist(), sids.tolist(), offsets.tolist())]
+
+    def return_matches(self, hashes):
+        """
+        Return the (song_id, offset_diff) tuples associated with
+        a list of (sha1, sample_offset) values.
+
+        The query pairs are loaded into a temporary table of the connection
+        and joined against the fingerprints on the binary hash, so a hash
+        found at several offsets of the clip counts at each of them. Large
+        clips are split over several connections, see `lookup_threads`.
+
+        With the postings layout the postings of each distinct hash are
+        fetched and the differences computed here instead.
+        """
+        if self.fingerprints_schema == "postings":
+            match_part = self._match_postings
+        else:
+            match_part = self._match_part
+
+        read = partial(self._read_on, self._read_replicas(), match_part)
+        for matches in self._fan_out(read, self._split(hashes)):
+            for match in matches:
+                yield match
+
+    def _match_part(self, cursor, hashes):
+        with cursor() as cur:
+            if not self._load_query(cur, hashes):
+                return []
+
+            cur.execute(self.SELECT_QUERY_MATCHES)
+            # (sid, db_offset - song_sampled_offset)
+            matches = list(cur)
+
+            cur.execute(self.DELETE_QUERY_HASHES)
+            return matches
+
+    def _match_postings(self, cursor, hashes):
+        with cursor() as cur:
+            found, counts, sids, offsets = self._read_postings(
+                cur, set(hash for hash, _ in hashes))
+
+        position = dict((hash, i) for i, hash in enumerate(found))
+        query = [(position[hash], offset) for hash, offset in hashes
+                 if hash in position]
+        if not query:
+            return []
+
+        # pair every query offset with all postings of its hash
+        rows = np.array([i for i, _ in query], dtype=np.int64)
+        query_offsets = np.array([offset for _, offset in query],
+                                 dtype=np.int64)
+        starts = np.cumsum(counts) - counts
+        which, postings = expand_ranges(starts[rows], counts[rows])
+        return zip(sids[postings].tolist(),
+                   (offsets[postings] - query_offsets[which]).tolist())
+
+    def top_alignments(self, hashes, limit):
+        """
+        Counts the matches per (song_id, offset_diff) pair on the server
+        and returns only the `limit` strongest pairs. Postings are counted
+        here.
+        """
+        if self.fingerprints_schema == "postings":
+            return super(SQLDatabase, self).top_alignments(hashes, limit)
+        return self._read(self._top_alignments, hashes, limit)
+
+    def _top_alignments(self, cursor, hashes, limit):
+        with cursor() as cur:
+            if not self._load_query(cur, hashes):
+                return []
+
+            cur.execute(self.SELECT_QUERY_ALIGNMENTS, (limit,))
+            alignments = [(sid, offset_difference, count)
+                          for sid, offset_difference, count in cur]
+
+            cur.execute(self.DELETE_QUERY_HASHES)
+            return alignments
+
+    def _load_query(self, cur, hashes):
+        """
+        Fills the connection's temporary query table with the (hash,
+        offset) pairs of a clip. Returns the number of pairs.
+        """
+        rows = [(unhexlify(hash), offset) for hash, offset in hashes]
+        if rows:
+            # pooled connections keep the table between queries
+            cur.execute(self.CREATE_QUERY_TABLE)
+            cur.execute(self.DELETE_QUERY_HASHES)
+            for batch in grouper(rows, self.QUERY_BATCH_SIZE):
+                cur.executemany(self.INSERT_QUERY_HASH, batch)
+        return len(rows)
 
     def __getstate__(self):
         return (self._options,)
 
     def __setstate__(self, state):
-        self._options, = state
-        self.cursor = cursor_factory(**self._options)
+        options, = state
+        self._configure(options)
 
 
 def grouper(iterable, n, fillvalue=None):
@@ -968,16 +2027,344 @@ def grouper(iterable, n, fillvalue=None):
             in izip_longest(fillvalue=fillvalue, *args))
 
 
+def pack_postings(rows):
+    """
+    Packs (hash, sid, offset) rows, grouped by hash, into one (hash,
+    postings) pair per hash. The postings are the varint encoded song id
+    and offset of every row, so the postings of a hash can be extended by
+    simply appending more.
+    """
+    rows = list(rows)
+    if not rows:
+        return []
+
+    data = encode_varints(np.array([(sid, offset) for _, sid, offset in rows],
+                                   dtype=np.int64).ravel())
+    # byte position of every value
+    value_starts = np.zeros(2 * len(rows) + 1, dtype=np.int64)
+    value_starts[1:] = np.flatnonzero(data < 0x80) + 1
+
+    firsts = [i for i in xrange(len(rows))
+              if i == 0 or rows[i][0] != rows[i - 1][0]]
+    bounds = value_starts[2 * np.array(firsts + [len(rows)])].tolist()
+    return [(rows[first][0], data[start:end].tostring())
+            for first, start, end in zip(firsts, bounds[:-1], bounds[1:])]
+
+
+def unpack_postings(blobs):
+    """
+    Decodes the postings of several hashes. Returns the number of postings
+    in every blob and the song ids and offsets of all of them.
+    """
+    data = np.frombuffer("".join(blobs), dtype=np.uint8)
+    if not len(data):
+        empty = np.zeros(0, dtype=np.int64)
+        return np.zeros(len(blobs), dtype=np.int64), empty, empty
+
+    values = decode_varints(data)
+    blob_of_byte = np.repeat(np.arange(len(blobs)),
+                             [len(blob) for blob in blobs])
+    counts = np.bincount(blob_of_byte[data < 0x80],
+                         minlength=len(blobs)) // 2
+    return counts, values[0::2], values[1::2]
+
+
 def cursor_factory(**factory_options):
+    # every factory gets its own pool, built from the pool_* options
+    pool_options = dict((key, factory_options.pop(key))
+                        for key in ConnectionPool.OPTIONS
+                        if key in factory_options)
+    pool = ConnectionPool(factory_options, **pool_options)
+
     def cursor(**options):
         options.update(factory_options)
-        return Cursor(**options)
+        return Cursor(pool=pool, **options)
+    cursor.pool = pool
     return cursor
 
 
+class ConnectionPool(object):
+    """
+    A per-process pool of database connections.
+
+    Inside a `transaction` block the calling thread keeps one connection
+    pinned, which every cursor of that thread then shares.
+
+    At most `pool_max_size` connections are open at once; callers wait
+    for a free one beyond that, up to `pool_wait_timeout` seconds (None
+    waits forever). Idle connections are closed after `pool_idle_timeout`
+    seconds, keeping at least `pool_min_size` open. A connection is only
+    pinged before reuse if it sat idle for more than `pool_ping_after`
+    seconds.
+
+    Connections inherited through a fork are dropped, not closed, as they
+    still belong to the parent process.
+    """
+
+    OPTIONS = ("pool_min_size", "pool_max_size", "pool_idle_timeout",
+               "pool_ping_after", "pool_wait_timeout")
+
+    def __init__(self, connect_options, pool_min_size=1, pool_max_size=10,
+                 pool_idle_timeout=300, pool_ping_after=30,
+                 pool_wait_timeout=None):
+        super(ConnectionPool, self).__init__()
+        self.connect_options = connect_options
+        self.min_size = pool_min_size
+        self.max_size = pool_max_size
+        self.idle_timeout = pool_idle_timeout
+        self.ping_after = pool_ping_after
+        self.wait_timeout = pool_wait_timeout
+        self._condition = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._idle = []  # (connection, returned at), most recent last
+        self._size = 0
+        self._stats = dict.fromkeys(
+            ("created", "closed", "checkouts", "waits", "pings", "in_use"),
+            0)
+
+    def _connect(self):
+        conn = mysql.connect(**self.connect_options)
+        conn.autocommit(False)
+        self._stats["created"] += 1
+        return conn
+
+    def get(self):
+        """
+        Checks out a connection, opening a new one if none is idle and the
+        pool is not full yet.
+        """
+        with self._condition:
+            if self._pid != os.getpid():
+                self._reset()
+
+            deadline = None
+            if self.wait_timeout is not None:
+                deadline = time.time() + self.wait_timeout
+
+            while not self._idle and self._size >= self.max_size:
+                self._stats["waits"] += 1
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeoutError(
+                            "No database connection free after %s seconds"
+                            % self.wait_timeout)
+                self._condition.wait(remaining)
+
+            self._stats["checkouts"] += 1
+            self._stats["in_use"] += 1
+            if self._idle:
+                conn, returned = self._idle.pop()
+            else:
+                conn, returned = None, None
+                self._size += 1
+
+        try:
+            if conn is not None and time.time() - returned > self.ping_after:
+                self._stats["pings"] += 1
+                try:
+                    conn.ping()
+                except mysql.MySQLError:
+                    self._close(conn)
+                    conn = None
+            if conn is None:
+                conn = self._connect()
+        except:
+            # the connection never opened, only its place is given back
+            self._release(None)
+            raise
+        return conn
+
+    def put(self, conn, discard=False):
+        """
+        Returns a connection to the pool, or closes it if `discard` is set
+        because it may be broken.
+        """
+        if self._pid != os.getpid():
+            return
+
+        if discard:
+            self._close(conn)
+            conn = None
+        self._release(conn)
+
+    def _close(self, conn):
+        with self._condition:
+            self._stats["closed"] += 1
+        try:
+            conn.close()
+        except mysql.MySQLError:
+            pass
+
+    def _release(self, conn):
+        with self._condition:
+            self._stats["in_use"] -= 1
+            if conn is None:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.time()))
+            self._close_idle()
+            self._condition.notify()
+
+    def _close_idle(self):
+        # the least recently used connections sit at the front
+        expired = time.time() - self.idle_timeout
+        while (self._idle and self._size > self.min_size and
+               self._idle[0][1] < expired):
+            conn, _ = self._idle.pop(0)
+            self._size -= 1
+            self._stats["closed"] += 1
+            try:
+                conn.close()
+            except mysql.MySQLError:
+                pass
+
+    def pinned(self):
+        """
+        Returns the connection of the calling thread's open transaction, or
+        None.
+        """
+        if self._pid != os.getpid():
+            return None
+        return getattr(self._local, "conn", None)
+
+    @contextmanager
+    def transaction(self):
+        if self.pinned() is not None:
+            # join the enclosing transaction
+            yield
+            return
+
+        conn = self.get()
+        self._local.conn = conn
+        try:
+            try:
+                yield
+            finally:
+                self._local.conn = None
+        except BaseException as err:
+            # an interrupt may have left a query half done on the
+            # connection, so it is not reused
+            broken = (isinstance(err, mysql.OperationalError) or
+                      not isinstance(err, Exception))
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+            self.put(conn, discard=broken)
+            raise
+
+        try:
+            conn.commit()
+        except mysql.MySQLError as err:
+            self.put(conn, discard=isinstance(err, mysql.OperationalError))
+            raise
+        self.put(conn)
+
+    def clear(self):
+        """
+        Forgets all connections without closing them, e.g. after a fork.
+        """
+        with self._condition:
+            self._reset()
+
+    def stats(self):
+        """
+        Returns counters of the pool: open connections (`size`), `idle`
+        and `in_use` ones, and totals of connections `created` and
+        `closed`, `checkouts`, `waits` for a free connection and `pings`.
+        """
+        with self._condition:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            return stats
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class Replica(object):
+    """
+    A read replica of the database, with a connection pool of its own.
+
+    Its health is checked at most every `check_interval` seconds, with a
+    trivial query or, given `max_lag`, by asking how many seconds it lags
+    behind the primary. A replica that is down, lags too far or stopped
+    replicating is skipped until the next check.
+    """
+
+    CHECK = "SELECT 1;"
+    # MySQL 8.0.22 renamed the statement and its lag column, older servers
+    # only know the original names
+    CHECK_LAG = "SHOW REPLICA STATUS;"
+    CHECK_LAG_LEGACY = "SHOW SLAVE STATUS;"
+    LAG_FIELDS = ("Seconds_Behind_Source", "Seconds_Behind_Master")
+
+    def __init__(self, cursor, check_interval=30, max_lag=None,
+                 name="replica"):
+        super(Replica, self).__init__()
+        self.cursor = cursor
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.name = name
+        self.up = True
+        self.next_check = 0
+
+    def healthy(self):
+        now = time.time()
+        if now >= self.next_check:
+            self.next_check = now + self.check_interval
+            try:
+                up, reason = self.check(), "lagging or not replicating"
+            except (mysql.MySQLError, PoolTimeoutError) as err:
+                up, reason = False, err
+            self._set_up(up, reason)
+        return self.up
+
+    def check(self):
+        with self.cursor(cursor_type=DictCursor) as cur:
+            if self.max_lag is None:
+                cur.execute(self.CHECK)
+                return True
+
+            try:
+                cur.execute(self.CHECK_LAG)
+            except mysql.ProgrammingError:
+                cur.execute(self.CHECK_LAG_LEGACY)
+            status = cur.fetchone()
+        if status is None:
+            return False
+        lag = next((status[field] for field in self.LAG_FIELDS
+                    if field in status), None)
+        return lag is not None and lag <= self.max_lag
+
+    def failed(self, err):
+        """
+        Takes the replica out of rotation until its next check.
+        """
+        self.next_check = time.time() + self.check_interval
+        self._set_up(False, err)
+
+    def _set_up(self, up, reason):
+        if self.up and not up:
+            print("Replica %s is down, reading elsewhere: %s"
+                  % (self.name, reason))
+        elif up and not self.up:
+            print("Replica %s is back up" % self.name)
+        self.up = up
+
+
 class Cursor(object):
     """
-    Establishes a connection to the database and returns an open cursor.
+    Checks out a connection from a `ConnectionPool` and returns an open
+    cursor.
 
 
     ```python
@@ -986,41 +2373,71 @@ class Cursor(object):
         cur.execute(query)
     ```
     """
-    _cache = Queue.Queue(maxsize=5)
+    # pools of cursors created without one, by connection options
+    _pools = {}
+    _pools_lock = threading.Lock()
 
-    def __init__(self, cursor_type=mysql.cursors.Cursor, **options):
+    def __init__(self, cursor_type=mysql.cursors.Cursor, pool=None,
+                 **options):
         super(Cursor, self).__init__()
 
-        try:
-            conn = self._cache.get_nowait()
-        except Queue.Empty:
-            conn = mysql.connect(**options)
-        else:
-            # Ping the connection before using it from the cache.
-            conn.ping(True)
+        if pool is None:
+            pool = self._shared_pool(options)
 
-        self.conn = conn
-        self.conn.autocommit(False)
+        self.pool = pool
         self.cursor_type = cursor_type
 
+        # inside a transaction, the transaction commits or rolls back
+        self.transaction_conn = pool.pinned()
+        self.conn = self.transaction_conn or pool.get()
+
+    @classmethod
+    def _shared_pool(cls, options):
+        key = tuple(sorted(options.items()))
+        with cls._pools_lock:
+            if key not in cls._pools:
+                cls._pools[key] = ConnectionPool(options)
+            return cls._pools[key]
+
     @classmethod
     def clear_cache(cls):
-        cls._cache = Queue.Queue(maxsize=5)
+        with cls._pools_lock:
+            for pool in cls._pools.itervalues():
+                pool.clear()
 
     def __enter__(self):
         self.cursor = self.conn.cursor(self.cursor_type)
         return self.cursor
 
     def __exit__(self, extype, exvalue, traceback):
-        # if we had a MySQL related error we try to rollback the cursor.
-        if extype is mysql.MySQLError:
-            self.cursor.rollback()
-
-        self.cursor.close()
-        self.conn.commit()
+        if self.transaction_conn is not None:
+            self.cursor.close()
+            return
+
+        broken = False
+
+        # if we had a MySQL related error or were interrupted we try to
+        # rollback the cursor.
+        if extype is not None and issubclass(extype, mysql.MySQLError):
+            broken = issubclass(extype, mysql.OperationalError)
+            try:
+                self.conn.rollback()
+            except mysql.MySQLError:
+                broken = True
+        elif extype is not None and not issubclass(extype, Exception):
+            broken = True
+            try:
+                self.conn.rollback()
+            except Exception:
+                pass
 
-        # Put it back on the queue
         try:
-            self._cache.put_nowait(self.conn)
-        except Queue.Full:
-            self.conn.close()
+            self.cursor.close()
+            if not broken:
+                self.conn.commit()
+        except mysql.MySQLError:
+            broken = True
+            raise
+        finally:
+            # Put it back in the pool
+            self.pool.put(self.conn, discard=broken)
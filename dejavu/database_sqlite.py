@@ -0,0 +1,499 @@
+from __future__ import absolute_import
+from binascii import hexlify, unhexlify
+from contextlib import contextmanager
+import os
+import sqlite3
+import threading
+import time
+
+from dejavu.database import Database, LeaseLostError
+
+
+class SQLiteDatabase(Database):
+    """
+    An embedded database in a single file, for development, tests and
+    single host deployments that should not depend on a MySQL server.
+
+    The fingerprints table is clustered on (hash, song_id, offset), so a
+    lookup reads one contiguous range of the table per hash and no
+    secondary index has to be maintained on ingest. The file runs in WAL
+    mode: readers never block the writer, and the hashes of a song are
+    written in one transaction, sorted by hash.
+
+    ```python
+    config = {
+        "database_type": "sqlite",
+        "database": {"path": "/var/lib/dejavu/fingerprints.db"},
+    }
+    ```
+    """
+
+    type = "sqlite"
+
+    # tables
+    FINGERPRINTS_TABLENAME = "fingerprints"
+    SONGS_TABLENAME = "songs"
+    ALIASES_TABLENAME = "song_aliases"
+    STOPLIST_TABLENAME = "stop_hashes"
+
+    # fields
+    FIELD_HASH = "hash"
+    FIELD_SONG_ID = "song_id"
+    FIELD_OFFSET = "offset"
+    FIELD_SONGNAME = "song_name"
+    FIELD_FINGERPRINTED = "fingerprinted"
+    FIELD_LEASE_OWNER = "lease_owner"
+    FIELD_LEASE_EXPIRES = "lease_expires"
+    FIELD_ALIAS = "alias_name"
+    FIELD_NUM_SONGS = "num_songs"
+
+    # SQLite limits the number of bound parameters of a statement to 999
+    LOOKUP_BATCH_SIZE = 900
+
+    # creates
+    CREATE_FINGERPRINTS_TABLE = """
+        CREATE TABLE IF NOT EXISTS %s (
+            %s BLOB NOT NULL,
+            %s INTEGER NOT NULL,
+            %s INTEGER NOT NULL,
+        PRIMARY KEY (%s, %s, %s)
+    ) WITHOUT ROWID;""" % (
+        FINGERPRINTS_TABLENAME, FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET,
+        FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET
+    )
+
+    CREATE_SONGS_TABLE = """
+        CREATE TABLE IF NOT EXISTS %s (
+            %s INTEGER PRIMARY KEY AUTOINCREMENT,
+            %s TEXT NOT NULL UNIQUE,
+            %s INTEGER DEFAULT 0,
+            %s TEXT DEFAULT NULL,
+            %s REAL DEFAULT NULL
+    );""" % (
+        SONGS_TABLENAME, FIELD_SONG_ID, FIELD_SONGNAME, FIELD_FINGERPRINTED,
+        FIELD_LEASE_OWNER, FIELD_LEASE_EXPIRES
+    )
+
+    CREATE_ALIASES_TABLE = """
+        CREATE TABLE IF NOT EXISTS %s (
+            %s TEXT PRIMARY KEY,
+            %s INTEGER NOT NULL
+    );""" % (ALIASES_TABLENAME, FIELD_ALIAS, FIELD_SONG_ID)
+
+    # hashes found in so many songs that recognition skips them
+    CREATE_STOPLIST_TABLE = """
+        CREATE TABLE IF NOT EXISTS %s (
+            %s BLOB PRIMARY KEY,
+            %s INTEGER NOT NULL
+    ) WITHOUT ROWID;""" % (STOPLIST_TABLENAME, FIELD_HASH, FIELD_NUM_SONGS)
+
+    # inserts
+    INSERT_FINGERPRINT = """
+        INSERT OR IGNORE INTO %s (%s, %s, %s) VALUES (?, ?, ?);
+    """ % (FINGERPRINTS_TABLENAME, FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET)
+
+    INSERT_SONG = "INSERT INTO %s (%s) VALUES (?);" % (
+        SONGS_TABLENAME, FIELD_SONGNAME)
+
+    INSERT_SONG_LEASE = """
+        INSERT INTO %s (%s, %s, %s) VALUES (?, ?, ?);
+    """ % (SONGS_TABLENAME, FIELD_SONGNAME, FIELD_LEASE_OWNER,
+           FIELD_LEASE_EXPIRES)
+
+    INSERT_ALIAS = """
+        INSERT OR IGNORE INTO %s (%s, %s) VALUES (?, ?);
+    """ % (ALIASES_TABLENAME, FIELD_ALIAS, FIELD_SONG_ID)
+
+    # counts the different songs of every hash found in at least ? songs
+    INSERT_STOPLIST = """
+        INSERT INTO %s (%s, %s)
+        SELECT %s, COUNT(DISTINCT %s) FROM %s
+        GROUP BY %s HAVING COUNT(DISTINCT %s) >= ?;
+    """ % (STOPLIST_TABLENAME, FIELD_HASH, FIELD_NUM_SONGS, FIELD_HASH,
+           FIELD_SONG_ID, FINGERPRINTS_TABLENAME, FIELD_HASH, FIELD_SONG_ID)
+
+    # selects
+    SELECT_MULTIPLE = """
+        SELECT %s, %s, %s FROM %s WHERE %s IN (%%s);
+    """ % (FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET, FINGERPRINTS_TABLENAME,
+           FIELD_HASH)
+
+    SELECT_ALL = """
+        SELECT %s, %s FROM %s;
+    """ % (FIELD_SONG_ID, FIELD_OFFSET, FINGERPRINTS_TABLENAME)
+
+    SELECT_ALL_FINGERPRINTS = """
+        SELECT %s, %s, %s FROM %s;
+    """ % (FIELD_HASH, FIELD_SONG_ID, FIELD_OFFSET, FINGERPRINTS_TABLENAME)
+
+    SELECT_SONG = """
+        SELECT %s FROM %s WHERE %s = ?;
+    """ % (FIELD_SONGNAME, SONGS_TABLENAME, FIELD_SONG_ID)
+
+    SELECT_SONGS = """
+        SELECT %s, %s FROM %s WHERE %s = 1;
+    """ % (FIELD_SONG_ID, FIELD_SONGNAME, SONGS_TABLENAME, FIELD_FINGERPRINTED)
+
+    SELECT_SONG_LEASE = """
+        SELECT %s, %s, %s, %s FROM %s WHERE %s = ?;
+    """ % (FIELD_SONG_ID, FIELD_FINGERPRINTED, FIELD_LEASE_OWNER,
+           FIELD_LEASE_EXPIRES, SONGS_TABLENAME, FIELD_SONGNAME)
+
+    SELECT_ALIASES = """
+        SELECT %s, %s FROM %s;
+    """ % (FIELD_ALIAS, FIELD_SONG_ID, ALIASES_TABLENAME)
+
+    SELECT_STOP_HASHES = """
+        SELECT %s FROM %s;
+    """ % (FIELD_HASH, STOPLIST_TABLENAME)
+
+    SELECT_NUM_FINGERPRINTS = """
+        SELECT COUNT(*) FROM %s;
+    """ % FINGERPRINTS_TABLENAME
+
+    SELECT_UNIQUE_SONG_IDS = """
+        SELECT COUNT(*) FROM %s WHERE %s = 1;
+    """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED)
+
+    # updates
+    # only while the caller still holds the lease, NULL for unclaimed songs
+    UPDATE_SONG_FINGERPRINTED = """
+        UPDATE %s SET %s = 1, %s = NULL, %s = NULL
+        WHERE %s = ? AND %s IS ?;
+    """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED, FIELD_LEASE_OWNER,
+           FIELD_LEASE_EXPIRES, FIELD_SONG_ID, FIELD_LEASE_OWNER)
+
+    UPDATE_LEASE = """
+        UPDATE %s SET %s = ?, %s = ? WHERE %s = ?;
+    """ % (SONGS_TABLENAME, FIELD_LEASE_OWNER, FIELD_LEASE_EXPIRES,
+           FIELD_SONG_ID)
+
+    UPDATE_LEASES = """
+        UPDATE %s SET %s = ? WHERE %s = ? AND %s = 0;
+    """ % (SONGS_TABLENAME, FIELD_LEASE_EXPIRES, FIELD_LEASE_OWNER,
+           FIELD_FINGERPRINTED)
+
+    # deletes
+    DELETE_UNFINGERPRINTED = """
+        DELETE FROM %s WHERE %s = 0 AND (%s IS NULL OR %s < ?);
+    """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED, FIELD_LEASE_EXPIRES,
+           FIELD_LEASE_EXPIRES)
+
+    # the table is clustered by hash, deleting a song scans it
+    DELETE_SONG_FINGERPRINTS = """
+        DELETE FROM %s WHERE %s = ?;
+    """ % (FINGERPRINTS_TABLENAME, FIELD_SONG_ID)
+
+    DELETE_ORPHAN_FINGERPRINTS = """
+        DELETE FROM %s WHERE %s NOT IN (SELECT %s FROM %s);
+    """ % (FINGERPRINTS_TABLENAME, FIELD_SONG_ID, FIELD_SONG_ID,
+           SONGS_TABLENAME)
+
+    DELETE_SONG = """
+        DELETE FROM %s WHERE %s = ?;
+    """ % (SONGS_TABLENAME, FIELD_SONG_ID)
+
+    DELETE_LEASED_SONG = """
+        DELETE FROM %s WHERE %s = ? AND %s = 0 AND %s IS ?;
+    """ % (SONGS_TABLENAME, FIELD_SONG_ID, FIELD_FINGERPRINTED,
+           FIELD_LEASE_OWNER)
+
+    DELETE_SONG_ALIASES = """
+        DELETE FROM %s WHERE %s = ?;
+    """ % (ALIASES_TABLENAME, FIELD_SONG_ID)
+
+    def __init__(self, path="dejavu.db", cache_size_mb=64, timeout=30,
+                 synchronous="NORMAL", fingerprints_only=False):
+        super(SQLiteDatabase, self).__init__()
+        self.path = path
+        self.cache_size_mb = int(cache_size_mb)
+        self.timeout = float(timeout)
+        self.synchronous = synchronous
+        # only store fingerprints, songs are kept by another database
+        self.fingerprints_only = fingerprints_only
+        self._local = threading.local()
+
+    def _connection(self):
+        # one connection per thread and process
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL;")
+            conn.execute("PRAGMA synchronous = %s;" % self.synchronous)
+            conn.execute("PRAGMA cache_size = -%d;" %
+                         (self.cache_size_mb * 1024))
+            conn.execute("PRAGMA temp_store = MEMORY;")
+            local.conn = conn
+            local.pid = os.getpid()
+            local.depth = 0
+        return local.conn
+
+    @contextmanager
+    def cursor(self):
+        cur = self._connection().cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the block in one write transaction, committed when the block
+        is left or rolled back on an error. Nested blocks join the outer
+        transaction.
+        """
+        conn = self._connection()
+        local = self._local
+        if local.depth:
+            local.depth += 1
+            try:
+                yield
+            finally:
+                local.depth -= 1
+            return
+
+        # take the write lock up front, so two writers never deadlock
+        # upgrading their read locks
+        conn.execute("BEGIN IMMEDIATE;")
+        local.depth = 1
+        try:
+            yield
+        except:
+            local.depth = 0
+            conn.execute("ROLLBACK;")
+            raise
+        local.depth = 0
+        conn.execute("COMMIT;")
+
+    def setup(self):
+        """
+        Creates any non-existing tables required for dejavu to function.
+
+        This also removes all songs that have been added but have no
+        fingerprints associated with them.
+        """
+        with self.transaction():
+            with self.cursor() as cur:
+                cur.execute(self.CREATE_SONGS_TABLE)
+                cur.execute(self.CREATE_FINGERPRINTS_TABLE)
+                cur.execute(self.CREATE_ALIASES_TABLE)
+                cur.execute(self.CREATE_STOPLIST_TABLE)
+        self.delete_unfingerprinted_songs()
+
+    def empty(self):
+        """
+        Removes all songs, aliases and fingerprints from the database.
+        """
+        with self.transaction():
+            with self.cursor() as cur:
+                cur.execute("DELETE FROM %s;" % self.FINGERPRINTS_TABLENAME)
+                cur.execute("DELETE FROM %s;" % self.STOPLIST_TABLENAME)
+                cur.execute("DELETE FROM %s;" % self.ALIASES_TABLENAME)
+                cur.execute("DELETE FROM %s;" % self.SONGS_TABLENAME)
+
+    def delete_unfingerprinted_songs(self):
+        """
+        Removes all songs that have no fingerprints associated with them
+        and whose lease has run out.
+        """
+        if self.fingerprints_only:
+            # every fingerprint would look orphaned
+            return
+
+        with self.transaction():
+            with self.cursor() as cur:
+                cur.execute(self.DELETE_UNFINGERPRINTED, (time.time(),))
+                if cur.rowcount:
+                    cur.execute(self.DELETE_ORPHAN_FINGERPRINTS)
+
+    def delete_song(self, sid):
+        """
+        Removes a song, its aliases and its fingerprints.
+        """
+        with self.transaction():
+            with self.cursor() as cur:
+                cur.execute(self.DELETE_SONG_FINGERPRINTS, (sid,))
+                cur.execute(self.DELETE_SONG_ALIASES, (sid,))
+                cur.execute(self.DELETE_SONG, (sid,))
+
+    def get_num_songs(self):
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_UNIQUE_SONG_IDS)
+            return cur.fetchone()[0]
+
+    def get_num_fingerprints(self):
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_NUM_FINGERPRINTS)
+            return cur.fetchone()[0]
+
+    def set_song_fingerprinted(self, sid, owner=None):
+        with self.cursor() as cur:
+            cur.execute(self.UPDATE_SONG_FINGERPRINTED, (sid, owner))
+            if owner is not None and not cur.rowcount:
+                raise LeaseLostError("Song %d is no longer leased by %s"
+                                     % (sid, owner))
+
+    def get_songs(self):
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_SONGS)
+            for sid, song_name in cur:
+                yield {self.FIELD_SONG_ID: sid, self.FIELD_SONGNAME: song_name}
+
+    def get_song_by_id(self, sid):
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_SONG, (sid,))
+            row = cur.fetchone()
+            return {self.FIELD_SONGNAME: row[0]} if row else None
+
+    def get_aliases(self):
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_ALIASES)
+            return cur.fetchall()
+
+    def get_stop_hashes(self):
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_STOP_HASHES)
+            return [hexlify(hash) for hash, in cur]
+
+    def build_stoplist(self, min_songs):
+        """
+        Replaces the stop-list in one transaction, which scans the whole
+        fingerprints table and blocks ingest meanwhile.
+        """
+        with self.transaction():
+            with self.cursor() as cur:
+                cur.execute("DELETE FROM %s;" % self.STOPLIST_TABLENAME)
+                cur.execute(self.INSERT_STOPLIST, (min_songs,))
+                return cur.rowcount
+
+    def insert_alias(self, alias_name, sid):
+        with self.cursor() as cur:
+            cur.execute(self.INSERT_ALIAS, (alias_name, sid))
+
+    def insert(self, hash, sid, offset):
+        self.insert_hashes(sid, [(hash, offset)])
+
+    def insert_song(self, song_name):
+        with self.cursor() as cur:
+            cur.execute(self.INSERT_SONG, (song_name,))
+            return cur.lastrowid
+
+    def claim_song(self, song_name, owner, ttl):
+        """
+        Inserts or takes over the song row for `song_name` on behalf of
+        `owner`, leased for `ttl` seconds. Returns the song ID, or None
+        when the song is fingerprinted already or leased by someone else.
+        """
+        now = time.time()
+        with self.transaction():
+            with self.cursor() as cur:
+                cur.execute(self.SELECT_SONG_LEASE, (song_name,))
+                row = cur.fetchone()
+                if row is None:
+                    cur.execute(self.INSERT_SONG_LEASE,
+                                (song_name, owner, now + ttl))
+                    return cur.lastrowid
+
+                sid, fingerprinted, lease_owner, lease_expires = row
+                if fingerprinted or (lease_owner not in (None, owner) and
+                                     lease_expires >= now):
+                    return None
+                cur.execute(self.UPDATE_LEASE, (owner, now + ttl, sid))
+                return sid
+
+    def renew_leases(self, owner, ttl):
+        with self.cursor() as cur:
+            cur.execute(self.UPDATE_LEASES, (time.time() + ttl, owner))
+
+    def release_song(self, sid, owner=None):
+        """
+        Removes a claimed song that could not be fingerprinted, together
+        with any fingerprints already written for it, unless it has been
+        fingerprinted or leased by another owner meanwhile.
+        """
+        if self.fingerprints_only:
+            self.delete_song(sid)
+            return True
+
+        with self.transaction():
+            with self.cursor() as cur:
+                cur.execute(self.DELETE_LEASED_SONG, (sid, owner))
+                if not cur.rowcount:
+                    return False
+                cur.execute(self.DELETE_SONG_FINGERPRINTS, (sid,))
+                return True
+
+    def query(self, hash):
+        for _, sid, offset in self.lookup_hashes([hash]):
+            yield (sid, offset)
+
+    def get_iterable_kv_pairs(self):
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_ALL)
+            for sid, offset in cur:
+                yield (sid, offset)
+
+    def iter_fingerprints(self):
+        with self.cursor() as cur:
+            cur.execute(self.SELECT_ALL_FINGERPRINTS)
+            for hash, sid, offset in cur:
+                yield (hexlify(hash), sid, offset)
+
+    def insert_hashes(self, sid, hashes):
+        """
+        Inserts the fingerprints of a song in one transaction, in hash
+        order so every insert lands next to the previous one.
+        """
+        self.insert_many_hashes([(sid, hashes)])
+
+    def insert_many_hashes(self, songs):
+        """
+        Inserts the fingerprints of several songs in one transaction,
+        sorted by hash across all of them.
+        """
+        rows = sorted((buffer(unhexlify(hash)), sid, offset)
+                      for sid, hashes in songs for hash, offset in hashes)
+        with self.transaction():
+            with self.cursor() as cur:
+                cur.executemany(self.INSERT_FINGERPRINT, rows)
+
+    def lookup_hashes(self, hashes):
+        """
+        Returns all fingerprints whose hash is one of `hashes`, as
+        (hash, sid, offset) tuples with the hashes given as passed in.
+        """
+        keys = dict((unhexlify(hash), hash) for hash in set(hashes))
+        values = sorted(keys)
+
+        with self.cursor() as cur:
+            for start in xrange(0, len(values), self.LOOKUP_BATCH_SIZE):
+                batch = values[start:start + self.LOOKUP_BATCH_SIZE]
+                cur.execute(self.SELECT_MULTIPLE %
+                            ", ".join("?" * len(batch)),
+                            [buffer(key) for key in batch])
+                for key, sid, offset in cur:
+                    yield (keys[str(key)], sid, offset)
+
+    def return_matches(self, hashes):
+        """
+        Returns (sid, offset_difference) for every stored fingerprint
+        sharing a hash with `hashes`.
+        """
+        offsets = {}
+        for hash, offset in hashes:
+            offsets.setdefault(hash, []).append(offset)
+
+        for hash, sid, db_offset in self.lookup_hashes(offsets):
+            for offset in offsets[hash]:
+                yield (sid, db_offset - offset)
+
+    def __getstate__(self):
+        return (self.path, self.cache_size_mb, self.timeout, self.synchronous,
+                self.fingerprints_only)
+
+    def __setstate__(self, state):
+        (self.path, self.cache_size_mb, self.timeout,
+         self.synchronous, self.fingerprints_only) = state
+        self._local = threading.local()
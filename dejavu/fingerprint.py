@@ -1,11 +1,10 @@
 import numpy as np
 import matplotlib.mlab as mlab
 import matplotlib.pyplot as plt
-from scipy.ndimage.filters import maximum_filter
 from scipy.ndimage.morphology import (generate_binary_structure,
-                                      iterate_structure, binary_erosion)
+                                      iterate_structure)
 import hashlib
-from operator import itemgetter
+from itertools import izip
 
 IDX_FREQ_I = 0
 IDX_TIME_J = 1
@@ -61,6 +60,34 @@ PEAK_SORT = True
 # potentially higher collisions and misclassifications when identifying songs.
 FINGERPRINT_REDUCTION = 20
 
+######################################################################
+# Filter structures that only depend on the settings above. They are
+# built once per process (see `dejavu.workers`) instead of on every call.
+PEAK_NEIGHBORHOOD = iterate_structure(generate_binary_structure(2, 1),
+                                      PEAK_NEIGHBORHOOD_SIZE)
+_WINDOWS = {}
+
+
+def get_window(wsize=DEFAULT_WINDOW_SIZE):
+    """
+    Returns the (cached) Hanning window used for an FFT of size `wsize`.
+    """
+    try:
+        return _WINDOWS[wsize]
+    except KeyError:
+        window = _WINDOWS[wsize] = mlab.window_hanning(np.ones(wsize))
+        return window
+
+
+def warm_up():
+    """
+    Builds the cached filter structures for the default settings so the
+    first fingerprint computed by a worker does not pay for them.
+    """
+    get_window(DEFAULT_WINDOW_SIZE)
+    return PEAK_NEIGHBORHOOD
+
+
 def fingerprint(channel_samples, Fs=DEFAULT_FS,
                 wsize=DEFAULT_WINDOW_SIZE,
                 wratio=DEFAULT_OVERLAP_RATIO,
@@ -70,51 +97,211 @@ def fingerprint(channel_samples, Fs=DEFAULT_FS,
     FFT the channel, log transform output, find local maxima, then return
     locally sensitive hashes.
     """
+    arr2D = spectrogram(channel_samples, Fs=Fs, wsize=wsize, wratio=wratio)
+
+    # find local maxima
+    local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min)
+
+    # return hashes
+    return generate_hashes(local_maxima, fan_value=fan_value)
+
+
+def spectrogram(channel_samples, Fs=DEFAULT_FS,
+                wsize=DEFAULT_WINDOW_SIZE,
+                wratio=DEFAULT_OVERLAP_RATIO):
+    """
+    Returns the log scaled spectrogram of the channel, one column per
+    frame of `wsize` samples.
+    """
     # FFT the signal and extract frequency components
     arr2D = mlab.specgram(
         channel_samples,
         NFFT=wsize,
         Fs=Fs,
-        window=mlab.window_hanning,
+        window=get_window(wsize),
         noverlap=int(wsize * wratio))[0]
 
     # apply log transform since specgram() returns linear array
     arr2D = 10 * np.log10(arr2D)
     arr2D[arr2D == -np.inf] = 0  # replace infs with zeros
+    return arr2D
 
-    # find local maxima
-    local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min)
 
-    # return hashes
-    return generate_hashes(local_maxima, fan_value=fan_value)
+class NeighborhoodFilter(object):
+    """
+    Applies `ufunc` over PEAK_NEIGHBORHOOD to spectrogram columns given in
+    time order, in one piece or several. The diamond is built up as
+    PEAK_NEIGHBORHOOD_SIZE rounds of a 3x3 cross, so each round only keeps
+    the column before and the last column it has not finished; the output
+    lags the input by that many columns until the `final` piece. Cells
+    outside the spectrogram are left out, which gives the same results as
+    `maximum_filter` in its default mode for `np.maximum` and as
+    `binary_erosion` with `border_value=1` for `np.logical_and`.
+    """
 
+    def __init__(self, ufunc, rounds=PEAK_NEIGHBORHOOD_SIZE):
+        self.ufunc = ufunc
+        self.before = [None] * rounds  # column before the held one
+        self.held = [None] * rounds    # column waiting for its successor
 
-def get_2D_peaks(arr2D, plot=False, amp_min=DEFAULT_AMP_MIN):
-    # http://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.morphology.iterate_structure.html#scipy.ndimage.morphology.iterate_structure
-    struct = generate_binary_structure(2, 1)
-    neighborhood = iterate_structure(struct, PEAK_NEIGHBORHOOD_SIZE)
+    def filter(self, columns, final=False):
+        for k in xrange(len(self.held)):
+            if self.held[k] is not None:
+                columns = np.hstack((self.held[k], columns))
+            done = columns.shape[1] if final else columns.shape[1] - 1
+            if done <= 0:
+                self.held[k] = columns if done == 0 else None
+                columns = columns[:, :0]
+                continue
 
-    # find local maxima using our fliter shape
-    local_max = maximum_filter(arr2D, footprint=neighborhood) == arr2D
-    background = (arr2D == 0)
-    eroded_background = binary_erosion(background, structure=neighborhood,
-                                       border_value=1)
+            after = None if final else columns[:, done]
+            self.held[k] = None if final else columns[:, done:]
+            columns, self.before[k] = (
+                self._cross(columns[:, :done], self.before[k], after),
+                columns[:, done - 1])
+        return columns
+
+    def _cross(self, columns, before, after):
+        ufunc = self.ufunc
+        out = columns.copy()
+        ufunc(out[1:], columns[:-1], out[1:])
+        ufunc(out[:-1], columns[1:], out[:-1])
+        ufunc(out[:, 1:], columns[:, :-1], out[:, 1:])
+        ufunc(out[:, :-1], columns[:, 1:], out[:, :-1])
+        if before is not None:
+            ufunc(out[:, 0], before, out[:, 0])
+        if after is not None:
+            ufunc(out[:, -1], after, out[:, -1])
+        return out
+
+
+class ChannelFingerprinter(object):
+    """
+    Fingerprints a channel that arrives in pieces, e.g. while recognizing
+    a clip incrementally. Together the hashes returned by `feed` are the
+    ones `fingerprint` returns for the whole channel, and every sample is
+    transformed, filtered for peaks and paired only once: the filters keep
+    their state between pieces, and a peak is only paired once all the
+    peaks it can pair with are known.
+    """
+
+    def __init__(self, Fs=DEFAULT_FS,
+                 wsize=DEFAULT_WINDOW_SIZE,
+                 wratio=DEFAULT_OVERLAP_RATIO,
+                 fan_value=DEFAULT_FAN_VALUE,
+                 amp_min=DEFAULT_AMP_MIN):
+        self.Fs = Fs
+        self.wsize = wsize
+        self.wratio = wratio
+        self.fan_value = fan_value
+        self.amp_min = amp_min
+        self.hop = wsize - int(wsize * wratio)
+
+        self.samples = np.zeros(0)  # not yet covered by a whole frame
+        self.frames = 0             # spectrogram columns computed so far
+        self.columns = None         # the ones still in the filters
+        self.maxima = NeighborhoodFilter(np.maximum)
+        self.background = NeighborhoodFilter(np.logical_and)
+        self.peaks_done = 0         # frames whose peaks are all known
+        self.peaks = np.zeros((0, 2), dtype=np.int64)  # not yet anchors
+
+    def feed(self, samples, final=False):
+        """
+        Adds the next samples of the channel and returns the hashes whose
+        anchor peak is now paired, with offsets from the channel start.
+        `final` marks the last piece, flushing everything that is left.
+        """
+        self._add_peaks(self._add_columns(samples, final), final)
+
+        # an anchor is paired with the (fan_value - 1) peaks after it that
+        # are at most MAX_HASH_TIME_DELTA frames later, so it is done when
+        # they are all known or the frames up to that delta are
+        if final:
+            anchors = len(self.peaks)
+        else:
+            anchors = max(
+                len(self.peaks) - max(self.fan_value - 1, 0),
+                np.searchsorted(self.peaks[:, IDX_TIME_J],
+                                self.peaks_done - MAX_HASH_TIME_DELTA))
+        hashes = list(generate_hashes(self.peaks, fan_value=self.fan_value,
+                                      anchors=anchors))
+        self.peaks = self.peaks[anchors:]
+        return hashes
+
+    def _add_columns(self, samples, final):
+        self.samples = np.concatenate((self.samples, samples))
+        frames = max(0, (len(self.samples) - self.wsize) // self.hop + 1)
+        if final and not self.frames and not frames:
+            # a channel shorter than a frame is padded to one, as a whole
+            arr2D = spectrogram(self.samples, Fs=self.Fs, wsize=self.wsize,
+                                wratio=self.wratio)
+            self.samples = self.samples[:0]
+        elif frames:
+            arr2D = spectrogram(
+                self.samples[:(frames - 1) * self.hop + self.wsize],
+                Fs=self.Fs, wsize=self.wsize, wratio=self.wratio)
+            self.samples = self.samples[frames * self.hop:]
+        else:
+            return None
+
+        self.frames += arr2D.shape[1]
+        if self.columns is None:
+            self.columns = arr2D
+        else:
+            self.columns = np.hstack((self.columns, arr2D))
+        return arr2D
+
+    def _add_peaks(self, arr2D, final):
+        if arr2D is None:
+            if not final or self.columns is None:
+                return
+            arr2D = self.columns[:, :0]
 
+        local_max = self.maxima.filter(arr2D, final)
+        eroded_background = self.background.filter(arr2D == 0, final)
+        done = local_max.shape[1]
+        columns, self.columns = (self.columns[:, :done],
+                                 self.columns[:, done:])
+
+        frequency_idx, time_idx = find_peaks(
+            columns, local_max == columns, eroded_background, self.amp_min)
+        peaks = np.column_stack((frequency_idx, time_idx + self.peaks_done))
+        peaks = peaks[np.argsort(peaks[:, IDX_TIME_J], kind="mergesort")]
+        self.peaks = np.concatenate((self.peaks, peaks.astype(np.int64)))
+        self.peaks_done += done
+
+
+def find_peaks(arr2D, local_max, eroded_background,
+               amp_min=DEFAULT_AMP_MIN):
+    """
+    Returns the frequency and time indexes of the peaks louder than
+    `amp_min`, given where the spectrogram equals its neighborhood maximum
+    and where it is silent throughout the neighborhood.
+    """
     # Boolean mask of arr2D with True at peaks
-    detected_peaks = local_max - eroded_background
+    detected_peaks = local_max ^ eroded_background
 
     # extract peaks
     amps = arr2D[detected_peaks]
     j, i = np.where(detected_peaks)
 
     # filter peaks
-    amps = amps.flatten()
-    peaks = zip(i, j, amps)
-    peaks_filtered = [x for x in peaks if x[2] > amp_min]  # freq, time, amp
+    loud = amps > amp_min
+    return j[loud], i[loud]
+
+
+def get_2D_peaks(arr2D, plot=False, amp_min=DEFAULT_AMP_MIN):
+    # find local maxima using our filter shape
+    local_max = NeighborhoodFilter(np.maximum).filter(arr2D, final=True)
+    background = (arr2D == 0)
+    eroded_background = NeighborhoodFilter(np.logical_and).filter(
+        background, final=True)
 
     # get indices for frequency and time
-    frequency_idx = [x[1] for x in peaks_filtered]
-    time_idx = [x[0] for x in peaks_filtered]
+    frequency_idx, time_idx = find_peaks(arr2D, local_max == arr2D,
+                                         eroded_background, amp_min)
+    frequency_idx = frequency_idx.tolist()
+    time_idx = time_idx.tolist()
 
     if plot:
         # scatter of the peaks
@@ -130,32 +317,38 @@ def get_2D_peaks(arr2D, plot=False, amp_min=DEFAULT_AMP_MIN):
     return zip(frequency_idx, time_idx)
 
 
-def generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE):
+def generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE, anchors=None):
     """
     Hash list structure:
        sha1_hash[0:20]    time_offset
     [(e05b341a9b77a51fd26, 32), ... ]
-    """
-    fingerprinted = set()  # to avoid rehashing same pairs
 
+    Pairing the peaks is done with numpy so that only the sha1 itself runs
+    as Python code while holding the GIL. With `anchors`, only that many
+    of the first peaks are paired with the ones following them.
+    """
+    peaks = np.asarray(peaks, dtype=np.int64).reshape(-1, 2)
     if PEAK_SORT:
-        peaks.sort(key=itemgetter(1))
-
-    for i in range(len(peaks)):
-        for j in range(1, fan_value):
-            if (i + j) < len(peaks) and not (i, i + j) in fingerprinted:
-                freq1 = peaks[i][IDX_FREQ_I]
-                freq2 = peaks[i + j][IDX_FREQ_I]
-
-                t1 = peaks[i][IDX_TIME_J]
-                t2 = peaks[i + j][IDX_TIME_J]
+        peaks = peaks[np.argsort(peaks[:, IDX_TIME_J], kind="mergesort")]
 
-                t_delta = t2 - t1
+    # every peak i is paired with the (fan_value - 1) peaks following it
+    npeaks = len(peaks)
+    if anchors is None:
+        anchors = npeaks
+    anchors = min(anchors, npeaks)
+    first = np.repeat(np.arange(anchors), max(fan_value - 1, 0))
+    second = first + np.tile(np.arange(1, fan_value), anchors)
+    paired = second < npeaks
+    first, second = first[paired], second[paired]
 
-                if t_delta >= MIN_HASH_TIME_DELTA and t_delta <= MAX_HASH_TIME_DELTA:
-                    h = hashlib.sha1(
-                        "%s|%s|%s" % (str(freq1), str(freq2), str(t_delta)))
-                    yield (h.hexdigest()[0:FINGERPRINT_REDUCTION], t1)
+    t1 = peaks[first, IDX_TIME_J]
+    t_delta = peaks[second, IDX_TIME_J] - t1
+    valid = (t_delta >= MIN_HASH_TIME_DELTA) & (t_delta <= MAX_HASH_TIME_DELTA)
 
-                # ensure we don't repeat hashing
-                fingerprinted.add((i, i + j))
+    sha1 = hashlib.sha1
+    for freq1, freq2, delta, offset in izip(
+            peaks[first[valid], IDX_FREQ_I].tolist(),
+            peaks[second[valid], IDX_FREQ_I].tolist(),
+            t_delta[valid].tolist(), t1[valid].tolist()):
+        h = sha1("%d|%d|%d" % (freq1, freq2, delta))
+        yield (h.hexdigest()[0:FINGERPRINT_REDUCTION], offset)
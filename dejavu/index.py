@@ -0,0 +1,287 @@
+"""
+Immutable, memory-mapped fingerprint index files.
+
+An index file holds every distinct hash once, sorted, and next to it the
+postings of that hash: the (song_id, offset) pairs it occurs at. Postings
+are sorted by song and offset and stored as variable length deltas, which
+takes a few bytes per fingerprint instead of a MySQL row and its index
+entries.
+
+Layout, all integers little endian:
+
+    header     magic, version, counts and the position of every section
+    keys       n_keys hashes of 10 bytes, sorted
+    starts     n_keys + 1 int64, byte position of the postings of every key
+    data       varint encoded (song_id delta, offset) pairs
+    meta       JSON with the songs and aliases of the catalog
+
+Files are opened with `mmap`, so every process serving the same file
+shares one copy in the page cache and opening it costs next to nothing.
+"""
+from __future__ import absolute_import
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from dejavu.database_memory import HASH_DTYPE, hash_keys
+
+MAGIC = "DJVINDEX"
+VERSION = 1
+
+# magic, version, n_keys, n_postings, then (position, length) of the keys,
+# starts, data and meta sections
+HEADER = struct.Struct("<8sIxxxxQQ8Q")
+ALIGNMENT = 8
+
+KEY_SIZE = np.dtype(HASH_DTYPE).itemsize
+
+
+def expand_ranges(starts, counts):
+    """
+    Returns, for consecutive ranges given by their `starts` and `counts`,
+    the range every element belongs to and the element positions.
+    """
+    total = counts.sum()
+    which = np.repeat(np.arange(len(starts)), counts)
+    within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    return which, starts[which] + within
+
+
+def segmented_cumsum(values, resets):
+    """
+    Cumulative sum of `values` that starts over wherever `resets` is set.
+    The first element must be a reset.
+    """
+    sums = np.cumsum(values)
+    firsts = np.flatnonzero(resets)
+    bases = sums[firsts] - values[firsts]
+    return sums - bases[np.cumsum(resets) - 1]
+
+
+def encode_varints(values):
+    """
+    LEB128 encodes non-negative integers into a uint8 array.
+    """
+    values = values.astype(np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        nbytes += rest > 0
+        rest >>= np.uint64(7)
+
+    which, positions = expand_ranges(np.zeros(len(values), dtype=np.int64),
+                                     nbytes)
+    shifts = (positions * 7).astype(np.uint64)
+    encoded = ((values[which] >> shifts) & np.uint64(0x7f)).astype(np.uint8)
+    # every byte but the last of a value has the high bit set
+    encoded[positions < nbytes[which] - 1] |= 0x80
+    return encoded
+
+
+def decode_varints(data):
+    """
+    Decodes a uint8 array of LEB128 encoded integers.
+    """
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    which = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = (np.arange(len(data)) - starts[which]) * 7
+    # offsets and song ids fit well within a float64 mantissa
+    parts = (data & 0x7f).astype(np.float64) * np.exp2(shifts)
+    return np.bincount(which, parts, len(ends)).astype(np.int64)
+
+
+def encode_postings(keys, sids, offsets):
+    """
+    Encodes postings sorted by (key, sid, offset). The first posting of a
+    key stores its song id as is, later ones the difference to the previous
+    song id; offsets are stored as the difference to the previous offset of
+    the same song.
+    """
+    new_key = np.ones(len(keys), dtype=bool)
+    new_key[1:] = keys[1:] != keys[:-1]
+    new_song = new_key.copy()
+    new_song[1:] |= sids[1:] != sids[:-1]
+
+    sid_deltas = np.where(new_key, sids, sids - np.roll(sids, 1))
+    offset_deltas = np.where(new_song, offsets, offsets - np.roll(offsets, 1))
+
+    pairs = np.empty(2 * len(keys), dtype=np.int64)
+    pairs[0::2] = sid_deltas
+    pairs[1::2] = offset_deltas
+    encoded = encode_varints(pairs)
+
+    # byte position at which the postings of each key begin
+    sizes = np.zeros(len(encoded) + 1, dtype=np.int64)
+    sizes[1:] = np.cumsum(encoded < 0x80)
+    first_values = 2 * np.flatnonzero(new_key)
+    value_starts = np.searchsorted(sizes, first_values, side="left")
+    return new_key, value_starts, encoded
+
+
+def fsync_directory(path):
+    """
+    Makes a rename into the directory of `path` survive a crash.
+    """
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_index(path, keys, sids, offsets, songs=(), aliases=()):
+    """
+    Writes an index file of the fingerprints given as parallel arrays of
+    10 byte hash keys, song ids and offsets. `songs` are (sid, song_name)
+    and `aliases` (alias_name, sid) pairs.
+
+    The file is written next to `path`, synced to disk and moved into
+    place when complete, so readers never see a partial index, not even
+    after a crash.
+    """
+    order = np.lexsort((offsets, sids, keys))
+    keys, sids, offsets = keys[order], sids[order], offsets[order]
+
+    new_key, byte_starts, data = encode_postings(keys, sids, offsets)
+    unique_keys = keys[new_key]
+    starts = np.append(byte_starts, len(data)).astype(np.int64)
+    meta = json.dumps({"songs": list(songs), "aliases": list(aliases)})
+
+    sections = [unique_keys.astype(HASH_DTYPE).tostring(), starts.tostring(),
+                data.tostring(), meta]
+
+    layout = []
+    position = HEADER.size
+    for section in sections:
+        position += -position % ALIGNMENT
+        layout.extend((position, len(section)))
+        position += len(section)
+
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(unique_keys), len(keys),
+                            *layout))
+        for section, section_position in zip(sections, layout[0::2]):
+            f.write("\0" * (section_position - f.tell()))
+            f.write(section)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, path)
+    fsync_directory(path)
+
+
+def build_index(path, database):
+    """
+    Writes the songs, aliases and fingerprints of any database supporting
+    `iter_fingerprints` to an index file.
+    """
+    hashes, sids, offsets = [], [], []
+    for hash, sid, offset in database.iter_fingerprints():
+        hashes.append(hash)
+        sids.append(sid)
+        offsets.append(offset)
+
+    songs = [(song[database.FIELD_SONG_ID], song[database.FIELD_SONGNAME])
+             for song in database.get_songs()]
+    write_index(path, hash_keys(hashes), np.array(sids, dtype=np.int64),
+                np.array(offsets, dtype=np.int64), songs,
+                list(database.get_aliases()))
+
+
+class IndexFile(object):
+    """
+    Read-only view of an index file.
+
+    ```python
+    index = IndexFile("fingerprints.idx")
+    which, sids, offsets = index.lookup(hash_keys(hashes))
+    ```
+    """
+
+    def __init__(self, path):
+        super(IndexFile, self).__init__()
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = HEADER.unpack_from(self._map)
+        magic, version, self.n_keys, self.n_postings = header[:4]
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %d dejavu index"
+                             % (path, VERSION))
+
+        buf = np.frombuffer(self._map, dtype=np.uint8)
+        sections = [buf[position:position + length] for position, length
+                    in zip(header[4::2], header[5::2])]
+        self.keys = sections[0].view(HASH_DTYPE)
+        self.starts = sections[1].view(np.int64)
+        self.data = sections[2]
+
+        meta = json.loads(sections[3].tostring())
+        self.songs = [tuple(song) for song in meta["songs"]]
+        self.song_names = dict(self.songs)
+        self.aliases = [tuple(alias) for alias in meta["aliases"]]
+
+    def __len__(self):
+        return self.n_postings
+
+    def lookup(self, keys):
+        """
+        Finds the postings of an array of hash keys.
+
+        Returns the index into `keys` every posting belongs to, and the
+        song ids and offsets of the postings.
+        """
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == keys[found]
+        return self._decode(np.flatnonzero(found), positions[found])
+
+    def _decode(self, which, positions):
+        if not len(positions):
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+
+        byte_starts = self.starts[positions]
+        byte_counts = self.starts[positions + 1] - byte_starts
+        byte_which, byte_positions = expand_ranges(byte_starts, byte_counts)
+        data = self.data[byte_positions]
+        values = decode_varints(data)
+
+        # postings per key, from the number of values that end in its bytes
+        counts = np.bincount(byte_which[data < 0x80],
+                             minlength=len(positions)) // 2
+        sid_deltas, offset_deltas = values[0::2], values[1::2]
+
+        new_key = np.zeros(len(sid_deltas), dtype=bool)
+        new_key[np.cumsum(counts) - counts] = True
+        sids = segmented_cumsum(sid_deltas, new_key)
+        offsets = segmented_cumsum(offset_deltas, new_key | (sid_deltas != 0))
+        return np.repeat(which, counts), sids, offsets
+
+    def postings(self):
+        """
+        Decodes the whole index into parallel arrays of hash keys, song ids
+        and offsets, sorted by hash.
+        """
+        positions = np.arange(len(self.keys))
+        which, sids, offsets = self._decode(positions, positions)
+        return self.keys[which], sids, offsets
+
+    def __iter__(self):
+        """
+        Yields all (hash, sid, offset) postings in hash order, with hashes
+        in hexadecimal format.
+        """
+        keys, sids, offsets = self.postings()
+        for key, sid, offset in zip(keys, sids.tolist(), offsets.tolist()):
+            yield key.ljust(KEY_SIZE, "\0").encode("hex"), sid, offset
+
+    def close(self):
+        # the arrays point into the map, drop them first
+        self.keys = self.starts = self.data = None
+        self._map.close()
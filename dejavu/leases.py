@@ -0,0 +1,66 @@
+import os
+import socket
+import threading
+
+# seconds a claimed song stays reserved without a heartbeat
+DEFAULT_LEASE_TTL = 300
+
+
+def default_owner():
+    """
+    Returns an owner identifier that is unique per ingest process.
+    """
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+class LeaseHeartbeat(object):
+    """
+    Renews the leases of an owner in a background thread while ingest runs.
+
+    ```python
+    heartbeat = LeaseHeartbeat(db, owner, ttl)
+    with heartbeat:
+        sid = db.claim_song(song_name, owner, ttl)
+        ...
+    ```
+
+    The context manager can be nested and shared between threads; the
+    heartbeat keeps running until the last block is left.
+    """
+
+    def __init__(self, database, owner, ttl=DEFAULT_LEASE_TTL):
+        super(LeaseHeartbeat, self).__init__()
+        self.database = database
+        self.owner = owner
+        self.ttl = ttl
+        self._depth = 0
+        self._lock = threading.Lock()
+        self._stopped = None
+        self._thread = None
+
+    def _run(self, stopped):
+        # renew well before the lease can run out
+        while not stopped.wait(self.ttl / 3.0):
+            try:
+                self.database.renew_leases(self.owner, self.ttl)
+            except Exception:
+                # a missed heartbeat is retried on the next tick
+                pass
+
+    def __enter__(self):
+        with self._lock:
+            self._depth += 1
+            if self._depth == 1:
+                self._stopped = threading.Event()
+                self._thread = threading.Thread(target=self._run,
+                                                args=(self._stopped,))
+                self._thread.daemon = True
+                self._thread.start()
+        return self
+
+    def __exit__(self, extype, exvalue, traceback):
+        with self._lock:
+            self._depth -= 1
+            if self._depth == 0:
+                self._stopped.set()
+                self._thread = None
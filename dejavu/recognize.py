@@ -1,3 +1,4 @@
+from dejavu.align import OffsetHistogram
 import dejavu.fingerprint as fingerprint
 import dejavu.decoder as decoder
 import numpy as np
@@ -12,10 +13,68 @@ class BaseRecognizer(object):
         self.Fs = fingerprint.DEFAULT_FS
 
     def _recognize(self, *data):
-        matches = []
-        for d in data:
-            matches.extend(self.dejavu.find_matches(d, Fs=self.Fs))
-        return self.dejavu.align_matches(matches)
+        """
+        Fingerprints the channels in `data` and aligns their matches.
+
+        When the Dejavu instance has a `recognize_margin` or a
+        `recognize_deadline`, the clip is processed in time-ordered chunks
+        and recognition stops as soon as the best song leads the runner-up
+        by the margin or the deadline passes, returning the best match
+        found so far.
+        """
+        deadline = self.dejavu.recognize_deadline
+        if deadline is not None:
+            deadline += time.time()
+
+        histogram = OffsetHistogram()
+        if not self._incremental(data):
+            for hashes in self.dejavu.fingerprint_channels(data, Fs=self.Fs):
+                self._add_matches(histogram, set(hashes))
+            return self.dejavu.resolve_alignment(histogram)
+
+        # each channel is fingerprinted piece by piece, so every sample
+        # is only processed once however many chunks it takes
+        channels = [fingerprint.ChannelFingerprinter(Fs=self.Fs)
+                    for _ in data]
+        for final, chunk in self._chunks(data):
+            for channel, samples in zip(channels, chunk):
+                self._add_matches(histogram,
+                                  set(channel.feed(samples, final)))
+                if self._settled(histogram, deadline):
+                    return self.dejavu.resolve_alignment(histogram)
+
+        return self.dejavu.resolve_alignment(histogram)
+
+    def _add_matches(self, histogram, hashes):
+        self.dejavu.add_matches(histogram, hashes)
+
+    def _incremental(self, data):
+        return bool(data and self.dejavu.recognize_chunk_seconds and (
+            self.dejavu.recognize_margin is not None or
+            self.dejavu.recognize_deadline is not None))
+
+    def _chunks(self, data):
+        """
+        Yields (final, channels) for consecutive windows over the clip in
+        time order, `final` being True for the last one.
+        """
+        size = max(1, int(self.dejavu.recognize_chunk_seconds * self.Fs))
+        length = max(len(d) for d in data)
+        for start in xrange(0, max(length, 1), size):
+            yield (start + size >= length,
+                   [d[start:start + size] for d in data])
+
+    def _settled(self, histogram, deadline):
+        if deadline is not None and time.time() >= deadline:
+            return True
+
+        margin = self.dejavu.recognize_margin
+        if margin is None:
+            return False
+
+        top = histogram.top(2)
+        runner_up = top[1][2] if len(top) > 1 else 0
+        return bool(top) and top[0][2] - runner_up >= margin
 
     def recognize(self):
         pass  # base class does nothing
@@ -0,0 +1,315 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from urlparse import parse_qs, urlparse
+from dejavu.recognize import FileRecognizer
+import httplib
+import json
+import os
+import Queue
+import socket
+import tempfile
+import threading
+import time
+import traceback
+
+DEFAULT_ADDRESS = "127.0.0.1:9000"
+
+
+class MatchBatcher(object):
+    """
+    Coalesces the hash lookups of concurrent requests into one database
+    query.
+
+    Every caller of `find_matches` blocks until its lookup is done. A
+    background thread takes the first waiting request, gathers whatever
+    else arrives within `window` seconds (up to `max_batch` requests) and
+    resolves all of them with a single `Dejavu.find_matches_many` call.
+    """
+
+    def __init__(self, dejavu, window=0.005, max_batch=64):
+        super(MatchBatcher, self).__init__()
+        self.dejavu = dejavu
+        self.window = window
+        self.max_batch = max_batch
+        self._requests = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def find_matches(self, hash_lists):
+        """
+        Returns one list of (sid, offset_difference) tuples per hash list,
+        like `Dejavu.find_matches_many`.
+        """
+        request = _BatchRequest(hash_lists)
+        self._requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
+    def _collect(self):
+        first = self._requests.get()
+        if first is None:
+            return None
+
+        batch = [first]
+        deadline = time.time() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=remaining)
+            except Queue.Empty:
+                break
+            if request is None:
+                # finish this batch, then stop
+                self._requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+
+            hash_lists = [hashes for request in batch
+                          for hashes in request.hash_lists]
+            try:
+                results = self.dejavu.find_matches_many(hash_lists)
+            except Exception as err:
+                for request in batch:
+                    request.error = err
+                    request.done.set()
+                continue
+
+            for request in batch:
+                request.result = results[:len(request.hash_lists)]
+                results = results[len(request.hash_lists):]
+                request.done.set()
+
+
+class _BatchRequest(object):
+
+    def __init__(self, hash_lists):
+        super(_BatchRequest, self).__init__()
+        self.hash_lists = [list(hashes) for hashes in hash_lists]
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BatchedFileRecognizer(FileRecognizer):
+    """
+    Recognizes files like `FileRecognizer`, incrementally and aggregated
+    as configured, but looks hashes up through a `MatchBatcher`. Matches
+    counted by the database (`aggregate_in_database`) cannot be batched
+    and are looked up directly.
+    """
+
+    def __init__(self, dejavu, batcher):
+        super(BatchedFileRecognizer, self).__init__(dejavu)
+        self.batcher = batcher
+
+    def _add_matches(self, histogram, hashes):
+        if self.dejavu.aggregate_in_database:
+            return super(BatchedFileRecognizer, self)._add_matches(
+                histogram, hashes)
+        matches, = self.batcher.find_matches([hashes])
+        histogram.add(matches)
+
+
+class RecognitionHandler(BaseHTTPRequestHandler):
+    """
+    Endpoints:
+
+        POST /recognize
+            Either the audio file itself as the body, with its format
+            given as `?format=mp3`, or a JSON body `{"path":
+            "/path/to/file"}` naming a file readable by the server. Paths
+            are only accepted on a Unix socket, or below the server's
+            `path_root`.
+            Answers with the match as JSON, or `null`.
+
+        GET /status
+            Answers with the number of fingerprinted songs.
+    """
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/status":
+            return self._respond(404, {"error": "not found"})
+        self._respond(200, {"songs": len(self.server.dejavu.songnames_set)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/recognize":
+            return self._respond(404, {"error": "not found"})
+
+        length = int(self.headers.getheader("content-length", 0))
+        body = self.rfile.read(length)
+
+        try:
+            if self.headers.gettype() == "application/json":
+                path = json.loads(body)["path"]
+                if not self.server.may_read(path):
+                    return self._respond(403, {
+                        "error": "reading files is not allowed here, "
+                                 "send the audio instead"})
+                match = self.server.recognize_file(path)
+            else:
+                fmt = parse_qs(url.query).get("format", [""])[0]
+                match = self.server.recognize_data(body, fmt)
+        except Exception as err:
+            traceback.print_exc()
+            return self._respond(500, {"error": str(err)})
+
+        self._respond(200, match)
+
+    def _respond(self, status, content):
+        body = json.dumps(content)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # unix socket clients have no address
+        if not isinstance(self.client_address, tuple):
+            self.client_address = ("unix", 0)
+        BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class _RecognitionServerMixin(ThreadingMixIn):
+    daemon_threads = True
+
+    # clients may name files on the server's disk
+    local_clients = False
+
+    def setup_dejavu(self, dejavu, batch_window, max_batch, path_root=None):
+        self.dejavu = dejavu
+        self.batcher = MatchBatcher(dejavu, batch_window, max_batch)
+        self.path_root = path_root and os.path.realpath(path_root)
+
+    def may_read(self, filename):
+        """
+        Whether a client may have the server read `filename`: always on a
+        Unix socket, whose clients share the host, otherwise only files
+        below `path_root`.
+        """
+        if self.local_clients:
+            return True
+        if not self.path_root:
+            return False
+        path = os.path.realpath(filename)
+        return path.startswith(os.path.join(self.path_root, ""))
+
+    def recognize_file(self, filename):
+        # the same path as `dejavu.py --recognize file`
+        return BatchedFileRecognizer(
+            self.dejavu, self.batcher).recognize_file(filename)
+
+    def recognize_data(self, data, fmt=""):
+        suffix = "." + fmt if fmt else ""
+        handle, filename = tempfile.mkstemp(suffix=suffix)
+        try:
+            with os.fdopen(handle, "wb") as f:
+                f.write(data)
+            return self.recognize_file(filename)
+        finally:
+            os.remove(filename)
+
+    def server_close(self):
+        self.batcher.close()
+        self.socket.close()
+
+
+class RecognitionServer(_RecognitionServerMixin, HTTPServer):
+    pass
+
+
+class UnixRecognitionServer(_RecognitionServerMixin, UnixStreamServer):
+    local_clients = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        UnixStreamServer.server_bind(self)
+
+
+def make_server(dejavu, address=DEFAULT_ADDRESS, batch_window=0.005,
+                max_batch=64, path_root=None):
+    """
+    Creates a recognition server around a ready Dejavu instance.
+
+      address: "host:port" for HTTP over TCP, or "unix:/path/to/socket"
+    path_root: directory below which TCP clients may name files to
+               recognize; by default they have to send the audio
+    """
+    if address.startswith("unix:"):
+        server = UnixRecognitionServer(address[len("unix:"):],
+                                       RecognitionHandler)
+    else:
+        host, port = address.rsplit(":", 1)
+        server = RecognitionServer((host, int(port)), RecognitionHandler)
+    server.setup_dejavu(dejavu, batch_window, max_batch, path_root)
+    return server
+
+
+def serve(dejavu, address=DEFAULT_ADDRESS, **options):
+    server = make_server(dejavu, address, **options)
+    print "Serving recognition requests on %s" % address
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class _UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, path):
+        httplib.HTTPConnection.__init__(self, "localhost")
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_path)
+
+
+def recognize_remote(address, filename):
+    """
+    Asks a running recognition server to recognize a file. Over a Unix
+    socket the server reads the file itself, over TCP it is uploaded.
+    Returns the match dictionary, or None.
+    """
+    if address.startswith("unix:"):
+        conn = _UnixHTTPConnection(address[len("unix:"):])
+        url = "/recognize"
+        body = json.dumps({"path": os.path.abspath(filename)})
+        content_type = "application/json"
+    else:
+        conn = httplib.HTTPConnection(address)
+        url = "/recognize?format=%s" % os.path.splitext(filename)[1][1:]
+        with open(filename, "rb") as f:
+            body = f.read()
+        content_type = "application/octet-stream"
+
+    try:
+        conn.request("POST", url, body, {"Content-Type": content_type})
+        response = conn.getresponse()
+        content = json.loads(response.read())
+    finally:
+        conn.close()
+
+    if response.status != 200:
+        raise RuntimeError(content.get("error", "recognition failed"))
+    return content
@@ -3,6 +3,7 @@ from pydub import AudioSegment
 from dejavu.decoder import path_to_songname
 from dejavu import Dejavu
 from dejavu.fingerprint import *
+from dejavu.server import recognize_remote
 import traceback
 import fnmatch
 import os, re, ast
@@ -113,11 +114,14 @@ def autolabeldoubles(rects, ax):
             '%s' % round(float(height), 3), ha='center', va='bottom')
 
 class DejavuTest(object):
-    def __init__(self, folder, seconds):
+    def __init__(self, folder, seconds, server=None):
         super(DejavuTest, self).__init__()
 
         self.test_folder = folder
         self.test_seconds = seconds
+        # address of a running `dejavu.py --serve`, None starts a new
+        # dejavu.py process for every test file
+        self.server = server
         self.test_songs = []
 
         print "test_seconds", self.test_seconds
@@ -201,6 +205,30 @@ class DejavuTest(object):
             fig_name = os.path.join(results_folder, "%s_%s.png" % (name, self.test_seconds[sec]))
             fig.savefig(fig_name)
 
+    def recognize(self, filename):
+        """
+        Returns the match dictionary for `filename`, or None.
+        """
+        if self.server:
+            return recognize_remote(self.server, filename)
+
+        result = subprocess.check_output([
+            "python", 
+            "dejavu.py",
+            '-r',
+            'file', 
+            filename])
+
+        if result.strip() == "None":
+            return None
+
+        result = result.strip()
+        result = result.replace(" \'", ' "')
+        result = result.replace("{\'", '{"')
+        result = result.replace("\':", '":')
+        result = result.replace("\',", '",')
+        return ast.literal_eval(result)
+
     def begin(self):
         for f in self.test_files:
             log_msg('--------------------------------------------------')
@@ -211,14 +239,9 @@ class DejavuTest(object):
             # format: XXXX_offset_length.mp3
             song = path_to_songname(f).split("_")[0]  
             line = self.get_line_id(song)
-            result = subprocess.check_output([
-                "python", 
-                "dejavu.py",
-                '-r',
-                'file', 
-                self.test_folder + "/" + f])
-
-            if result.strip() == "None":
+            result = self.recognize(self.test_folder + "/" + f)
+
+            if result is None:
                 log_msg('No match')
                 self.result_match[line][col] = 'no'
                 self.result_matching_times[line][col] = 0
@@ -226,14 +249,7 @@ class DejavuTest(object):
                 self.result_match_confidence[line][col] = 0
             
             else:
-                result = result.strip()
-                result = result.replace(" \'", ' "')
-                result = result.replace("{\'", '{"')
-                result = result.replace("\':", '":')
-                result = result.replace("\',", '",')
-
                 # which song did we predict?
-                result = ast.literal_eval(result)
                 song_result = result["song_name"]
                 log_msg('song: %s' % song)
                 log_msg('song_result: %s' % song_result)
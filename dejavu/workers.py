@@ -0,0 +1,111 @@
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import threading
+
+# execution modes understood by `WorkerPool`
+MODE_PROCESS = "process"
+MODE_THREAD = "thread"
+
+
+def _initialize_worker():
+    """
+    Runs once in every worker when the pool starts.
+
+    Importing the audio stack and building the peak filter structures here
+    means the first song or clip a worker receives does not pay for it.
+    """
+    import dejavu.decoder
+    import dejavu.fingerprint as fingerprint
+    fingerprint.warm_up()
+
+
+def default_processes(processes=None):
+    # Try to use the maximum amount of processes if not given.
+    try:
+        processes = processes or multiprocessing.cpu_count()
+    except NotImplementedError:
+        processes = 1
+    return 1 if processes <= 0 else processes
+
+
+class WorkerPool(object):
+    """
+    A long-lived pool of warm fingerprinting workers.
+
+    The underlying pool is started lazily on first use and then reused by
+    every ingest and recognition call until `close` is called. Threads may
+    share a `WorkerPool`; only one of them starts the pool.
+
+    With `mode="thread"` the workers are threads of the calling process
+    instead of forked children. Nothing has to be pickled and nothing is
+    forked, which suits servers that are already threaded; the FFT and
+    the peak filters release the GIL for most of their runtime.
+
+    ```python
+    workers = WorkerPool(4)
+    for result in workers.imap_unordered(func, tasks):
+        ...
+    workers.close()
+    ```
+    """
+
+    def __init__(self, processes=None, database=None, mode=None):
+        super(WorkerPool, self).__init__()
+        self.processes = default_processes(processes)
+        self.database = database
+        self.mode = (mode or MODE_PROCESS).lower()
+        if self.mode not in (MODE_PROCESS, MODE_THREAD):
+            raise TypeError("Unsupported worker mode supplied.")
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def threaded(self):
+        return self.mode == MODE_THREAD
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                if self.threaded:
+                    self._pool = ThreadPool(self.processes,
+                                            _initialize_worker)
+                else:
+                    if self.database is not None:
+                        self.database.before_fork()
+                    self._pool = multiprocessing.Pool(self.processes,
+                                                      _initialize_worker)
+            return self._pool
+
+    def resize(self, processes):
+        """
+        Makes sure the pool runs `processes` workers, restarting it only if
+        the size actually changes.
+        """
+        processes = default_processes(processes)
+        with self._lock:
+            if processes == self.processes:
+                return
+            self.processes = processes
+        self.close()
+
+    def imap_unordered(self, func, iterable):
+        return self.pool.imap_unordered(func, iterable)
+
+    def map(self, func, iterable):
+        return self.pool.map(func, iterable)
+
+    def apply_async(self, func, args=(), kwds={}, callback=None):
+        return self.pool.apply_async(func, args, kwds, callback)
+
+    def close(self):
+        """
+        Stops the workers once the tasks already handed to them are done.
+        The pool is started again on next use.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        # joined outside the lock, a task may still start the next pool
+        if pool is not None:
+            pool.close()
+            pool.join()
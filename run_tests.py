@@ -49,6 +49,12 @@ parser.add_option("--seed",
                   default=None,
                   type=int,
                   help='Random seed')
+parser.add_option("--server",
+                  action="store",
+                  dest="server",
+                  default=None,
+                  help='Address of a running "dejavu.py --serve" to send '
+                       'recognition requests to')
 options, args = parser.parse_args()
 test_folder = args[0]
 
@@ -78,7 +84,7 @@ log_msg("Running Dejavu fingerprinter on files in %s..." % test_folder,
         log=options.log, silent=options.silent)
 
 tm = time.time()
-djv = DejavuTest(options.temp_folder, test_seconds)
+djv = DejavuTest(options.temp_folder, test_seconds, server=options.server)
 log_msg("finished obtaining results from dejavu in %s" % (time.time() - tm),
         log=options.log, silent=options.silent)
 
@@ -6,6 +6,16 @@
 # Clear out previous results
 rm -rf ./results ./temp_audio
 
+###########
+# Ingest the ./mp3 folder from 4 processes at once and check that the
+# song leases split the work (empties the database first)
+python test_leases.py --processes 4 ./mp3 mp3
+
+###########
+# Check that recognizing in chunks finds the same songs as a single pass
+# and costs about as much (uses an in-memory database)
+python test_incremental.py ./mp3/*.mp3
+
 ###########
 # Fingerprint files of extension mp3 in the ./mp3 folder
 python dejavu.py -f ./mp3/ mp3
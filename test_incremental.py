@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+"""
+Checks that incremental recognition fingerprints every sample only once:
+fingerprinting a file in chunks gives exactly the hashes of a single
+pass, and recognizing it in chunks takes about as long as recognizing it
+in one pass and finds the same song.
+
+    python test_incremental.py ./mp3/*.mp3
+
+Uses an in-memory database, so no database server is needed.
+"""
+
+import sys
+import time
+import argparse
+
+from dejavu import Dejavu
+from dejavu.recognize import FileRecognizer
+import dejavu.decoder as decoder
+import dejavu.fingerprint as fingerprint
+
+# chunked work may take this much longer than a single pass
+MAX_SLOWDOWN = 1.5
+
+
+def check(description, ok):
+    print("%s: %s" % ("ok" if ok else "FAILED", description))
+    return ok
+
+
+def best_time(func, repeat=3):
+    times = []
+    for _ in range(repeat):
+        t = time.time()
+        result = func()
+        times.append(time.time() - t)
+    return min(times), result
+
+
+def fingerprint_in_chunks(samples, Fs, chunk_seconds):
+    channel = fingerprint.ChannelFingerprinter(Fs=Fs)
+    size = int(chunk_seconds * Fs)
+    hashes = []
+    for start in range(0, len(samples), size):
+        hashes.extend(channel.feed(samples[start:start + size],
+                                   start + size >= len(samples)))
+    return hashes
+
+
+def test_fingerprints(filename, chunk_seconds):
+    channels, Fs = decoder.read(filename)
+    single, whole = best_time(
+        lambda: list(fingerprint.fingerprint(channels[0], Fs=Fs)))
+    chunked, pieces = best_time(
+        lambda: fingerprint_in_chunks(channels[0], Fs, chunk_seconds))
+
+    ok = check("%s: same hashes in chunks as in one pass" % filename,
+               sorted(whole) == sorted(pieces))
+    ok &= check("%s: fingerprinting in chunks took %.2fs, one pass %.2fs"
+                % (filename, chunked, single),
+                chunked <= single * MAX_SLOWDOWN)
+    return ok
+
+
+def test_recognition(filenames, chunk_seconds):
+    config = {"database_type": "memory", "worker_processes": 1}
+    djv = Dejavu(config)
+    for filename in filenames:
+        djv.fingerprint_file(filename)
+
+    ok = True
+    for filename in filenames:
+        djv.recognize_margin = None
+        single, match = best_time(
+            lambda: djv.recognize(FileRecognizer, filename))
+
+        # a margin no song reaches, so the whole clip is worked through
+        djv.recognize_margin = sys.maxint
+        djv.recognize_chunk_seconds = chunk_seconds
+        chunked, chunked_match = best_time(
+            lambda: djv.recognize(FileRecognizer, filename))
+
+        same = (match and chunked_match and
+                match[Dejavu.SONG_ID] == chunked_match[Dejavu.SONG_ID] and
+                match[Dejavu.OFFSET] == chunked_match[Dejavu.OFFSET] and
+                match[Dejavu.CONFIDENCE] == chunked_match[Dejavu.CONFIDENCE])
+        ok &= check("%s: same match in chunks as in one pass" % filename,
+                    same)
+        ok &= check("%s: recognizing in chunks took %.2fs, one pass %.2fs"
+                    % (filename, chunked, single),
+                    chunked <= single * MAX_SLOWDOWN)
+
+    djv.close()
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Test that incremental recognition costs about the "
+                    "same as a single pass.")
+    parser.add_argument('-s', '--chunk-seconds', type=float, default=2,
+                        help='seconds of audio per chunk')
+    parser.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    ok = True
+    for filename in args.files:
+        ok &= test_fingerprints(filename, args.chunk_seconds)
+    ok &= test_recognition(args.files, args.chunk_seconds)
+    sys.exit(0 if ok else 1)
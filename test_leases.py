@@ -0,0 +1,135 @@
+#!/usr/bin/python
+
+"""
+Checks that several ingest processes sharing one database split the work
+through song leases: every song is claimed and fingerprinted exactly once,
+a process starting up never removes songs the others are still working on,
+and a host whose lease ran out can neither finish nor remove a song taken
+over by another one.
+
+    python test_leases.py --config dejavu.cnf --processes 4 ./mp3 mp3
+
+WARNING: empties the database first.
+"""
+
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+from dejavu import Dejavu
+from dejavu.database import LeaseLostError
+import dejavu.decoder as decoder
+
+
+def ingest(config, owner, folder, extension, claims):
+    config = dict(config, ingest_owner=owner, worker_processes=1)
+    djv = Dejavu(config)
+
+    # count the songs this process won
+    claim_song = djv.db.claim_song
+    won = []
+
+    def counting_claim_song(song_name, owner, ttl):
+        sid = claim_song(song_name, owner, ttl)
+        if sid is not None:
+            won.append(song_name)
+        return sid
+    djv.db.claim_song = counting_claim_song
+
+    djv.fingerprint_directory(folder, ["." + extension])
+    djv.close()
+    claims.put((owner, won))
+
+
+def check(description, ok):
+    print("%s: %s" % ("ok" if ok else "FAILED", description))
+    return ok
+
+
+def test_parallel_ingest(config, processes, folder, extension):
+    expected = set(decoder.path_to_songname(filename) for filename, _
+                   in decoder.find_files(folder, ["." + extension]))
+
+    claims = multiprocessing.Queue()
+    workers = []
+    for i in xrange(processes):
+        worker = multiprocessing.Process(
+            target=ingest,
+            args=(config, "test-host-%d" % i, folder, extension, claims))
+        worker.start()
+        workers.append(worker)
+        # later processes run setup() while the first ones ingest
+        time.sleep(1)
+
+    won = [claims.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    claimed = [song_name for _, songs in won for song_name in songs]
+    for owner, songs in won:
+        print("%s fingerprinted %d songs" % (owner, len(songs)))
+
+    djv = Dejavu(config)
+    stored = [song[djv.db.FIELD_SONGNAME] for song in djv.db.get_songs()]
+    djv.close()
+
+    ok = check("every song claimed once",
+               sorted(claimed) == sorted(expected))
+    ok &= check("every song stored once", sorted(stored) == sorted(expected))
+    return ok
+
+
+def test_lease_takeover(config):
+    djv = Dejavu(config)
+    db = djv.db
+    song_name = "lease takeover test"
+
+    # the first host's lease runs out right away
+    sid = db.claim_song(song_name, "test-host-a", -1)
+    ok = check("expired lease taken over",
+               db.claim_song(song_name, "test-host-b", 60) == sid)
+    ok &= check("old owner cannot release the song",
+                not db.release_song(sid, "test-host-a"))
+    try:
+        db.set_song_fingerprinted(sid, "test-host-a")
+    except LeaseLostError:
+        lost = True
+    else:
+        lost = False
+    ok &= check("old owner cannot finish the song", lost)
+    db.set_song_fingerprinted(sid, "test-host-b")
+    ok &= check("new owner finishes the song",
+                db.get_song_by_id(sid) is not None and
+                song_name in [song[db.FIELD_SONGNAME]
+                              for song in db.get_songs()])
+
+    db.delete_song(sid)
+    djv.close()
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Test ingest leases with several local processes. "
+                    "WARNING: empties the database first.")
+    parser.add_argument('-c', '--config', default='dejavu.cnf',
+                        help='Dejavu JSON configuration')
+    parser.add_argument('-p', '--processes', type=int, default=4,
+                        help='number of ingest processes')
+    parser.add_argument('folder')
+    parser.add_argument('extension')
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+
+    djv = Dejavu(config)
+    djv.empty()
+    djv.close()
+
+    ok = test_lease_takeover(config)
+    ok &= test_parallel_ingest(config, args.processes, args.folder,
+                               args.extension)
+    sys.exit(0 if ok else 1)